@@ -1,6 +1,8 @@
 from django.contrib import admin
 
+from .forms import ImageLabelForm
 from .models import Image, Label, ImageLabel
+from .registry import label_registry
 
 
 class ImageAdmin(admin.ModelAdmin):
@@ -8,10 +10,22 @@ class ImageAdmin(admin.ModelAdmin):
     list_display = ('taken_date', 'created_date', 'file', 'caption', 'uploaded_by')
 
 
+class ImageLabelAdmin(admin.ModelAdmin):
+    form = ImageLabelForm
+    list_display = ('id', 'image', 'label_title', 'user', 'created_date')
+    list_select_related = ('image', 'user')
+
+    def label_title(self, obj):
+        """ Label title from the registry, rather than a query per row """
+        return label_registry.title(obj.label_id)
+    label_title.short_description = 'label'
+    label_title.admin_order_field = 'label__title'
+
+
 admin.site.register(Image, ImageAdmin)
 
 admin.site.register(Label)
-admin.site.register(ImageLabel)
+admin.site.register(ImageLabel, ImageLabelAdmin)
 
 
 # from django.contrib import admin
@@ -0,0 +1,68 @@
+""" Conditional GET (ETag and Last-Modified validators) for the image APIs
+
+A client that sends back the ETag (If-None-Match) or Last-Modified (If-Modified-Since) of its last response gets
+an empty `304 Not Modified` when nothing has changed, without a single object being fetched or serialized:
+  - lists are validated by the max(updated_date) and COUNT(*) of the (filtered) queryset, one aggregate query.
+    They get no Last-Modified: deleting an image changes the COUNT(*) but can't move max(updated_date), so an
+    If-Modified-Since would keep matching a list that lost rows.
+  - a single object is validated by its own updated_date
+Both also hash the query string and Accept header, because `?fields=`, `?cursor=` or `?format=` change the response.
+
+Image.updated_date is bumped by anything that changes its serialization, including new votes
+(see `TotalVotesManager.apply_deltas`).
+"""
+import hashlib
+from calendar import timegm
+
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+
+def make_etag(request, *parts):
+    """ Quoted ETag for a representation of a resource, given the parts of its state that determine it """
+    parts += (request.META.get('QUERY_STRING', ''), request.META.get('HTTP_ACCEPT', ''))
+    state = '|'.join(str(p) for p in parts)
+    return quote_etag(hashlib.md5(state.encode('utf-8')).hexdigest())
+
+
+def set_validators(response, etag, last_modified):
+    if 200 <= response.status_code < 300:
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+class ConditionalListMixin(object):
+    """ ListAPIView mixin that answers a list request with 304 Not Modified when the list hasn't changed """
+    updated_field = 'updated_date'
+
+    def list(self, request, *args, **kwargs):
+        state = (self.filter_queryset(self.get_queryset()).order_by()
+                 .aggregate(updated=Max(self.updated_field), count=Count('pk')))
+        etag = make_etag(request, state['updated'] and state['updated'].isoformat(), state['count'])
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            return not_modified
+        return set_validators(super().list(request, *args, **kwargs), etag, None)
+
+
+class ConditionalRetrieveMixin(object):
+    """ RetrieveAPIView mixin that answers with 304 Not Modified when the object hasn't changed """
+    updated_field = 'updated_date'
+
+    def retrieve(self, request, *args, **kwargs):
+        # just the one column, so a 304 costs a single small query (no related objects prefetched)
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        updated = (self.filter_queryset(self.get_queryset()).prefetch_related(None)
+                   .filter(**{self.lookup_field: kwargs[lookup_url_kwarg]})
+                   .values_list(self.updated_field, flat=True).first())
+        if updated is None:
+            return super().retrieve(request, *args, **kwargs)  # 404
+        last_modified = timegm(updated.utctimetuple())
+        etag = make_etag(request, kwargs[lookup_url_kwarg], updated.isoformat())
+        not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if not_modified is not None:
+            return not_modified
+        return set_validators(super().retrieve(request, *args, **kwargs), etag, last_modified)
@@ -0,0 +1,68 @@
+""" The consensus (top-k labels, vote counts and agreement ratio) for Images, served from cached TotalVotes
+
+Each image's full tally is cached under its own key, so a batch of N images costs one cache.get_many()
+plus at most one TotalVotes query for the cache misses, no matter how large N is.
+TotalVotesManager.apply_deltas() deletes the cached tallies of the images whose votes changed.
+"""
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+CACHE_KEY = 'labeler:consensus:{}'
+CACHE_TIMEOUT = getattr(settings, 'LABELER_CONSENSUS_CACHE_TIMEOUT', 24 * 60 * 60)
+
+
+def cache_key(image_id):
+    """
+    >>> cache_key(42)
+    'labeler:consensus:42'
+    """
+    return CACHE_KEY.format(image_id)
+
+
+def invalidate_consensus(image_ids, using=None):
+    """ Forget the cached tallies for these images, now and again once the vote transaction commits """
+    keys = [cache_key(image_id) for image_id in set(image_ids)]
+    if keys:
+        cache.delete_many(keys)
+        transaction.on_commit(lambda: cache.delete_many(keys), using=using)
+
+
+def get_tallies(image_ids):
+    """ {image_id: [(name, votes), ...] sorted by descending votes} from the cache, or from TotalVotes on a miss """
+    image_ids = list(image_ids)
+    cached = cache.get_many([cache_key(image_id) for image_id in image_ids])
+    tallies = {image_id: cached[cache_key(image_id)] for image_id in image_ids if cache_key(image_id) in cached}
+    missing = [image_id for image_id in image_ids if image_id not in tallies]
+    if missing:
+        TotalVotes = apps.get_model('labeler', 'TotalVotes')
+        fetched = {image_id: [] for image_id in missing}
+        for image_id, name, votes in (TotalVotes.objects.filter(image_id__in=missing, votes__gt=0)
+                                      .order_by('image_id', '-votes', 'name')
+                                      .values_list('image_id', 'name', 'votes')):
+            fetched[image_id].append((name, votes))
+        cache.set_many({cache_key(image_id): tally for image_id, tally in fetched.items()}, CACHE_TIMEOUT)
+        tallies.update(fetched)
+    return tallies
+
+
+def summarize(image_id, tally, k=3):
+    """ Top-k labels, total votes and agreement ratio (fraction of the votes that went to the top label)
+
+    >>> summarize(7, [('coyote', 3), ('wolf', 1)], k=1)
+    {'image': 7, 'total_votes': 4, 'agreement': 0.75, 'labels': [{'label': 'coyote', 'votes': 3}]}
+    """
+    total = sum(votes for _, votes in tally)
+    return {
+        'image': image_id,
+        'total_votes': total,
+        'agreement': (float(tally[0][1]) / total) if total else None,
+        'labels': [{'label': name, 'votes': votes} for name, votes in tally[:k]],
+    }
+
+
+def image_consensus(image_ids, k=3):
+    """ List of consensus summaries, one for each of the image_ids, in the same order """
+    tallies = get_tallies(image_ids)
+    return [summarize(image_id, tallies[image_id], k=k) for image_id in image_ids]
@@ -0,0 +1,179 @@
+""" Read Darknet `.weights` files into Keras layer order and layout, with a cache of the converted tensors
+
+A Darknet weights file is a 4-int32 header followed by every layer's float32 parameters, for each convolution:
+the batch normalization beta, gamma, mean and variance (or the conv bias, without batch normalization), then the
+kernel in (out, in, height, width) order. Keras wants [gamma, beta, mean, variance] and (height, width, in, out).
+
+`WeightReader` memory-maps the file, so reading a layer is a zero-copy slice rather than a copy of the whole file.
+`conversion_plan` works out the shapes of every layer once, from the model's layer names and weight shapes.
+`load_converted` writes the converted (transposed, contiguous) tensors to one .npy file named by a hash of the
+source file and the plan, and later starts memory-map that instead, so no conversion is repeated and only the
+pages Keras copies into the model are ever read. The source hash is remembered next to the cache along with the
+file's size and mtime, so it's only recomputed when the weights file changes.
+
+NumPy only: labeler.yolo.load_weights passes in the Keras layer shapes.
+"""
+import hashlib
+import json
+import os
+import tempfile
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+HEADER_SIZE = 4  # int32 values (major, minor, revision, images seen), so 4 float32-sized words
+
+# conv: layer name, kernel: its Keras (height, width, in, out) shape, bias: whether it has a bias,
+# norm: the name of the BatchNormalization layer that follows it (or None)
+ConvPlan = namedtuple('ConvPlan', ['conv', 'kernel', 'bias', 'norm'])
+
+
+class WeightReader:
+    """ Sequential reader of the float32 values in a Darknet weights file, as views into a read-only memory map """
+
+    def __init__(self, weight_file):
+        self.all_weights = np.memmap(weight_file, dtype='float32', mode='r')
+        self.offset = HEADER_SIZE
+
+    def read_bytes(self, size):
+        """ The next `size` float32 values (the name is historical: it's values, not bytes) """
+        size = int(size)
+        if self.offset + size > len(self.all_weights):
+            raise ValueError('Weights file too short: {} values wanted at offset {} of {}'.format(
+                size, self.offset, len(self.all_weights)))
+        self.offset += size
+        return self.all_weights[self.offset - size:self.offset]
+
+    def reset(self):
+        self.offset = HEADER_SIZE
+
+
+def conversion_plan(layers):
+    """ ConvPlan for each convolution, from the model's (layer name, [weight shapes]) pairs in layer order
+
+    >>> plan = conversion_plan([('conv2d_1', [(3, 3, 3, 16)]), ('batch_normalization_1', [(16,)] * 4),
+    ...                         ('leaky_re_lu_1', []), ('conv2d_2', [(1, 1, 16, 125), (125,)])])
+    >>> [(step.conv, step.kernel, step.bias, step.norm) for step in plan]
+    [('conv2d_1', (3, 3, 3, 16), False, 'batch_normalization_1'), ('conv2d_2', (1, 1, 16, 125), True, None)]
+    """
+    layers = list(layers)
+    plan = []
+    for i, (name, shapes) in enumerate(layers):
+        if 'conv' in name:
+            norm = layers[i + 1][0] if i + 1 < len(layers) and 'batch' in layers[i + 1][0] else None
+            plan.append(ConvPlan(name, tuple(int(d) for d in shapes[0]), len(shapes) > 1, norm))
+    return plan
+
+
+def plan_arrays(plan):
+    """ (layer name, [Keras weight shapes]) in the order the converted tensors are stored """
+    for step in plan:
+        out = step.kernel[-1]
+        if step.norm:
+            yield step.norm, [(out,)] * 4
+        yield step.conv, [step.kernel, (out,)] if step.bias else [step.kernel]
+
+
+def convert(reader, plan):
+    """ OrderedDict {layer name: [weights in Keras order and layout]} read from a WeightReader """
+    converted = OrderedDict()
+    for step in plan:
+        out = step.kernel[-1]
+        if step.norm:
+            beta, gamma, mean, var = (reader.read_bytes(out) for _ in range(4))
+            converted[step.norm] = [gamma, beta, mean, var]
+        bias = reader.read_bytes(out) if step.bias else None
+        kernel = reader.read_bytes(np.prod(step.kernel))
+        # Darknet (out, in, height, width) -> Keras (height, width, in, out)
+        kernel = kernel.reshape(tuple(reversed(step.kernel))).transpose([2, 3, 1, 0])
+        converted[step.conv] = [kernel] if bias is None else [kernel, bias]
+    return converted
+
+
+def file_hash(path, block_size=2 ** 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fin:
+        for block in iter(lambda: fin.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def source_hash(weights_path, cache_dir):
+    """ file_hash() of the weights file, remembered (in cache_dir) for as long as its size and mtime don't change """
+    stat = os.stat(weights_path)
+    signature = [os.path.abspath(weights_path), stat.st_size, stat.st_mtime_ns]
+    memo_path = os.path.join(cache_dir, os.path.basename(weights_path) + '.sha256')
+    try:
+        with open(memo_path) as fin:
+            memo = json.load(fin)
+        if memo['source'] == signature:
+            return memo['sha256']
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
+    digest = file_hash(weights_path)
+    try:
+        with open(memo_path, 'w') as fout:
+            json.dump({'source': signature, 'sha256': digest}, fout)
+    except (IOError, OSError):
+        pass
+    return digest
+
+
+def cache_path(weights_path, plan, cache_dir=None):
+    """ Where the converted tensors for this weights file (content) and model (plan) are cached """
+    cache_dir = cache_dir or os.path.dirname(os.path.abspath(weights_path))
+    plan_hash = hashlib.sha256(json.dumps(plan).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_dir, '{}-{}.npy'.format(source_hash(weights_path, cache_dir)[:32], plan_hash))
+
+
+def split(flat, plan):
+    """ The converted weights as views into one flat array, in the order of plan_arrays() """
+    converted, offset = OrderedDict(), 0
+    for name, shapes in plan_arrays(plan):
+        arrays = []
+        for shape in shapes:
+            size = int(np.prod(shape))
+            arrays.append(flat[offset:offset + size].reshape(shape))
+            offset += size
+        converted[name] = arrays
+    if offset != len(flat):
+        raise ValueError('Converted weights cache has {} values, the model needs {}'.format(len(flat), offset))
+    return converted
+
+
+def write_cache(converted, path):
+    """ Store the converted tensors (contiguous, in plan order) in one .npy file, atomically """
+    directory = os.path.dirname(path)
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        total = sum(array.size for arrays in converted.values() for array in arrays)
+        with os.fdopen(fd, 'wb') as fout:
+            np.lib.format.write_array_header_1_0(fout, {'descr': '<f4', 'fortran_order': False, 'shape': (total,)})
+            for arrays in converted.values():
+                for array in arrays:
+                    fout.write(np.ascontiguousarray(array, dtype='<f4').tobytes())
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def load_converted(weights_path, plan, cache_dir=None, use_cache=True):
+    """ OrderedDict {layer name: [Keras weights]} for a Darknet weights file, converted once and then cached
+
+    The arrays are read-only views into a memory map of the cache (or of the weights file, without the cache).
+    """
+    if not use_cache:
+        return convert(WeightReader(weights_path), plan)
+    try:
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        path = cache_path(weights_path, plan, cache_dir=cache_dir)
+        if not os.path.exists(path):
+            write_cache(convert(WeightReader(weights_path), plan), path)
+    except (IOError, OSError):
+        if not os.path.exists(weights_path):
+            raise
+        # read-only cache directory: convert on every start, as before
+        return convert(WeightReader(weights_path), plan)
+    return split(np.load(path, mmap_mode='r'), plan)
@@ -0,0 +1,110 @@
+""" Thumbnails and previews of Images, generated on first request (or right after upload) and cached on disk
+
+Each derivative is stored as `<size>/<ab>/<source key>.jpg` under LABELER_DERIVATIVES_ROOT (MEDIA_ROOT/derivatives),
+where the source key is the content_hash of the original (or a hash of its name, size and mtime for files uploaded
+before content hashes). A changed source gets a new key, so a cached derivative never needs invalidating and is only
+regenerated when its source changes.
+
+Requires Pillow. JPEGs are decoded at reduced scale (PIL's draft mode), so a 16 MP camera-trap photo never has to be
+decoded at full resolution to make a 160 px thumbnail.
+"""
+import hashlib
+import logging
+import os
+import tempfile
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+
+_logger = logging.getLogger(__name__)
+
+# name: maximum width and height in pixels (the aspect ratio is kept)
+SIZES = getattr(settings, 'LABELER_DERIVATIVE_SIZES', OrderedDict([('thumb', 160), ('medium', 800)]))
+JPEG_QUALITY = 85
+
+
+def derivatives_storage():
+    """ Storage for the derivatives cache (looked up on each call, so it follows changes to MEDIA_ROOT) """
+    location = getattr(settings, 'LABELER_DERIVATIVES_ROOT', None) or os.path.join(settings.MEDIA_ROOT, 'derivatives')
+    base_url = getattr(settings, 'LABELER_DERIVATIVES_URL', None) or settings.MEDIA_URL + 'derivatives/'
+    return FileSystemStorage(location=location, base_url=base_url)
+
+
+def source_key(image):
+    """ Key that changes whenever the Image's file content does: its content_hash, or a hash of its name and stat """
+    if image.content_hash:
+        return image.content_hash
+    storage, name = image.file.storage, image.file.name
+    stamp = '{}:{}:{}'.format(name, storage.size(name), storage.get_modified_time(name).timestamp())
+    return hashlib.sha256(stamp.encode('utf-8')).hexdigest()
+
+
+def derivative_name(key, size):
+    """
+    >>> derivative_name('e3b0c442', 'thumb')
+    'thumb/e3/e3b0c442.jpg'
+    """
+    return '{}/{}/{}.jpg'.format(size, key[:2], key)
+
+
+def render(fin, paths):
+    """ Decode the image in fin once and write a JPEG of each {max_size: path}, largest first """
+    import PIL.Image
+    import PIL.ImageOps
+
+    img = PIL.Image.open(fin)
+    largest = max(paths)
+    img.draft('RGB', (largest, largest))  # JPEG: decode straight from the DCT coefficients at 1/2, 1/4 or 1/8 scale
+    if hasattr(PIL.ImageOps, 'exif_transpose'):
+        img = PIL.ImageOps.exif_transpose(img)
+    img = img.convert('RGB')
+    for max_size in sorted(paths, reverse=True):
+        img.thumbnail((max_size, max_size), PIL.Image.LANCZOS)
+        write_atomically(img, paths[max_size])
+
+
+def write_atomically(img, path):
+    """ Save to a temporary file and rename it into place, so a half-written derivative is never served """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fout:
+            img.save(fout, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def generate_derivatives(image, sizes=None, force=False):
+    """ Make any of the derivatives of an Image that aren't in the cache yet, returning {size: name}
+
+    Raises:
+      KeyError: for an unknown size
+      ImportError: if Pillow isn't installed
+      IOError/OSError: if the source file can't be read or decoded
+    """
+    sizes = list(SIZES) if sizes is None else list(sizes)
+    storage, key = derivatives_storage(), source_key(image)
+    names = OrderedDict((size, derivative_name(key, size)) for size in sizes)
+    missing = {SIZES[size]: storage.path(name) for size, name in names.items() if force or not storage.exists(name)}
+    if missing:
+        with image.file.storage.open(image.file.name, 'rb') as fin:
+            render(fin, missing)
+    return names
+
+
+def derivative_url(image, size):
+    """ URL of a cached derivative, generating it first if need be """
+    return derivatives_storage().url(generate_derivatives(image, [size])[size])
+
+
+def generate_derivatives_quietly(images):
+    """ Eagerly generate the derivatives of freshly uploaded images, logging (not raising) any failures """
+    for image in images:
+        try:
+            generate_derivatives(image)
+        except (ImportError, IOError, OSError, ValueError) as e:
+            _logger.warning('Unable to generate derivatives of image %s (%s): %s', image.pk, image.file.name, e)
@@ -0,0 +1,212 @@
+""" Object detection (YOLO v2, labeler.yolo) for uploaded images, as a long-lived in-process service
+
+The Keras model is built and its weights loaded once per worker process, on the first request, by the one thread
+that then runs every forward pass for that process. Requests are queued and collected into micro-batches of at
+most LABELER_DETECTION_MAX_BATCH images, waiting at most LABELER_DETECTION_MAX_WAIT seconds for a batch to fill,
+so N concurrent requests cost one `model.predict()` of N images rather than N model setups or N forward passes.
+
+Requests are only batched with the other requests of their own process, so the web server has to run threaded
+workers, e.g. `gunicorn --threads 8 labeler_site.wsgi` (gunicorn's gthread worker). With one request at a time per
+process (gunicorn's default sync workers, uWSGI without threads) every batch is a single image and MAX_WAIT is
+added to each request for nothing, so set it to 0 there. The images that labeler.preannotate submits together are
+batched either way.
+
+Settings:
+  LABELER_DETECTION_WEIGHTS: path to the Darknet weights (e.g. tiny-yolo-voc.weights), None disables detection
+  LABELER_DETECTION_WEIGHTS_CACHE: directory for the converted weights (labeler.darknet), default next to the weights
+  LABELER_DETECTION_MODEL_LOADER: dotted path of a function(weights_path) that returns a model with .predict()
+  LABELER_DETECTION_MAX_BATCH, LABELER_DETECTION_MAX_WAIT, LABELER_DETECTION_TIMEOUT (seconds)
+  LABELER_DETECTION_RETRY_AFTER: seconds to answer DetectionUnavailable right away after the model fails to load,
+    before loading it is tried again
+
+Requires numpy and Pillow, plus keras and tensorflow for the default model loader.
+"""
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+_logger = logging.getLogger(__name__)
+
+INPUT_SIZE = (416, 416)  # NORM_W, NORM_H of labeler.yolo
+
+
+class DetectionUnavailable(Exception):
+    """ Detection isn't configured (no weights) or its model couldn't be loaded """
+
+
+def next_batch(requests, max_batch_size, max_wait):
+    """ Block for a first item from a queue, then take more until the batch is full or max_wait seconds have passed """
+    batch = [requests.get()]
+    deadline = time.monotonic() + max_wait
+    while len(batch) < max_batch_size:
+        remaining = deadline - time.monotonic()
+        try:
+            batch.append(requests.get(timeout=remaining) if remaining > 0 else requests.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+
+class BatchingPredictor(object):
+    """ Run model.predict() on micro-batches of the inputs submitted by any number of threads
+
+    The model is loaded by (and only ever used in) the predictor's own thread, which is started on the first submit.
+    If it fails to load, submit() raises DetectionUnavailable for the next retry_after seconds, rather than every
+    batch trying (and slowly failing) to load it again.
+    """
+
+    def __init__(self, load_model, max_batch_size=8, max_wait=0.02, retry_after=60.):
+        self.load_model = load_model
+        self.max_batch_size = max(int(max_batch_size), 1)
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+        self.model = None
+        self.load_error, self.load_failed_at = None, None
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.batch_sizes = []  # of the last few batches, for monitoring and tests
+
+    def submit(self, array):
+        """ Future for the model's output for one input array
+
+        Raises DetectionUnavailable while the model can't be loaded (see check_available).
+        """
+        self.check_available()
+        future = Future()
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='labeler-detection', daemon=True)
+                self.thread.start()
+        self.queue.put((array, future))
+        return future
+
+    def predict(self, array, timeout=None):
+        return self.submit(array).result(timeout=timeout)
+
+    def run(self):
+        while True:
+            self.predict_batch(next_batch(self.queue, self.max_batch_size, self.max_wait))
+
+    def check_available(self):
+        """ Raise DetectionUnavailable if the model failed to load less than retry_after seconds ago """
+        failed_at = self.load_failed_at
+        if self.model is None and failed_at is not None and time.monotonic() - failed_at < self.retry_after:
+            raise DetectionUnavailable('{} (retrying in {:.0f} s)'.format(
+                self.load_error, self.retry_after - (time.monotonic() - failed_at)))
+
+    def load(self):
+        self.check_available()
+        start = time.time()
+        try:
+            model = self.load_model()
+        except Exception as e:
+            _logger.exception('Unable to load the detection model')
+            self.load_error = 'Unable to load the detection model: {}'.format(e)
+            self.load_failed_at = time.monotonic()
+            raise DetectionUnavailable(self.load_error)
+        self.load_error, self.load_failed_at = None, None
+        _logger.info('Loaded the detection model in %.1f s', time.time() - start)
+        return model
+
+    def predict_batch(self, batch):
+        import numpy as np
+
+        batch = [(array, future) for array, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            if self.model is None:
+                self.model = self.load()
+            outputs = self.model.predict(np.stack([array for array, _ in batch]))
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        self.batch_sizes = self.batch_sizes[-99:] + [len(batch)]
+        for (_, future), output in zip(batch, outputs):
+            future.set_result(output)
+
+
+def load_yolo_model(weights_path):
+    """ The YOLO v2 Keras model of labeler.yolo with the Darknet weights in weights_path """
+    from .yolo import build_model, load_weights
+    return load_weights(build_model(), weights_path,
+                        cache_dir=getattr(settings, 'LABELER_DETECTION_WEIGHTS_CACHE', None))
+
+
+_detector = None
+_detector_lock = threading.Lock()
+
+
+def get_detector():
+    """ The BatchingPredictor for this process, created on first use from the LABELER_DETECTION_* settings """
+    global _detector
+    with _detector_lock:
+        if _detector is None:
+            weights_path = getattr(settings, 'LABELER_DETECTION_WEIGHTS', None)
+            if not weights_path:
+                raise DetectionUnavailable('Detection is disabled (settings.LABELER_DETECTION_WEIGHTS is not set)')
+            loader = import_string(getattr(settings, 'LABELER_DETECTION_MODEL_LOADER',
+                                           'labeler.detection.load_yolo_model'))
+            _detector = BatchingPredictor(lambda: loader(weights_path),
+                                          max_batch_size=getattr(settings, 'LABELER_DETECTION_MAX_BATCH', 8),
+                                          max_wait=getattr(settings, 'LABELER_DETECTION_MAX_WAIT', 0.02),
+                                          retry_after=getattr(settings, 'LABELER_DETECTION_RETRY_AFTER', 60.))
+        return _detector
+
+
+def reset_detector():
+    """ Forget this process's detector (and its model), so the next request makes a new one from the settings """
+    global _detector
+    with _detector_lock:
+        _detector = None
+
+
+def preprocess(fin, size=INPUT_SIZE):
+    """ ((height, width, 3) float array of RGB values in [0, 1] at the model's input size, original (width, height)) """
+    import numpy as np
+    import PIL.Image
+
+    img = PIL.Image.open(fin)
+    original_size = img.size
+    img.draft('RGB', size)
+    img = img.convert('RGB').resize(size, PIL.Image.BILINEAR)
+    return np.asarray(img, dtype=np.float32) / 255., original_size
+
+
+def detections_json(detections, width, height, labels=None):
+    """ A list of {label, score, x, y, w, h (fractions of the image size), xmin, ymin, xmax, ymax (pixels)} """
+    from .yolo_decode import LABELS, to_pixels
+
+    labels = labels or LABELS
+    pixels = to_pixels(detections.xywh, width, height)
+    return [dict(label=labels[label], score=round(float(score), 4),
+                 x=float(x), y=float(y), w=float(w), h=float(h),
+                 xmin=int(xmin), ymin=int(ymin), xmax=int(xmax), ymax=int(ymax))
+            for (x, y, w, h), (xmin, ymin, xmax, ymax), label, score
+            in zip(detections.xywh, pixels, detections.labels, detections.scores)]
+
+
+def detect_image(image, timeout=None):
+    """ Boxes detected in an Image's file, best first, as detections_json()
+
+    Raises:
+      DetectionUnavailable: when detection isn't configured
+      concurrent.futures.TimeoutError: when the detector is too busy to answer within timeout seconds
+      IOError/OSError: if the file can't be read or decoded
+    """
+    from .yolo_decode import decode_netout
+
+    detector = get_detector()
+    with image.file.storage.open(image.file.name, 'rb') as fin:
+        array, (width, height) = preprocess(fin)
+    if timeout is None:
+        timeout = getattr(settings, 'LABELER_DETECTION_TIMEOUT', 30)
+    detections = decode_netout(detector.predict(array, timeout=timeout))
+    return sorted(detections_json(detections, width, height), key=lambda box: -box['score'])
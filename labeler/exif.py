@@ -0,0 +1,282 @@
+""" Read EXIF (TIFF) metadata from JPEG files or the raw bytes of their APP1 segment, without PIL
+
+`read_exif(path)` seeks from segment to segment through the JPEG header and reads only the APP1 (EXIF)
+segment, which is typically a few KB at the start of a multi-MB file. PIL is only needed for other formats.
+
+The result is the same name-keyed dict that `labeler_site.image_info.get_exif` builds with PIL:
+IFD0 and Exif sub-IFD tags merged into one dict, with the GPS sub-IFD as a name-keyed dict under 'GPSInfo'.
+Rationals are (numerator, denominator) tuples, ASCII strings are str and UNDEFINED values are bytes.
+
+References:
+  [EXIF 2.3 spec](http://www.cipa.jp/std/documents/e/DC-008-2012_E.pdf)
+  [TIFF 6.0 spec](https://www.itu.int/itudoc/itu-t/com16/tiff-fx/docs/tiff6.pdf)
+"""
+import base64
+import datetime
+import struct
+
+from django.utils import timezone
+
+EXIF_HEADER = b'Exif\x00\x00'
+
+# JPEG markers: start/end of image, start of scan, APP1 (EXIF), standalone markers without a length,
+# and the start of frame markers that hold the image dimensions
+SOI, EOI, SOS, APP1 = 0xD8, 0xD9, 0xDA, 0xE1
+STANDALONE_MARKERS = set([0x01, SOI] + list(range(0xD0, 0xD8)))
+SOF_MARKERS = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+EXIF_IFD_TAG, GPS_IFD_TAG, INTEROP_IFD_TAG = 0x8769, 0x8825, 0xA005
+
+# TIFF field type: (struct format character, size in bytes)
+FIELD_TYPES = {
+    1: ('B', 1), 2: ('s', 1), 3: ('H', 2), 4: ('L', 4), 5: ('LL', 8), 6: ('b', 1), 7: ('s', 1),
+    8: ('h', 2), 9: ('l', 4), 10: ('ll', 8), 11: ('f', 4), 12: ('d', 8),
+}
+ASCII, UNDEFINED = 2, 7
+
+# Fallback tag names for when PIL (which has the complete tables) isn't installed
+TAGS = {
+    0x010E: 'ImageDescription', 0x010F: 'Make', 0x0110: 'Model', 0x0112: 'Orientation', 0x011A: 'XResolution',
+    0x011B: 'YResolution', 0x0128: 'ResolutionUnit', 0x0131: 'Software', 0x0132: 'DateTime', 0x013B: 'Artist',
+    0x0213: 'YCbCrPositioning', 0x8298: 'Copyright', 0x829A: 'ExposureTime', 0x829D: 'FNumber',
+    0x8769: 'ExifOffset', 0x8822: 'ExposureProgram', 0x8825: 'GPSInfo', 0x8827: 'ISOSpeedRatings',
+    0x9000: 'ExifVersion', 0x9003: 'DateTimeOriginal', 0x9004: 'DateTimeDigitized', 0x9101: 'ComponentsConfiguration',
+    0x9201: 'ShutterSpeedValue', 0x9202: 'ApertureValue', 0x9204: 'ExposureBiasValue', 0x9205: 'MaxApertureValue',
+    0x9207: 'MeteringMode', 0x9208: 'LightSource', 0x9209: 'Flash', 0x920A: 'FocalLength', 0x927C: 'MakerNote',
+    0x9286: 'UserComment', 0x9290: 'SubsecTime', 0x9291: 'SubsecTimeOriginal', 0x9292: 'SubsecTimeDigitized',
+    0xA000: 'FlashPixVersion', 0xA001: 'ColorSpace', 0xA002: 'ExifImageWidth', 0xA003: 'ExifImageHeight',
+    0xA005: 'ExifInteroperabilityOffset', 0xA217: 'SensingMethod', 0xA300: 'FileSource', 0xA301: 'SceneType',
+    0xA401: 'CustomRendered', 0xA402: 'ExposureMode', 0xA403: 'WhiteBalance', 0xA404: 'DigitalZoomRatio',
+    0xA405: 'FocalLengthIn35mmFilm', 0xA406: 'SceneCaptureType', 0xA407: 'GainControl', 0xA408: 'Contrast',
+    0xA409: 'Saturation', 0xA40A: 'Sharpness', 0xA40C: 'SubjectDistanceRange', 0xA420: 'ImageUniqueID',
+    0xA431: 'BodySerialNumber', 0xA434: 'LensModel',
+}
+GPSTAGS = {
+    0: 'GPSVersionID', 1: 'GPSLatitudeRef', 2: 'GPSLatitude', 3: 'GPSLongitudeRef', 4: 'GPSLongitude',
+    5: 'GPSAltitudeRef', 6: 'GPSAltitude', 7: 'GPSTimeStamp', 8: 'GPSSatellites', 9: 'GPSStatus',
+    10: 'GPSMeasureMode', 11: 'GPSDOP', 12: 'GPSSpeedRef', 13: 'GPSSpeed', 14: 'GPSTrackRef', 15: 'GPSTrack',
+    16: 'GPSImgDirectionRef', 17: 'GPSImgDirection', 18: 'GPSMapDatum', 27: 'GPSProcessingMethod',
+    29: 'GPSDateStamp',
+}
+try:
+    from PIL.ExifTags import TAGS as _PIL_TAGS, GPSTAGS as _PIL_GPSTAGS
+    TAGS.update(_PIL_TAGS)
+    GPSTAGS.update(_PIL_GPSTAGS)
+except ImportError:
+    pass
+
+
+def read_ifd(tiff, offset, endian):
+    """ {tag number: value} for the IFD (image file directory) at `offset` in the TIFF bytes """
+    entries = {}
+    if offset + 2 > len(tiff):
+        return entries
+    count = struct.unpack_from(endian + 'H', tiff, offset)[0]
+    for i in range(count):
+        entry = offset + 2 + 12 * i
+        if entry + 12 > len(tiff):
+            break
+        tag, field_type, n = struct.unpack_from(endian + 'HHL', tiff, entry)
+        if field_type not in FIELD_TYPES:
+            continue
+        fmt, size = FIELD_TYPES[field_type]
+        nbytes = size * n
+        data_offset = entry + 8 if nbytes <= 4 else struct.unpack_from(endian + 'L', tiff, entry + 8)[0]
+        if data_offset + nbytes > len(tiff):
+            continue
+        raw = tiff[data_offset:data_offset + nbytes]
+        if field_type == ASCII:
+            value = raw.split(b'\x00', 1)[0].decode('latin-1').strip()
+        elif field_type == UNDEFINED:
+            value = bytes(raw)
+        else:
+            values = struct.unpack(endian + fmt * n, raw)
+            if len(fmt) == 2:
+                values = tuple(zip(values[::2], values[1::2]))
+            value = values[0] if n == 1 else values
+        entries[tag] = value
+    return entries
+
+
+def decode_tiff(tiff):
+    """ Name-keyed dict of the IFD0, Exif and GPS tags in a TIFF-structured EXIF payload (without the Exif header) """
+    if len(tiff) < 8 or tiff[:2] not in (b'II', b'MM'):
+        return {}
+    endian = '<' if tiff[:2] == b'II' else '>'
+    if struct.unpack_from(endian + 'H', tiff, 2)[0] != 42:
+        return {}
+    tags = read_ifd(tiff, struct.unpack_from(endian + 'L', tiff, 4)[0], endian)
+    if isinstance(tags.get(EXIF_IFD_TAG), int):
+        tags.update(read_ifd(tiff, tags[EXIF_IFD_TAG], endian))
+    exif = {TAGS.get(tag, tag): value for tag, value in tags.items()}
+    if isinstance(tags.get(GPS_IFD_TAG), int):
+        gps = read_ifd(tiff, tags[GPS_IFD_TAG], endian)
+        exif['GPSInfo'] = {GPSTAGS.get(tag, tag): value for tag, value in gps.items()}
+    return exif
+
+
+def decode_app1(payload):
+    """ EXIF dict from the payload of a JPEG APP1 segment, or None if it isn't an EXIF segment """
+    if not payload.startswith(EXIF_HEADER):
+        return None
+    return decode_tiff(memoryview(payload)[len(EXIF_HEADER):].tobytes())
+
+
+def read_jpeg_exif(fin):
+    """ EXIF dict from a JPEG file object, {} if it has no EXIF segment, or None if it isn't a JPEG
+
+    Only the 4-byte segment headers and the APP1 segment are read, everything else is skipped with seek().
+    """
+    if fin.read(2) != b'\xff\xd8':
+        return None
+    while True:
+        header = fin.read(4)
+        if len(header) < 4 or header[0] != 0xFF:
+            return {}
+        marker = header[1]
+        if marker == 0xFF or marker in STANDALONE_MARKERS:
+            fin.seek(-3 if marker == 0xFF else -2, 1)  # fill byte, or a marker without a length
+            continue
+        if marker in (SOS, EOI) or marker in SOF_MARKERS:
+            return {}  # EXIF always comes before the frame header and image data
+        length = struct.unpack('>H', header[2:])[0]
+        if marker == APP1:
+            exif = decode_app1(fin.read(length - 2))
+            if exif is not None:
+                return exif
+        else:
+            fin.seek(length - 2, 1)
+
+
+def pil_exif(path):
+    """ EXIF dict for any image format PIL can open (the slow path, used for anything other than JPEG) """
+    try:
+        import PIL.Image
+    except ImportError:
+        return {}
+    try:
+        img = PIL.Image.open(path)
+        exif = img._getexif() if hasattr(img, '_getexif') else None
+    except (IOError, OSError, SyntaxError, ValueError):
+        return {}
+    exif = {TAGS.get(k, k): v for k, v in (exif or {}).items()}
+    if isinstance(exif.get('GPSInfo'), dict):
+        exif['GPSInfo'] = {GPSTAGS.get(k, k): v for k, v in exif['GPSInfo'].items()}
+    return exif
+
+
+def read_exif(path):
+    """ Name-keyed EXIF dict for the image file at path ({} if it has none)
+
+    >>> import os
+    >>> exif = read_exif(os.path.join(os.path.dirname(__file__), 'data', 'SUNP0254.jpg'))
+    >>> exif['Model'], exif['DateTimeOriginal'], exif['ExposureTime']
+    ('WF121', '2014:04:27 17:40:29', (1, 60))
+    """
+    with open(path, 'rb') as fin:
+        exif = read_jpeg_exif(fin)
+    return pil_exif(path) if exif is None else exif
+
+
+def parse_exif_datetime(value):
+    """ Timezone-aware datetime from an EXIF 'YYYY:MM:DD HH:MM:SS' string (in the current timezone), or None
+
+    >>> parse_exif_datetime('0000:00:00 00:00:00') is None
+    True
+    """
+    try:
+        dt = datetime.datetime.strptime(str(value).strip()[:19], '%Y:%m:%d %H:%M:%S')
+    except ValueError:
+        return None
+    return timezone.make_aware(dt) if timezone.is_naive(dt) else dt
+
+
+def taken_date(exif):
+    """ When the photo was taken, according to its EXIF tags (None if unknown) """
+    for name in ('DateTimeOriginal', 'DateTimeDigitized', 'DateTime'):
+        if exif and exif.get(name):
+            dt = parse_exif_datetime(exif[name])
+            if dt is not None:
+                return dt
+    return None
+
+
+def to_float(value):
+    """ A rational as a float, whether it's a (num, den) tuple, a [num, den] list (from JSON) or a PIL IFDRational
+
+    >>> to_float((45, 2)), to_float([1, 0]), to_float(2.5)
+    (22.5, None, 2.5)
+    """
+    if isinstance(value, (tuple, list)):
+        if len(value) != 2 or not value[1]:
+            return None
+        return float(value[0]) / value[1]
+    try:
+        return float(value)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+
+
+def gps_degrees(dms, ref):
+    """ Decimal degrees from EXIF (degrees, minutes, seconds) rationals and an N/S/E/W reference
+
+    >>> gps_degrees([[37, 1], [45, 1], [36, 1]], 'S')
+    -37.76
+    """
+    if not isinstance(dms, (tuple, list)) or not dms:
+        return None
+    parts = [to_float(v) for v in dms[:3]]
+    if any(p is None for p in parts):
+        return None
+    degrees = sum(p / 60 ** i for i, p in enumerate(parts))
+    return -degrees if str(ref).strip().upper()[:1] in ('S', 'W') else degrees
+
+
+def exif_fields(exif):
+    """ The EXIF values that are stored in their own (indexed) Image columns, from an EXIF (or Image.info) dict
+
+    The camera make and model are lowercased, so they can be filtered on with an exact match that uses the index.
+
+    >>> gps = {'GPSLatitude': [[45, 1], [30, 1], [0, 1]], 'GPSLatitudeRef': 'N',
+    ...        'GPSLongitude': [[122, 1], [0, 1], [0, 1]], 'GPSLongitudeRef': 'W'}
+    >>> exif_fields({'Make': 'Bushnell ', 'GPSInfo': gps})
+    {'latitude': 45.5, 'longitude': -122.0, 'camera_make': 'bushnell', 'camera_model': '', 'taken_date': None}
+    """
+    exif = exif or {}
+    gps = exif.get('GPSInfo') if isinstance(exif.get('GPSInfo'), dict) else {}
+    latitude = gps_degrees(gps.get('GPSLatitude'), gps.get('GPSLatitudeRef', 'N'))
+    longitude = gps_degrees(gps.get('GPSLongitude'), gps.get('GPSLongitudeRef', 'E'))
+    if latitude is None or longitude is None or not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        latitude = longitude = None
+    return {
+        'latitude': latitude,
+        'longitude': longitude,
+        'camera_make': str(exif.get('Make') or '').strip('\x00 ').lower()[:64],
+        'camera_model': str(exif.get('Model') or '').strip('\x00 ').lower()[:64],
+        'taken_date': taken_date(exif),
+    }
+
+
+def jsonify(value, max_bytes=1024):
+    """ A JSON-serializable copy of an EXIF dict, so it can be stored in Image.info
+
+    Short binary values are stored as ASCII when they're printable and base64 otherwise,
+    and long ones (MakerNote blobs) are left out.
+
+    >>> jsonify({'ExifVersion': b'0230', 'FNumber': (28, 10), 'MakerNote': b'\\x00' * 2000, 42: b'\\xff'})
+    {'ExifVersion': '0230', 'FNumber': [28, 10], '42': 'base64:/w=='}
+    """
+    if isinstance(value, dict):
+        items = ((str(k), jsonify(v, max_bytes=max_bytes)) for k, v in value.items())
+        return {k: v for k, v in items if v is not None}
+    if isinstance(value, (tuple, list)):
+        return [jsonify(v, max_bytes=max_bytes) for v in value]
+    if isinstance(value, (bytes, bytearray)):
+        if len(value) > max_bytes:
+            return None
+        stripped = bytes(value).rstrip(b'\x00')
+        if all(32 <= c < 127 for c in stripped):
+            return stripped.decode('ascii')
+        return 'base64:' + base64.b64encode(bytes(value)).decode('ascii')
+    if isinstance(value, str):
+        return value.replace('\x00', '')
+    return value
@@ -0,0 +1,82 @@
+""" Query-string filters for the image list APIs, on the EXIF columns that Image denormalizes from `info`
+
+  ?bbox=min_lon,min_lat,max_lon,max_lat   images taken inside a box (decimal degrees, WGS84, like GeoJSON's bbox),
+                                          which may cross the antimeridian (min_lon > max_lon)
+  ?camera_make=Bushnell                   case-insensitive exact match, and likewise ?camera_model=
+                                          (the columns are stored lowercased, see labeler.exif.exif_fields)
+  ?taken_after=2017-08-01                 taken on or after a date (or ISO 8601 datetime), and ?taken_before=
+
+Each one is a range or equality condition on an indexed column (see Image.Meta.indexes), so they compose with
+the keyset pagination and the conditional-GET aggregate without loading a single `info` dict.
+?camera_model= without ?camera_make= uses image_camera_model_idx, since it isn't the leading column of
+image_camera_idx.
+"""
+import datetime
+
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import BaseFilterBackend
+
+
+def parse_bbox(value):
+    """ (min_lon, min_lat, max_lon, max_lat) from a `bbox` query parameter
+
+    >>> parse_bbox('-123.5, 45, -122,46.25')
+    (-123.5, 45.0, -122.0, 46.25)
+    >>> parse_bbox('170,-10,-170,10')
+    (170.0, -10.0, -170.0, 10.0)
+    """
+    try:
+        bbox = tuple(float(v) for v in value.split(','))
+    except ValueError:
+        raise ValidationError({'bbox': 'Expected four numbers: min_lon,min_lat,max_lon,max_lat.'})
+    if len(bbox) != 4:
+        raise ValidationError({'bbox': 'Expected four numbers: min_lon,min_lat,max_lon,max_lat.'})
+    min_lon, min_lat, max_lon, max_lat = bbox
+    if not (-180 <= min_lon <= 180 and -180 <= max_lon <= 180 and -90 <= min_lat <= max_lat <= 90):
+        raise ValidationError({'bbox': 'Expected -180 <= longitude <= 180 and -90 <= min_lat <= max_lat <= 90.'})
+    return bbox
+
+
+def bbox_q(min_lon, min_lat, max_lon, max_lat):
+    """ Condition for latitude/longitude inside the box, split in two at the antimeridian if need be """
+    q = Q(latitude__gte=min_lat, latitude__lte=max_lat)
+    if min_lon <= max_lon:
+        return q & Q(longitude__gte=min_lon, longitude__lte=max_lon)
+    return q & (Q(longitude__gte=min_lon) | Q(longitude__lte=max_lon))
+
+
+def parse_taken(name, value, end_of_day=False):
+    """ Aware datetime from a date or datetime query parameter (a bare date covers the whole day) """
+    dt = parse_datetime(value)
+    if dt is None:
+        try:
+            date = parse_date(value)
+        except ValueError:
+            date = None
+        if date is None:
+            raise ValidationError({name: 'Expected an ISO 8601 date or datetime.'})
+        dt = datetime.datetime.combine(date, datetime.time.max if end_of_day else datetime.time.min)
+    if timezone.is_naive(dt):
+        dt = timezone.make_aware(dt)
+    return dt
+
+
+class ImageFilterBackend(BaseFilterBackend):
+    """ Filter Images by ?bbox=, ?camera_make=, ?camera_model=, ?taken_after= and ?taken_before= """
+
+    def filter_queryset(self, request, queryset, view=None):
+        params = request.query_params
+        if params.get('bbox'):
+            queryset = queryset.filter(bbox_q(*parse_bbox(params['bbox'])))
+        for field in ('camera_make', 'camera_model'):
+            if params.get(field):
+                queryset = queryset.filter(**{field: params[field].strip().lower()})
+        if params.get('taken_after'):
+            queryset = queryset.filter(taken_date__gte=parse_taken('taken_after', params['taken_after']))
+        if params.get('taken_before'):
+            queryset = queryset.filter(taken_date__lte=parse_taken('taken_before', params['taken_before'],
+                                                                   end_of_day=True))
+        return queryset
@@ -1,8 +1,18 @@
 from django import forms
-from .models import Image
+from .models import Image, ImageLabel
+from .registry import label_registry
 
 
 class FileUploadForm(forms.ModelForm):
     class Meta:
         model = Image
         fields = ('caption', 'file',)
+
+
+class ImageLabelForm(forms.ModelForm):
+    """ A ballot (vote) for a label, with the label choices read from the label registry instead of the db """
+    label = forms.TypedChoiceField(choices=label_registry.choices, coerce=label_registry.get)
+
+    class Meta:
+        model = ImageLabel
+        fields = ('image', 'label', 'user')
@@ -0,0 +1,195 @@
+""" Fill in Image.info and the EXIF columns (taken_date, latitude, ...) of images that were uploaded without them
+
+The images are streamed from the db with .iterator(), their headers are read (not the whole file) by a pool of
+worker processes, and the results are written back with one batched UPDATE ... CASE per batch of images.
+Images that have no EXIF get info={} so they're never read again. Images whose file can't be read keep info=NULL,
+so they're retried by a fresh run, but skipped with --resume (which starts after the last pk in the checkpoint file).
+With --from-info the columns of images that already have info are recomputed from it, without reading any files.
+Each mode has its own checkpoint file, and a checkpoint records its mode, so --resume never starts from the other's.
+
+Usage:
+  python manage.py backfill_exif --workers 8
+  python manage.py backfill_exif --resume       # carry on from where an interrupted run left off
+  python manage.py backfill_exif --from-info    # fill in latitude, longitude, camera_make/model from stored info
+"""
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Case, F, Value, When
+from django.utils import timezone
+
+from labeler.exif import exif_fields, jsonify, read_exif
+from labeler.models import Image
+
+MAX_QUERY_PARAMS = 2000  # per UPDATE, for databases with no limit of their own
+EXIF_COLUMNS = ('latitude', 'longitude', 'camera_make', 'camera_model')
+CHECKPOINTS = {'exif': '.backfill_exif.checkpoint', 'from-info': '.backfill_exif-from-info.checkpoint'}
+
+
+def extract_exif(path):
+    """ (info, error) for the image at path, reading only the EXIF segment of JPEGs
+
+    Runs in the worker processes, so it must not touch the db.
+    """
+    try:
+        exif = read_exif(path)
+    except (IOError, OSError) as e:
+        return None, str(e)
+    return jsonify(exif), None
+
+
+def max_query_params():
+    """ The database's limit on the number of parameters in one query """
+    limit = getattr(connection.features, 'max_query_params', None)  # Django >= 2.0
+    if limit is None and connection.vendor == 'sqlite':
+        limit = 999  # SQLITE_MAX_VARIABLE_NUMBER before SQLite 3.32, as in Django's own bulk_batch_size()
+    return limit or MAX_QUERY_PARAMS
+
+
+def rows_per_update(num_case_columns, max_params=None):
+    """ Number of rows one UPDATE can set, binding 2 parameters (pk and value) per row for each CASE column, plus
+    the row's pk in the WHERE clause, within the database's limit on query parameters (999 for older SQLite)
+
+    >>> rows_per_update(6, max_params=999)
+    76
+    """
+    max_params = max_params or max_query_params()
+    return max(1, (max_params - 1) // (2 * num_case_columns + 1))
+
+
+def iter_batches(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Command(BaseCommand):
+    help = 'Extract the EXIF header of every Image without info, in parallel, and store it in info and its columns.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Number of worker processes reading image headers (0 to read them in this process).')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of images per worker map() and per UPDATE.')
+        parser.add_argument('--resume', action='store_true', default=False,
+                            help='Skip the images up to the last primary key recorded in the checkpoint file.')
+        parser.add_argument('--checkpoint', default=None,
+                            help='File where the last primary key processed is recorded after each batch '
+                                 '(default: .backfill_exif.checkpoint, or .backfill_exif-from-info.checkpoint).')
+        parser.add_argument('--from-info', action='store_true', default=False,
+                            help='Recompute the EXIF columns of the images that already have info, from their info.')
+
+    def handle(self, *args, **options):
+        self.mode = 'from-info' if options['from_info'] else 'exif'
+        self.checkpoint = options['checkpoint'] or os.path.join(settings.BASE_DIR, CHECKPOINTS[self.mode])
+        last_pk = self.read_checkpoint() if options['resume'] else 0
+        images = Image.objects.filter(info__isnull=not options['from_info'], pk__gt=last_pk).order_by('pk')
+        self.total, self.done, self.errors, self.start = images.count(), 0, 0, time.time()
+        self.stdout.write('Backfilling EXIF for {} images after pk {}'.format(self.total, last_pk))
+        columns = ('pk', 'file', 'taken_date', 'info') if options['from_info'] else ('pk', 'file', 'taken_date')
+        batches = iter_batches(images.values_list(*columns).iterator(), max(options['batch_size'], 1))
+
+        if options['from_info']:
+            for batch in batches:
+                # values_list() skips jsonfield's decoding, so info arrives as the JSON text
+                infos = [(json.loads(info) if isinstance(info, str) else info, None) for _, _, _, info in batch]
+                self.write_batch([row[:3] for row in batch], infos, info=False)
+        elif options['workers'] <= 0:
+            for batch in batches:
+                self.write_batch(batch, map(extract_exif, self.paths(batch)))
+        else:
+            with ProcessPoolExecutor(max_workers=options['workers']) as pool:
+                # keep the workers busy on the next batch while this one is written to the db
+                in_flight = deque()
+                chunksize = max(1, options['batch_size'] // (4 * options['workers']))
+                for batch in batches:
+                    in_flight.append((batch, pool.map(extract_exif, self.paths(batch), chunksize=chunksize)))
+                    if len(in_flight) > 1:
+                        self.write_batch(*in_flight.popleft())
+                while in_flight:
+                    self.write_batch(*in_flight.popleft())
+
+        self.stdout.write(self.style.SUCCESS('Backfilled EXIF for {} images ({} unreadable) in {:.1f} s.'.format(
+            self.done - self.errors, self.errors, time.time() - self.start)))
+
+    @staticmethod
+    def paths(batch):
+        return [default_storage.path(name) for _, name, _ in batch]
+
+    def write_batch(self, batch, results, info=True):
+        """ Store one batch of extract_exif() results with a single UPDATE, then checkpoint and report progress """
+        infos, dates, columns = {}, {}, {}
+        for (pk, name, old_taken_date), (exif, error) in zip(batch, results):
+            if error:
+                self.errors += 1
+                self.stderr.write('Unable to read image {} ({}): {}'.format(pk, name, error))
+                continue
+            infos[pk] = exif
+            columns[pk] = exif_fields(exif)
+            new_taken_date = columns[pk]['taken_date']
+            if old_taken_date is None and new_taken_date is not None:
+                dates[pk] = new_taken_date
+        if infos:
+            pks, now = list(infos), timezone.now()
+            chunk_size = rows_per_update(len(EXIF_COLUMNS) + bool(info) + bool(dates))
+            with transaction.atomic():
+                for i in range(0, len(pks), chunk_size):
+                    chunk = pks[i:i + chunk_size]
+                    updates = {name: self.case(name, {pk: columns[pk][name] for pk in chunk}) for name in EXIF_COLUMNS}
+                    updates['updated_date'] = now
+                    if info:
+                        updates['info'] = self.case('info', {pk: infos[pk] for pk in chunk})
+                    chunk_dates = [(pk, dates[pk]) for pk in chunk if pk in dates]
+                    if chunk_dates:
+                        updates['taken_date'] = Case(*[When(pk=pk, then=Value(dt)) for pk, dt in chunk_dates],
+                                                     default=F('taken_date'),
+                                                     output_field=Image._meta.get_field('taken_date'))
+                    Image.objects.filter(pk__in=chunk).update(**updates)
+        self.write_checkpoint(batch[-1][0])
+
+        self.done += len(batch)
+        elapsed = max(time.time() - self.start, 1e-6)
+        rate = self.done / elapsed
+        self.stdout.write('{}/{} images ({:.0f}/s, {} unreadable, about {:.0f} s to go)'.format(
+            self.done, self.total, rate, self.errors, (self.total - self.done) / rate if rate else 0))
+
+    @staticmethod
+    def case(name, values):
+        """ CASE expression that sets a column to a different value for each {pk: value} """
+        field = Image._meta.get_field(name)
+        return Case(*[When(pk=pk, then=Value(value, output_field=field)) for pk, value in values.items()],
+                    output_field=field)
+
+    def read_checkpoint(self):
+        """ The last primary key in the checkpoint file ("<pk> <mode>"), refusing one written by the other mode """
+        try:
+            with open(self.checkpoint) as fin:
+                fields = fin.read().split()
+        except IOError:
+            return 0
+        try:
+            pk = int(fields[0]) if fields else 0
+        except ValueError:
+            raise CommandError('Invalid checkpoint file {}'.format(self.checkpoint))
+        if len(fields) > 1 and fields[1] != self.mode:
+            raise CommandError('Checkpoint file {} was written by a {} backfill, not {}'.format(
+                self.checkpoint, fields[1], self.mode))
+        return pk
+
+    def write_checkpoint(self, pk):
+        temp_path = self.checkpoint + '.tmp'
+        with open(temp_path, 'w') as fout:
+            fout.write('{} {}'.format(pk, self.mode))
+        os.replace(temp_path, self.checkpoint)
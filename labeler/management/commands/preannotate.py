@@ -0,0 +1,76 @@
+""" Suggest labels for Images with a model (machine pre-annotation, see labeler.preannotate), a batch at a time
+
+Images that already have machine labels are skipped. The last primary key processed is recorded in a checkpoint
+file after each batch, so --resume (and --follow) don't re-run the model on images it found nothing in.
+
+Usage:
+  python manage.py preannotate                   # every image without machine labels
+  python manage.py preannotate --follow          # then keep pre-annotating new uploads as they arrive
+  python manage.py preannotate --predictor labeler.preannotate.cats_vs_dogs_predictions
+"""
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+from labeler.models import Image, ImageLabel
+from labeler.preannotate import BATCH_SIZE, MIN_CONFIDENCE, preannotate
+
+
+class Command(BaseCommand):
+    help = 'Run a model on the Images without machine labels and store its predictions as machine labels.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                            help='Number of images per model batch (and per INSERT).')
+        parser.add_argument('--predictor', default=None,
+                            help='Dotted path of the prediction function (default: LABELER_PREANNOTATE_PREDICTOR).')
+        parser.add_argument('--min-confidence', type=float, default=MIN_CONFIDENCE,
+                            help='Only store predictions at least this confident.')
+        parser.add_argument('--resume', action='store_true', default=False,
+                            help='Skip the images up to the last primary key recorded in the checkpoint file.')
+        parser.add_argument('--checkpoint', default=os.path.join(settings.BASE_DIR, '.preannotate.checkpoint'),
+                            help='File where the last primary key processed is recorded after each batch.')
+        parser.add_argument('--follow', action='store_true', default=False,
+                            help='Keep polling for (and pre-annotating) new images after the first pass.')
+        parser.add_argument('--interval', type=float, default=10.,
+                            help='Seconds between polls for new images with --follow.')
+
+    def handle(self, *args, **options):
+        self.checkpoint = options['checkpoint']
+        predict = import_string(options['predictor']) if options['predictor'] else None
+        last_pk = self.read_checkpoint() if options['resume'] else 0
+        batch_size, total = max(options['batch_size'], 1), 0
+        annotated = ImageLabel.objects.filter(is_machine=True).values('image_id')
+        while True:
+            images = list(Image.objects.filter(pk__gt=last_pk).exclude(pk__in=annotated)
+                          .only('file').order_by('pk')[:batch_size])
+            if images:
+                created = preannotate(images, predict=predict, min_confidence=options['min_confidence'])
+                last_pk = images[-1].pk
+                self.write_checkpoint(last_pk)
+                total += len(images)
+                self.stdout.write('{} images pre-annotated ({} labels suggested in this batch)'.format(
+                    total, created))
+            elif options['follow']:
+                time.sleep(options['interval'])
+            else:
+                break
+        self.stdout.write(self.style.SUCCESS('Pre-annotated {} images.'.format(total)))
+
+    def read_checkpoint(self):
+        try:
+            with open(self.checkpoint) as fin:
+                return int(fin.read().strip() or 0)
+        except IOError:
+            return 0
+        except ValueError:
+            raise CommandError('Invalid checkpoint file {}'.format(self.checkpoint))
+
+    def write_checkpoint(self, pk):
+        temp_path = self.checkpoint + '.tmp'
+        with open(temp_path, 'w') as fout:
+            fout.write(str(pk))
+        os.replace(temp_path, self.checkpoint)
@@ -0,0 +1,71 @@
+""" Recompute the denormalized TotalVotes tallies (and ImagePriority) from the individual ImageLabel ballots
+
+Usage:
+  python manage.py rebuild_totalvotes            # replace any stale tallies
+  python manage.py rebuild_totalvotes --verify   # only report images whose tallies are stale
+"""
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count
+
+from labeler.consensus import invalidate_consensus
+from labeler.models import Image, ImageLabel, ImagePriority, TotalVotes
+
+
+class Command(BaseCommand):
+    help = 'Rebuild (or --verify) the TotalVotes aggregates for every Image, one batch of images at a time.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify', action='store_true', default=False,
+                            help="Don't change anything, just report the images with stale tallies.")
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of images to recompute per query/transaction.')
+
+    def handle(self, *args, **options):
+        batch_size, verify = options['batch_size'], options['verify']
+        num_images, stale = 0, []
+        last_pk = 0
+        while True:
+            image_ids = list(Image.objects.filter(pk__gt=last_pk).order_by('pk').values_list(
+                'pk', flat=True)[:batch_size])
+            if not image_ids:
+                break
+            last_pk = image_ids[-1]
+            num_images += len(image_ids)
+            with transaction.atomic():
+                expected = self.count_ballots(image_ids)
+                actual = Counter({(tv['image_id'], tv['name']): tv['votes'] for tv in
+                                  TotalVotes.objects.filter(image_id__in=image_ids).values('image_id', 'name', 'votes')
+                                  if tv['votes']})
+                stale_ids = sorted(set(key[0] for key in (set(expected) | set(actual))
+                                       if expected[key] != actual[key]))
+                stale += stale_ids
+                if stale_ids and not verify:
+                    TotalVotes.objects.filter(image_id__in=stale_ids).delete()
+                    TotalVotes.objects.bulk_create([
+                        TotalVotes(image_id=image_id, name=name, votes=votes)
+                        for (image_id, name), votes in sorted(expected.items()) if image_id in stale_ids])
+                    invalidate_consensus(stale_ids)
+                if not verify:
+                    queued = set(ImagePriority.objects.filter(image_id__in=image_ids).values_list(
+                        'image_id', flat=True))
+                    ImagePriority.objects.refresh(set(stale_ids) | (set(image_ids) - queued))
+            self.stdout.write('{} images checked, {} with stale tallies'.format(num_images, len(stale)))
+
+        if verify and stale:
+            raise CommandError('TotalVotes are stale for {} images: {}'.format(
+                len(stale), ', '.join(str(pk) for pk in stale[:20]) + (' ...' if len(stale) > 20 else '')))
+        if verify:
+            self.stdout.write(self.style.SUCCESS('TotalVotes are up to date for all {} images.'.format(num_images)))
+        else:
+            self.stdout.write(self.style.SUCCESS('Rebuilt TotalVotes for {} of {} images.'.format(
+                len(stale), num_images)))
+
+    @staticmethod
+    def count_ballots(image_ids):
+        """ GROUP BY image and label title for just this batch of images """
+        ballots = (ImageLabel.objects.filter(image_id__in=image_ids, label__isnull=False, is_machine=False)
+                   .values('image_id', 'label__title').annotate(votes=Count('id')).order_by())
+        return Counter({(b['image_id'], b['label__title']): b['votes'] for b in ballots})
@@ -0,0 +1,74 @@
+""" Delete the content-addressed files (blobs) that no Image references any more
+
+Deleting an Image releases its blob right away, unless an upload reused the blob in the last LABELER_BLOB_GRACE
+seconds (its Image may not have been committed yet). Those blobs, and the ones left behind by uploads whose Image
+couldn't be saved, are deleted by this sweep, e.g. from a daily cron job.
+
+Usage:
+  python manage.py sweep_blobs
+  python manage.py sweep_blobs --dry-run    # only list the unreferenced blobs
+"""
+import os
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+
+from labeler.derivatives import derivatives_storage
+from labeler.models import Image
+from labeler.storage import content_hash_from_name
+
+
+def iter_blobs(storage, batch_size, skip_dirs=()):
+    """ Yield batches of (name, content hash) of the content-addressed files in storage, outside of skip_dirs """
+    root = storage.path('')
+    skip = set(os.path.realpath(path) for path in skip_dirs)
+    skip.update(os.path.realpath(storage.path(name)) for name in (storage.temp_dirname, storage.trash_dirname))
+    batch = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if os.path.realpath(os.path.join(dirpath, d)) not in skip]
+        for filename in filenames:
+            name = os.path.relpath(os.path.join(dirpath, filename), root).replace(os.sep, '/')
+            content_hash = content_hash_from_name(name)
+            if content_hash:
+                batch.append((name, content_hash))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+class Command(BaseCommand):
+    help = 'Delete the content-addressed files that no Image references.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help="Don't delete anything, just list the unreferenced files.")
+        parser.add_argument('--grace', type=float, default=None,
+                            help='Keep files reused by an upload in the last GRACE seconds '
+                                 '(default: settings.LABELER_BLOB_GRACE).')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of files to look up per query.')
+
+    def handle(self, *args, **options):
+        if not hasattr(default_storage, 'delete_unreferenced'):
+            raise CommandError('DEFAULT_FILE_STORAGE is not labeler.storage.ContentAddressedStorage')
+        num_blobs = deleted = 0
+        # derivatives are named by the content_hash of their source too, but they're a cache, not uploads
+        derivatives_root = derivatives_storage().location
+        for batch in iter_blobs(default_storage, max(options['batch_size'], 1), skip_dirs=[derivatives_root]):
+            num_blobs += len(batch)
+            referenced = set(Image.objects.filter(content_hash__in=[h for _, h in batch])
+                             .values_list('content_hash', flat=True))
+            for name, content_hash in batch:
+                if content_hash in referenced:
+                    continue
+                if options['dry_run']:
+                    self.stdout.write(name)
+                    continue
+
+                def is_referenced():
+                    return Image.objects.filter(content_hash=content_hash).exists()
+                if default_storage.delete_unreferenced(name, is_referenced, grace=options['grace']):
+                    deleted += 1
+        self.stdout.write(self.style.SUCCESS('Deleted {} of {} files.'.format(deleted, num_blobs)))
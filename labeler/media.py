@@ -0,0 +1,183 @@
+""" Serve user uploads (MEDIA_ROOT) efficiently, after the view has checked that the user may see them
+
+Access is checked per file: the path is resolved to the Images that use it (by content hash, or by file name) and
+settings.LABELER_MEDIA_PERMISSION, a function(user, images, path), decides. The default, `can_view_media`, lets
+staff see everything and everyone else (logged in, with LABELER_MEDIA_REQUIRE_LOGIN) see the files of any Image,
+since every labeler is shown every image. Set it to 'labeler.media.uploader_or_staff' (or your own function) to
+restrict files to the users who uploaded them.
+
+With settings.LABELER_MEDIA_SENDFILE the transfer is handed off to the front web server, so the file's bytes never
+pass through Python:
+  'x-accel-redirect': nginx, with an `internal` location at LABELER_MEDIA_ACCEL_PREFIX aliased to MEDIA_ROOT, e.g.
+                      location /protected-media/ { internal; alias /srv/labeler/user_uploads/; }
+  'x-sendfile':       Apache mod_xsendfile or lighttpd, which are given the absolute path
+Otherwise (the default, and what the dev server uses) the file is streamed by Django in blocks, with
+`Range: bytes=...` requests answered with 206 Partial Content and conditional requests with 304 Not Modified.
+
+Content-addressed files (see labeler.storage) and derivatives never change, so they're cached for a year.
+
+References:
+  [nginx X-Accel](https://www.nginx.com/resources/wiki/start/topics/examples/x-accel/)
+  [RFC 7233: Range requests](https://tools.ietf.org/html/rfc7233)
+"""
+import mimetypes
+import os
+import posixpath
+import re
+from urllib.parse import quote
+
+from django.apps import apps
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+from django.utils.module_loading import import_string
+
+from .storage import content_hash_from_name
+
+BLOCK_SIZE = 64 * 2 ** 10
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+MAX_AGE = 60 * 60
+RANGE_REGEX = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def media_path(path, document_root=None):
+    """ Absolute path of a file under MEDIA_ROOT, refusing anything outside it or in a hidden (.incoming) directory """
+    path = posixpath.normpath(path).lstrip('/')
+    if any(part.startswith('.') for part in path.split('/')):
+        raise Http404('Not found')
+    try:
+        full_path = safe_join(document_root or settings.MEDIA_ROOT, path)
+    except ValueError:
+        raise Http404('Not found')
+    if not os.path.isfile(full_path):
+        raise Http404('Not found')
+    return path, full_path
+
+
+def images_for_path(path):
+    """ QuerySet of the Images whose file (or, for derivatives, whose content) is at path under MEDIA_ROOT """
+    Image = apps.get_model('labeler', 'Image')
+    content_hash = content_hash_from_name(path)
+    if content_hash:
+        return Image.objects.filter(content_hash=content_hash)
+    return Image.objects.filter(file=path)
+
+
+def can_view_media(user, images, path):
+    """ Default LABELER_MEDIA_PERMISSION: staff see every file, other users the files of any Image
+
+    Derivatives of images without a content hash are named by a hash of the original's name and mtime, which
+    can't be traced back to the Image, so they're served like any Image's file. Other files that no Image
+    uses (e.g. blobs awaiting `manage.py sweep_blobs`) are staff only.
+    """
+    if user.is_staff:
+        return True
+    return images.exists() or path.startswith('derivatives/')
+
+
+def uploader_or_staff(user, images, path):
+    """ LABELER_MEDIA_PERMISSION that only lets users see the files of the Images they uploaded (and staff, all) """
+    return user.is_staff or (user.is_authenticated and images.filter(uploaded_by=user).exists())
+
+
+def has_media_permission(user, path):
+    """ Whether the user may see the file at path under MEDIA_ROOT, according to settings.LABELER_MEDIA_PERMISSION """
+    permission = getattr(settings, 'LABELER_MEDIA_PERMISSION', 'labeler.media.can_view_media')
+    return import_string(permission)(user, images_for_path(path), path)
+
+
+def parse_range(header, size):
+    """ (first, last) byte positions (inclusive) for a single-range `Range` header, or None to send the whole file
+
+    Raises ValueError when the range can't be satisfied.
+
+    >>> parse_range('bytes=0-99', 1000), parse_range('bytes=900-', 1000), parse_range('bytes=-100', 1000)
+    ((0, 99), (900, 999), (900, 999))
+    >>> parse_range('bytes=0-1,5-9', 1000) is None
+    True
+    """
+    match = RANGE_REGEX.match(header.replace(' ', '')) if header else None
+    if not match or not any(match.groups()):
+        return None  # absent, malformed or multiple ranges: ignore it (allowed by the RFC) and send everything
+    first, last = match.groups()
+    if not first:
+        first, last = max(size - int(last), 0), size - 1  # the last N bytes
+    else:
+        first, last = int(first), min(int(last), size - 1) if last else size - 1
+    if first > last or first >= size:
+        raise ValueError('Unsatisfiable range {!r} for {} bytes'.format(header, size))
+    return first, last
+
+
+def iter_file_range(fin, first, last, block_size=BLOCK_SIZE):
+    """ Yield the bytes from first to last (inclusive) of a file in blocks, then close it """
+    try:
+        fin.seek(first)
+        remaining = last - first + 1
+        while remaining > 0:
+            block = fin.read(min(block_size, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+    finally:
+        fin.close()
+
+
+def serve_media(request, path, document_root=None):
+    """ Response for a file under MEDIA_ROOT: an X-Accel-Redirect/X-Sendfile handoff, a 304, or the (partial) file
+
+    Raises Http404 for files that don't exist or that the user may not see (see has_media_permission).
+    """
+    path, full_path = media_path(path, document_root=document_root)
+    if not has_media_permission(request.user, path):
+        raise Http404('Not found')
+    stat = os.stat(full_path)
+    etag = quote_etag(content_hash_from_name(path) or '{:x}-{:x}'.format(int(stat.st_mtime * 1e6), stat.st_size))
+    last_modified = int(stat.st_mtime)
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = file_response(request, path, full_path, stat.st_size, etag)
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    immutable = content_hash_from_name(path) or path.startswith('derivatives/')
+    # access is checked per user, so shared caches mustn't keep a copy
+    patch_cache_control(response, private=True, max_age=IMMUTABLE_MAX_AGE if immutable else MAX_AGE)
+    return response
+
+
+def file_response(request, path, full_path, size, etag):
+    content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+    sendfile = getattr(settings, 'LABELER_MEDIA_SENDFILE', None)
+    if sendfile:
+        response = HttpResponse(content_type=content_type)
+        if sendfile == 'x-accel-redirect':
+            prefix = getattr(settings, 'LABELER_MEDIA_ACCEL_PREFIX', '/protected-media/')
+            response['X-Accel-Redirect'] = quote(prefix.rstrip('/') + '/' + path)
+        else:
+            response['X-Sendfile'] = full_path
+        return response  # the web server handles Range requests itself
+
+    first_last = None
+    # If-Range: only send part of the file if it's still the version the client has the rest of
+    if request.META.get('HTTP_IF_RANGE', etag) == etag:
+        try:
+            first_last = parse_range(request.META.get('HTTP_RANGE'), size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */{}'.format(size)
+            return response
+    if first_last is None:
+        response = FileResponse(open(full_path, 'rb'), content_type=content_type)
+        response['Content-Length'] = str(size)
+    else:
+        first, last = first_last
+        response = StreamingHttpResponse(iter_file_range(open(full_path, 'rb'), first, last),
+                                         status=206, content_type=content_type)
+        response['Content-Range'] = 'bytes {}-{}/{}'.format(first, last, size)
+        response['Content-Length'] = str(last - first + 1)
+    response['Accept-Ranges'] = 'bytes'
+    return response
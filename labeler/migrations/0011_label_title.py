@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-17 21:37
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('labeler', '0010_auto_20170829_0758'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='label',
+            name='title',
+            field=models.CharField(default='', max_length=100),
+            preserve_default=False,
+        ),
+        migrations.AlterField(
+            model_name='image',
+            name='caption',
+            field=models.CharField(blank=True, default='', max_length=50, verbose_name='Quick picture caption'),
+        ),
+        migrations.AlterField(
+            model_name='image',
+            name='label',
+            field=models.ManyToManyField(through='labeler.ImageLabel', to='labeler.Label'),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-17 21:38
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def merge_duplicate_totalvotes(apps, schema_editor):
+    """ Sum any duplicate (image, name) tallies into a single row so the unique constraint can be created """
+    TotalVotes = apps.get_model('labeler', 'TotalVotes')
+    duplicates = (TotalVotes.objects.values('image_id', 'name').annotate(n=models.Count('id'))
+                  .filter(n__gt=1).order_by())
+    for dup in duplicates:
+        rows = list(TotalVotes.objects.filter(image_id=dup['image_id'], name=dup['name']).order_by('id'))
+        rows[0].votes = sum(row.votes for row in rows)
+        rows[0].save()
+        TotalVotes.objects.filter(id__in=[row.id for row in rows[1:]]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('labeler', '0011_label_title'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='imagelabel',
+            name='image',
+            field=models.ForeignKey(db_index=False, default=None, null=True, on_delete=django.db.models.deletion.CASCADE, to='labeler.Image'),
+        ),
+        migrations.AlterField(
+            model_name='imagelabel',
+            name='user',
+            field=models.ForeignKey(db_index=False, default=None, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='totalvotes',
+            name='image',
+            field=models.ForeignKey(db_index=False, default=None, null=True, on_delete=django.db.models.deletion.CASCADE, to='labeler.Image'),
+        ),
+        migrations.RunPython(merge_duplicate_totalvotes, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='totalvotes',
+            unique_together=set([('image', 'name')]),
+        ),
+        migrations.AddIndex(
+            model_name='imagelabel',
+            index=models.Index(fields=['image', 'label'], name='imagelabel_image_label_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='imagelabel',
+            index=models.Index(fields=['user', 'image'], name='imagelabel_user_image_idx'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-17 21:43
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_image_priorities(apps, schema_editor):
+    """ One ImagePriority per existing Image, computed from its TotalVotes """
+    Image = apps.get_model('labeler', 'Image')
+    ImagePriority = apps.get_model('labeler', 'ImagePriority')
+    TotalVotes = apps.get_model('labeler', 'TotalVotes')
+    stats = {s['image_id']: s for s in TotalVotes.objects.filter(votes__gt=0).values('image_id').annotate(
+        total=models.Sum('votes'), top=models.Max('votes')).order_by()}
+    priorities = []
+    for image_id in Image.objects.values_list('id', flat=True).iterator():
+        total, top = stats.get(image_id, {}).get('total', 0), stats.get(image_id, {}).get('top', 0)
+        priorities.append(ImagePriority(image_id=image_id, total_votes=total,
+                                        disagreement=(1. - float(top) / total) if total else 0.))
+    ImagePriority.objects.bulk_create(priorities)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('labeler', '0013_image_created_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImagePriority',
+            fields=[
+                ('image', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='priority', serialize=False, to='labeler.Image')),
+                ('total_votes', models.IntegerField(default=0)),
+                ('disagreement', models.FloatField(default=0.0, verbose_name='Fraction of the votes that disagree with the most popular label')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='imagepriority',
+            index=models.Index(fields=['total_votes', '-disagreement', 'image'], name='imagepriority_schedule_idx'),
+        ),
+        migrations.RunPython(populate_image_priorities, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-17 21:48
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import labeler.uploadhandlers
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('labeler', '0015_image_content_hash'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='image',
+            name='file',
+            field=models.FileField(upload_to='images', validators=[labeler.uploadhandlers.validate_image_upload], verbose_name='Image to be labeled'),
+        ),
+    ]
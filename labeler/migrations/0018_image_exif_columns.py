@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-17 21:57
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('labeler', '0017_image_updated_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='camera_make',
+            field=models.CharField(blank=True, default='', max_length=64, verbose_name='Camera manufacturer'),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='camera_model',
+            field=models.CharField(blank=True, default='', max_length=64, verbose_name='Camera model'),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='latitude',
+            field=models.FloatField(blank=True, default=None, null=True, verbose_name='GPS latitude (decimal degrees north)'),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='longitude',
+            field=models.FloatField(blank=True, default=None, null=True, verbose_name='GPS longitude (decimal degrees east)'),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['latitude', 'longitude'], name='image_lat_lon_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['camera_make', 'camera_model'], name='image_camera_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['taken_date'], name='image_taken_idx'),
+        ),
+    ]
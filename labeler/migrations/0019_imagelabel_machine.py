@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-17 22:09
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('labeler', '0018_image_exif_columns'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imagelabel',
+            name='confidence',
+            field=models.FloatField(blank=True, default=None, null=True, verbose_name="The model's confidence in a machine label (0 to 1)."),
+        ),
+        migrations.AddField(
+            model_name='imagelabel',
+            name='is_machine',
+            field=models.BooleanField(default=False, verbose_name='Suggested by a model rather than voted for by a person.'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def lowercase_cameras(apps, schema_editor):
+    """ Store camera_make and camera_model lowercased, as exif_fields() now does, so ?camera_make= is an exact match """
+    Image = apps.get_model('labeler', 'Image')
+    for field in ('camera_make', 'camera_model'):
+        for value in Image.objects.exclude(**{field: ''}).values_list(field, flat=True).distinct().order_by():
+            if value != value.lower():
+                Image.objects.filter(**{field: value}).update(**{field: value.lower()})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('labeler', '0019_imagelabel_machine'),
+    ]
+
+    operations = [
+        migrations.RunPython(lowercase_cameras, migrations.RunPython.noop),
+    ]
@@ -9,11 +9,27 @@ References:
   [Django tutorial part 2](https://docs.djangoproject.com/en/1.11/intro/tutorial02/)
   [Pattern for uploading files](http://www.bogotobogo.com/python/Django/Python_Django_Image_Files_Uploading_Example.php)
 """
-from django.db import models
+from collections import Counter
+
+from django.conf import settings
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Max, Sum
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
 import jsonfield
 # from django.contrib.postgres.fields import JSONField  # only for PostGRESQL (psycopg2 backend)!
 from django.contrib.auth.models import User
 
+from .consensus import invalidate_consensus
+from .derivatives import generate_derivatives_quietly
+from .exif import exif_fields, jsonify
+from .pagecache import invalidate_index
+from .preannotate import queue_preannotation
+from .registry import label_registry
+from .storage import content_hash_from_name
+from .uploadhandlers import validate_image_upload
+
 
 # FIXME: Unused but don't comment it out because migrations use it
 def user_images_directory(instance, filename):
@@ -37,41 +53,304 @@ class Label(models.Model):
     title = models.CharField(max_length=100)
 
 
+@receiver(post_save, sender=Label)
+@receiver(post_delete, sender=Label)
+def invalidate_label_registry(sender, instance, using, **kwargs):
+    """ Reload the label registry in this process now and in every other process once the change is committed """
+    label_registry.invalidate()
+    transaction.on_commit(label_registry.invalidate, using=using)
+
+
 class Image(models.Model):
     """ A database record for images to be labeled """
 
-    ANIMAL_CHOICES = []
-    labels = Label.objects.values('id', 'title')
-    for label in labels:
-        ANIMAL_CHOICES.append((label['id'], label['title']))
+    # (id, title) pairs read from the label registry when iterated, so importing this module never queries the db
+    ANIMAL_CHOICES = label_registry.lazy_choices()
 
     caption = models.CharField("Quick picture caption",
                                max_length=50, default='', blank=True)
     description = models.TextField("Description of the image, where and when it was taken, who/what is in it, etc",
                                    max_length=512, default='', blank=True)
-    label = models.ManyToManyField(Label, through='ImageLabel', blank=False, choices=ANIMAL_CHOICES)
+    label = models.ManyToManyField(Label, through='ImageLabel', blank=False)
     taken_date = models.DateTimeField('Date photo was taken.', null=True, default=None, blank=True)
     updated_date = models.DateTimeField('Date photo was changed.', auto_now=True)
     created_date = models.DateTimeField('Date photo was created.', auto_now_add=True)
     uploaded_by = models.ForeignKey(User, default=None, null=True, blank=True)
-    file = models.FileField("Image to be labeled", upload_to='images', blank=False)
+    file = models.FileField("Image to be labeled", upload_to='images', blank=False,
+                            validators=[validate_image_upload])
     info = jsonfield.JSONField("Metadata about the image (usually from the EXIF header)", null=True, default=None,
                                blank=True)
+    content_hash = models.CharField("SHA-256 of the file content (shared by duplicate uploads)", max_length=64,
+                                    default='', blank=True, db_index=True, editable=False)
+    # denormalized from the EXIF in `info`, so they can be indexed and filtered on (see labeler.filters)
+    latitude = models.FloatField("GPS latitude (decimal degrees north)", null=True, default=None, blank=True)
+    longitude = models.FloatField("GPS longitude (decimal degrees east)", null=True, default=None, blank=True)
+    camera_make = models.CharField("Camera manufacturer", max_length=64, default='', blank=True)
+    camera_model = models.CharField("Camera model", max_length=64, default='', blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_date', 'id'], name='image_created_id_idx'),  # keyset pagination
+            models.Index(fields=['updated_date'], name='image_updated_idx'),  # max(updated_date) ETag validator
+            models.Index(fields=['latitude', 'longitude'], name='image_lat_lon_idx'),  # ?bbox=
+            models.Index(fields=['camera_make', 'camera_model'], name='image_camera_idx'),  # ?camera_make=
+            models.Index(fields=['camera_model'], name='image_camera_model_idx'),  # ?camera_model= on its own
+            models.Index(fields=['taken_date'], name='image_taken_idx'),  # ?taken_after=
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.file and not self.file._committed:
+            self.set_upload_metadata(self.file.file)
+            # store the file first, so the content-addressed storage can tell us its hash
+            self.file.save(self.file.name, self.file.file, save=False)
+        self.content_hash = content_hash_from_name(self.file.name) or self.content_hash
+        super().save(*args, **kwargs)
+
+    def set_upload_metadata(self, uploaded):
+        """ Fill in info (and the columns from it) from the EXIF that labeler.uploadhandlers captured during upload """
+        exif = getattr(uploaded, 'exif', None)
+        if exif:
+            if self.info is None:
+                self.info = jsonify(exif)
+            self.set_exif_fields(exif)
+
+    def set_exif_fields(self, exif):
+        """ Copy GPS coordinates, camera make and model, and taken_date (unless it's already set) out of EXIF tags """
+        fields = exif_fields(exif)
+        self.latitude, self.longitude = fields['latitude'], fields['longitude']
+        self.camera_make, self.camera_model = fields['camera_make'], fields['camera_model']
+        if self.taken_date is None:
+            self.taken_date = fields['taken_date']
+
+
+@receiver(post_save, sender=Image)
+@receiver(post_delete, sender=Image)
+def invalidate_index_page(sender, instance, using, **kwargs):
+    """ The index page lists every image, so re-render it (see labeler.pagecache) """
+    invalidate_index(using=using)
+
+
+def release_blob(storage, name, content_hash, using=None):
+    """ Delete a content-addressed file if no Image references its content hash (the blob's reference count is 0)
+
+    With ContentAddressedStorage a blob reused by an upload in the last LABELER_BLOB_GRACE seconds is kept
+    (its Image may not be committed yet), for `manage.py sweep_blobs` to remove later if it's still unreferenced.
+    """
+    def is_referenced():
+        return Image.objects.using(using).filter(content_hash=content_hash).exists()
+
+    if hasattr(storage, 'delete_unreferenced'):
+        return storage.delete_unreferenced(name, is_referenced)
+    if is_referenced():
+        return False
+    storage.delete(name)
+    return True
+
+
+@receiver(post_delete, sender=Image)
+def release_image_blob(sender, instance, using, **kwargs):
+    """ Release a content-addressed file once the transaction deleting an Image commits (see release_blob)
+
+    Files with other (legacy) names are left alone, as they always have been.
+    """
+    if not instance.content_hash or not instance.file:
+        return
+    name, storage, content_hash = instance.file.name, instance.file.storage, instance.content_hash
+    transaction.on_commit(lambda: release_blob(storage, name, content_hash, using=using), using=using)
+
+
+def count_votes(image_labels):
+    """ Count ImageLabel ballots by (image_id, label_id), ignoring machine labels and ballots missing an image or label
+
+    >>> count_votes([ImageLabel(image_id=1, label_id=2), ImageLabel(image_id=1, label_id=2), ImageLabel(image_id=1),
+    ...              ImageLabel(image_id=1, label_id=2, is_machine=True)])
+    Counter({(1, 2): 2})
+    """
+    return Counter((il.image_id, il.label_id) for il in image_labels
+                   if il.image_id is not None and il.label_id is not None and not il.is_machine)
+
+
+class ImageLabelQuerySet(models.QuerySet):
+    """ ImageLabel QuerySet that keeps TotalVotes in sync for bulk operations that bypass Model.save()
+
+    Deletes (including cascades) are handled by the post_delete receiver below.
+    """
+    TALLY_FIELDS = ('image', 'image_id', 'label', 'label_id', 'is_machine')
+
+    def bulk_create(self, objs, batch_size=None):
+        with transaction.atomic(using=self.db):
+            objs = super().bulk_create(objs, batch_size=batch_size)
+            TotalVotes.objects.apply_deltas(count_votes(objs))
+        return objs
+
+    def update(self, **kwargs):
+        if not any(k in kwargs for k in self.TALLY_FIELDS):
+            return super().update(**kwargs)
+        with transaction.atomic(using=self.db):
+            pks = list(self.values_list('pk', flat=True))
+            before = count_votes(ImageLabel.objects.filter(pk__in=pks).only('image', 'label', 'is_machine'))
+            rows = super().update(**kwargs)
+            after = count_votes(ImageLabel.objects.filter(pk__in=pks).only('image', 'label', 'is_machine'))
+            after.subtract(before)
+            TotalVotes.objects.apply_deltas(after)
+        return rows
 
 
 class ImageLabel(models.Model):
-    class Meta:
-        auto_created = True
-    """ Individual user labels (a filled out ballot that "votes" for a label associated with an image) """
+    """ Individual user labels (a filled out ballot that "votes" for a label associated with an image)
+
+    Machine labels (is_machine, see labeler.preannotate) are a model's suggestions, not votes, so they aren't counted.
+    """
     label = models.ForeignKey(Label, default=None, null=True)
-    image = models.ForeignKey(Image, default=None, null=True)
-    user = models.ForeignKey(User, default=None, null=True)
+    # the composite indexes below lead with image and user, so separate FK indexes would only slow down inserts
+    image = models.ForeignKey(Image, default=None, null=True, db_index=False)
+    user = models.ForeignKey(User, default=None, null=True, db_index=False)
     updated_date = models.DateTimeField('Datetime the label was assigned to the image.', auto_now=True)
     created_date = models.DateTimeField('Datetime the label was assigned to the image.', auto_now_add=True)
+    is_machine = models.BooleanField('Suggested by a model rather than voted for by a person.', default=False)
+    confidence = models.FloatField("The model's confidence in a machine label (0 to 1).", null=True, default=None,
+                                   blank=True)
+
+    objects = ImageLabelQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['image', 'label'], name='imagelabel_image_label_idx'),  # votes for an image
+            models.Index(fields=['user', 'image'], name='imagelabel_user_image_idx'),  # has user voted on image
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._tallied = count_votes([instance])
+        return instance
+
+    def save(self, *args, **kwargs):
+        """ Save the ballot and move its vote in TotalVotes (if the image or label changed) in one transaction """
+        with transaction.atomic(using=kwargs.get('using')):
+            super().save(*args, **kwargs)
+            deltas = count_votes([self])
+            deltas.subtract(getattr(self, '_tallied', Counter()))
+            TotalVotes.objects.apply_deltas(deltas)
+        self._tallied = count_votes([self])
+
+
+@receiver(post_delete, sender=ImageLabel)
+def retract_vote(sender, instance, using, **kwargs):
+    """ Decrement TotalVotes for a deleted ballot (post_delete is sent inside the delete transaction) """
+    deltas = Counter({key: -n for key, n in getattr(instance, '_tallied', count_votes([instance])).items()})
+    TotalVotes.objects.db_manager(using).apply_deltas(deltas)
+
+
+class TotalVotesManager(models.Manager):
+
+    def apply_deltas(self, deltas):
+        """ Add each vote count delta in a {(image_id, label_id): delta} mapping to the matching TotalVotes row
+
+        Counts are changed with F() expressions so concurrent voters never overwrite each other's increments.
+        Missing rows are created for positive deltas only, since a decrement means the row was already counted.
+        """
+        deltas = {key: n for key, n in deltas.items() if n}
+        if not deltas:
+            return
+        titles = label_registry.titles(set(label_id for _, label_id in deltas))
+        name_deltas = Counter()
+        for (image_id, label_id), n in deltas.items():
+            if label_id in titles:
+                name_deltas[(image_id, titles[label_id])] += n
+        with transaction.atomic(using=self.db):
+            for (image_id, name), n in name_deltas.items():
+                if not n:
+                    continue
+                votes = self.filter(image_id=image_id, name=name)
+                if votes.update(votes=F('votes') + n) or n < 0:
+                    continue
+                try:
+                    with transaction.atomic(using=self.db):
+                        self.create(image_id=image_id, name=name, votes=n)
+                except IntegrityError:
+                    # another voter created the row first (or the image was deleted out from under us)
+                    votes.update(votes=F('votes') + n)
+            image_ids = set(image_id for image_id, _ in name_deltas)
+            ImagePriority.objects.db_manager(self.db).refresh(image_ids)
+            # the image's labels are part of its API representation, so its ETag (see labeler.conditional) changes too
+            Image.objects.db_manager(self.db).filter(pk__in=image_ids).update(updated_date=timezone.now())
+        invalidate_consensus((image_id for image_id, _ in name_deltas), using=self.db)
 
 
 class TotalVotes(models.Model):
-    """ Aggregated (denormalized) votes (by all users, who are allowed to vote multiple times) for an individual Image """
-    image = models.ForeignKey(Image, default=None, null=True)
+    """ Aggregated (denormalized) votes (by all users, who are allowed to vote multiple times) for an individual Image
+
+    Maintained incrementally by ImageLabel saves, deletes, bulk_create() and update().
+    Rebuild or verify them with `python manage.py rebuild_totalvotes`.
+    """
+    image = models.ForeignKey(Image, default=None, null=True, db_index=False)  # covered by unique_together index
     name = models.CharField(max_length=128)
     votes = models.IntegerField(default=0)
+
+    objects = TotalVotesManager()
+
+    class Meta:
+        unique_together = (('image', 'name'),)
+
+
+class ImagePriorityManager(models.Manager):
+
+    def refresh(self, image_ids):
+        """ Recompute the priority of each image from its TotalVotes (creating any missing ImagePriority rows) """
+        image_ids = set(image_ids)
+        if not image_ids:
+            return
+        stats = {s['image_id']: s for s in TotalVotes.objects.using(self.db).filter(
+            image_id__in=image_ids, votes__gt=0).values('image_id').annotate(
+            total=Sum('votes'), top=Max('votes')).order_by()}
+        with transaction.atomic(using=self.db):
+            for image_id in image_ids:
+                total, top = stats.get(image_id, {}).get('total', 0), stats.get(image_id, {}).get('top', 0)
+                fields = dict(total_votes=total, disagreement=(1. - float(top) / total) if total else 0.)
+                if not self.filter(image_id=image_id).update(**fields):
+                    try:
+                        with transaction.atomic(using=self.db):
+                            self.create(image_id=image_id, **fields)
+                    except IntegrityError:
+                        # created concurrently, or the image has been deleted
+                        self.filter(image_id=image_id).update(**fields)
+
+
+class ImagePriority(models.Model):
+    """ Denormalized labeling priority for each Image: fewest votes first, then most disagreement about its label
+
+    Kept up to date by TotalVotesManager.apply_deltas(), so labeler.scheduler can pick the next image to label
+    with a single index scan rather than aggregating all the votes on every request.
+    """
+    image = models.OneToOneField(Image, primary_key=True, related_name='priority')
+    total_votes = models.IntegerField(default=0)
+    disagreement = models.FloatField('Fraction of the votes that disagree with the most popular label', default=0.)
+
+    objects = ImagePriorityManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['total_votes', '-disagreement', 'image'], name='imagepriority_schedule_idx'),
+        ]
+
+
+@receiver(post_save, sender=Image)
+def create_image_priority(sender, instance, created, raw=False, using=None, **kwargs):
+    """ New images start at the front of the labeling queue """
+    if created and not raw:
+        ImagePriority.objects.db_manager(using).get_or_create(image=instance)
+
+
+@receiver(post_save, sender=Image)
+def preannotate_image(sender, instance, created, raw=False, using=None, **kwargs):
+    """ With settings.LABELER_PREANNOTATE, suggest labels for new images in the background (see labeler.preannotate) """
+    if created and not raw and getattr(settings, 'LABELER_PREANNOTATE', False):
+        transaction.on_commit(lambda: queue_preannotation([instance.pk]), using=using)
+
+
+@receiver(post_save, sender=Image)
+def create_image_derivatives(sender, instance, created, raw=False, using=None, **kwargs):
+    """ With settings.LABELER_EAGER_DERIVATIVES, make new images' thumbnails right away, not on first view """
+    if created and not raw and getattr(settings, 'LABELER_EAGER_DERIVATIVES', False):
+        transaction.on_commit(lambda: generate_derivatives_quietly([instance]), using=using)
@@ -0,0 +1,121 @@
+""" Non-maximum suppression of detected boxes, on NumPy arrays
+
+Boxes are (N, 4) arrays of (x, y, w, h): center, width and height, as decoded by labeler.yolo_decode.
+The IoU of every pair of boxes is computed at once as an (N, N) matrix, so the greedy pass that keeps the best box
+and drops the ones overlapping it is one vectorized row operation per kept box, not a Python call per pair.
+
+  nms(xywh, scores)                   class-agnostic: indices of the boxes to keep, best first
+  nms(xywh, scores, classes=labels)   per class: a box only suppresses boxes of its own class
+  batched_nms(xywh, scores, image_ids, classes=labels)   many images' boxes at once, never mixing images
+  suppress(xywh, probs)               YOLO style: zero each box's score for each class it's suppressed in
+
+The overlap semantics are those of labeler.yolo_decode.BoundBox.iou: a box is suppressed by a higher scoring box
+when their IoU is >= the threshold.
+"""
+import numpy as np
+
+IOU_THRESHOLD = 0.4
+
+
+def corners(xywh):
+    """ (N, 2) lower and (N, 2) upper corners of (x, y, w, h) boxes
+
+    >>> lo, hi = corners(np.array([[.5, .5, .2, .4]]))
+    >>> lo.tolist(), hi.tolist()
+    ([[0.4, 0.3]], [[0.6, 0.7]])
+    """
+    xywh = np.asarray(xywh, dtype=np.float64).reshape(-1, 4)
+    return xywh[:, :2] - xywh[:, 2:] / 2, xywh[:, :2] + xywh[:, 2:] / 2
+
+
+def iou_matrix(xywh, other=None):
+    """ (N, M) intersection over union of each box in xywh with each box in other (default: with each other)
+
+    >>> iou_matrix(np.array([[.5, .5, .2, .2], [.6, .5, .2, .2], [.9, .9, .1, .1]])).round(4)
+    array([[1.    , 0.3333, 0.    ],
+           [0.3333, 1.    , 0.    ],
+           [0.    , 0.    , 1.    ]])
+    """
+    lo, hi = corners(xywh)
+    other_lo, other_hi = (lo, hi) if other is None else corners(other)
+    overlap = np.clip(np.minimum(hi[:, None], other_hi[None]) - np.maximum(lo[:, None], other_lo[None]), 0, None)
+    intersection = overlap[..., 0] * overlap[..., 1]
+    area, other_area = np.prod(hi - lo, axis=1), np.prod(other_hi - other_lo, axis=1)
+    union = area[:, None] + other_area[None] - intersection
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(union > 0, intersection / union, 0.)
+
+
+def greedy(iou, iou_threshold=IOU_THRESHOLD):
+    """ Indices kept by greedy suppression, given the IoU matrix of boxes already sorted best first """
+    keep = np.ones(len(iou), dtype=bool)
+    for i in range(len(iou)):
+        if keep[i]:
+            keep[i + 1:] &= iou[i, i + 1:] < iou_threshold
+    return np.flatnonzero(keep)
+
+
+def nms(xywh, scores, iou_threshold=IOU_THRESHOLD, classes=None, score_threshold=None):
+    """ Indices of the boxes that survive non-maximum suppression, in descending score order
+
+    With classes (an (N,) array of class ids) boxes only compete with boxes of the same class.
+    Boxes scoring <= score_threshold are dropped before the suppression.
+
+    >>> xywh = np.array([[.5, .5, .2, .2], [.52, .5, .2, .2], [.5, .5, .2, .2]])
+    >>> nms(xywh, np.array([.9, .8, .7])).tolist()
+    [0]
+    >>> nms(xywh, np.array([.9, .8, .7]), classes=np.array([0, 0, 1])).tolist()
+    [0, 2]
+    """
+    return batched_nms(xywh, scores, np.zeros(len(scores), dtype=int), iou_threshold=iou_threshold,
+                       classes=classes, score_threshold=score_threshold)
+
+
+def batched_nms(xywh, scores, image_ids, iou_threshold=IOU_THRESHOLD, classes=None, score_threshold=None):
+    """ nms() of the boxes of many images at once: boxes only suppress boxes with the same image id (and class)
+
+    Returns indices into the (concatenated) inputs, best first.
+    Each image (and class) gets its own IoU matrix, so memory grows with the boxes per image, not the whole batch.
+
+    >>> xywh = np.array([[.5, .5, .2, .2], [.52, .5, .2, .2], [.5, .5, .2, .2]])
+    >>> batched_nms(xywh, np.array([.9, .8, .7]), np.array([0, 0, 1])).tolist()
+    [0, 2]
+    """
+    xywh = np.asarray(xywh, dtype=np.float64).reshape(-1, 4)
+    scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+    candidates = np.arange(len(scores))
+    if score_threshold is not None:
+        candidates = candidates[scores > score_threshold]
+    if not len(candidates):
+        return candidates
+    groups = np.asarray(image_ids)[candidates]
+    if classes is not None:
+        # (image, class) pairs as one integer group key
+        groups = np.stack([groups, np.asarray(classes)[candidates]], axis=1)
+        groups = np.unique(groups, axis=0, return_inverse=True)[1].reshape(-1)
+
+    # best first overall, so each group's members are already in descending score order
+    best_first = np.argsort(-scores[candidates], kind='mergesort')
+    order, groups = candidates[best_first], groups[best_first]
+    keep = []
+    for group in np.unique(groups):
+        members = order[groups == group]
+        keep.append(members[greedy(iou_matrix(xywh[members]), iou_threshold)])
+    keep = np.concatenate(keep)
+    return keep[np.argsort(-scores[keep], kind='mergesort')]
+
+
+def suppress(xywh, probs, iou_threshold=IOU_THRESHOLD):
+    """ Per-class suppression of a (N, classes) score matrix: zero the scores of boxes suppressed in each class
+
+    Zero scores (under the detection threshold) never suppress anything.
+    """
+    probs = np.array(probs, dtype=np.float64)
+    iou = iou_matrix(xywh)
+    for c in np.flatnonzero(probs.any(axis=0)):
+        members = np.flatnonzero(probs[:, c])
+        members = members[np.argsort(-probs[members, c], kind='mergesort')]
+        suppressed = np.ones(len(members), dtype=bool)
+        suppressed[greedy(iou[np.ix_(members, members)], iou_threshold)] = False
+        probs[members[suppressed], c] = 0
+    return probs
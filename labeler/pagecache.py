@@ -0,0 +1,47 @@
+""" Cached rendering of the index page, invalidated by a version number that every Image save or delete bumps
+
+The whole page is cached under a key that includes the current version, so a new upload (or edit) makes every process
+render it afresh, while each table row is also cached as a template fragment keyed by its image's pk and updated_date
+(see labeler/index.html), so re-rendering the page after one upload only re-renders that one row.
+The version lives in the Django cache, so it's shared by all processes when the cache backend is (file-based,
+memcached, ...) and only needs the local-memory backend for a single process (and the tests).
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+INDEX_VERSION_KEY = 'labeler:index:version'
+INDEX_PAGE_KEY = 'labeler:index:page:{version}:{path}'
+PAGE_TIMEOUT = getattr(settings, 'LABELER_INDEX_CACHE_TIMEOUT', 24 * 60 * 60)
+ROW_TIMEOUT = getattr(settings, 'LABELER_INDEX_ROW_CACHE_TIMEOUT', 7 * 24 * 60 * 60)
+
+
+def index_version():
+    version = cache.get(INDEX_VERSION_KEY)
+    if version is None:
+        # start from the clock so an evicted counter never repeats a version whose page may still be cached
+        cache.add(INDEX_VERSION_KEY, int(time.time() * 1000), timeout=None)
+        version = cache.get(INDEX_VERSION_KEY)
+    return version
+
+
+def bump_index_version():
+    try:
+        cache.incr(INDEX_VERSION_KEY)
+    except ValueError:
+        cache.add(INDEX_VERSION_KEY, int(time.time() * 1000), timeout=None)
+
+
+def invalidate_index(using=None):
+    """ Stop serving the cached index page, now and again once the transaction that changed an Image commits """
+    bump_index_version()
+    transaction.on_commit(bump_index_version, using=using)
+
+
+def index_page_key(request):
+    """ Cache key for the rendered page at this request's path (and query string) and the current version """
+    path = hashlib.md5(request.get_full_path().encode('utf-8')).hexdigest()
+    return INDEX_PAGE_KEY.format(version=index_version(), path=path)
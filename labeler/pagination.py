@@ -0,0 +1,119 @@
+""" Keyset (cursor) pagination for the image list APIs
+
+Each page is a `WHERE (created_date, id) < (cursor)` range seek on the (created_date, id) index,
+so page 1000 costs the same as page 1 and images uploaded while a client is paging never shift or
+duplicate the rows on the pages that follow (new uploads only ever appear before the first page).
+
+References:
+  [DRF pagination](http://www.django-rest-framework.org/api-guide/pagination/)
+  [Use the index, Luke: paging through results](http://use-the-index-luke.com/no-offset)
+"""
+import base64
+from collections import OrderedDict, namedtuple
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+Cursor = namedtuple('Cursor', ['reverse', 'created_date', 'pk'])
+
+
+def encode_cursor(cursor):
+    """ Opaque (urlsafe base64) token for a position in the list
+
+    >>> from datetime import datetime
+    >>> decode_cursor(encode_cursor(Cursor(False, datetime(2017, 8, 1, 12, 30), 42)))
+    Cursor(reverse=False, created_date=datetime.datetime(2017, 8, 1, 12, 30), pk=42)
+    """
+    token = '{}|{}|{}'.format('p' if cursor.reverse else 'n', cursor.created_date.isoformat(), cursor.pk)
+    return base64.urlsafe_b64encode(token.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(encoded):
+    """ Cursor from encode_cursor(), or None if the token was tampered with or truncated """
+    try:
+        direction, created_date, pk = base64.urlsafe_b64decode(encoded.encode('ascii')).decode('utf-8').split('|')
+        created_date = parse_datetime(created_date)
+        if direction not in ('n', 'p') or created_date is None:
+            return None
+        return Cursor(direction == 'p', created_date, int(pk))
+    except (TypeError, ValueError, UnicodeError):
+        return None
+
+
+class KeysetPagination(BasePagination):
+    """ Newest-first cursor pagination keyed on the (created_date, id) of the last row of the previous page """
+    page_size = 100
+    max_page_size = 1000
+    page_size_query_param = 'page_size'
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.base_url = request.build_absolute_uri()
+        encoded = request.query_params.get(self.cursor_query_param)
+        cursor = decode_cursor(encoded) if encoded else None
+        if encoded and cursor is None:
+            raise NotFound(self.invalid_cursor_message)
+
+        queryset = self.seek(queryset, cursor)
+
+        # one extra row tells us whether there's another page without a COUNT(*)
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if cursor is not None and cursor.reverse:
+            results.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, cursor is not None
+        self.page = results
+        return results
+
+    def seek(self, queryset, cursor):
+        """ The rows after (or before, for a reverse cursor) the cursor, nearest first """
+        # the plain created_date bound is what the index seeks on: on its own the OR of the row comparison
+        # is a filter applied while scanning from the newest row, so deep pages would cost more than page 1
+        if cursor is None:
+            return queryset.order_by('-created_date', '-pk')
+        if cursor.reverse:
+            return queryset.filter(created_date__gte=cursor.created_date).filter(
+                Q(created_date__gt=cursor.created_date) | Q(pk__gt=cursor.pk)).order_by('created_date', 'pk')
+        return queryset.filter(created_date__lte=cursor.created_date).filter(
+            Q(created_date__lt=cursor.created_date) | Q(pk__lt=cursor.pk)).order_by('-created_date', '-pk')
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except (TypeError, ValueError):
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        last = self.page[-1]
+        return replace_query_param(self.base_url, self.cursor_query_param,
+                                   encode_cursor(Cursor(False, last.created_date, last.pk)))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        first = self.page[0]
+        return replace_query_param(self.base_url, self.cursor_query_param,
+                                   encode_cursor(Cursor(True, first.created_date, first.pk)))
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
@@ -0,0 +1,159 @@
+""" Machine pre-annotation: a model's predictions for new Images, stored as candidate labels for labelers to confirm
+
+Each predicted class that matches a Label (by title, or through LABELER_PREANNOTATE_LABELS) becomes an ImageLabel
+with is_machine=True and the model's confidence. Machine labels aren't votes: they're left out of TotalVotes,
+the consensus and the labeling priority, and are listed separately (api/images/<pk>/suggestions/).
+
+New uploads are pre-annotated off the request path, in batches, either
+  - by a background thread in each web process, with settings.LABELER_PREANNOTATE = True
+    (images are queued once their upload transaction commits), or
+  - by `python manage.py preannotate [--follow]`, e.g. on a separate worker box.
+
+The model is LABELER_PREANNOTATE_PREDICTOR, a function(images) returning [(class name, confidence), ...] per image:
+  'labeler.preannotate.yolo_predictions' (default): the best score of each VOC class the YOLO detector finds
+  'labeler.preannotate.cats_vs_dogs_predictions': the cats-vs-dogs classifier of labeler.experiment
+"""
+import logging
+import queue
+import threading
+
+from django.apps import apps
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .consensus import invalidate_consensus
+from .detection import next_batch
+from .registry import label_registry
+
+_logger = logging.getLogger(__name__)
+
+MIN_CONFIDENCE = getattr(settings, 'LABELER_PREANNOTATE_MIN_CONFIDENCE', 0.3)
+BATCH_SIZE = getattr(settings, 'LABELER_PREANNOTATE_BATCH', 16)
+MAX_WAIT = 1.  # seconds the background thread waits for a batch of uploads to fill
+
+
+def yolo_predictions(images):
+    """ [(VOC class, best score), ...] of the objects the YOLO detector (labeler.detection) finds in each image """
+    from .detection import get_detector, preprocess
+    from .yolo_decode import LABELS, decode_netout
+
+    detector = get_detector()
+    futures = []
+    for image in images:
+        try:
+            with image.file.storage.open(image.file.name, 'rb') as fin:
+                # submitted all at once, so the detector runs them through the model in as few batches as it can
+                futures.append(detector.submit(preprocess(fin)[0]))
+        except (IOError, OSError, ValueError) as e:
+            _logger.warning('Unable to read image %s (%s): %s', image.pk, image.file.name, e)
+            futures.append(None)
+    predictions = []
+    for future in futures:
+        best = {}
+        if future is not None:
+            detections = decode_netout(future.result(timeout=getattr(settings, 'LABELER_DETECTION_TIMEOUT', 30)))
+            for label, score in zip(detections.labels, detections.scores):
+                best[LABELS[label]] = max(best.get(LABELS[label], 0.), float(score))
+        predictions.append(sorted(best.items(), key=lambda p: -p[1]))
+    return predictions
+
+
+_cats_vs_dogs = None
+
+
+def cats_vs_dogs_predictions(images):
+    """ [('cat' or 'dog', probability)] for each image, from the labeler.experiment classifier
+
+    Its weights are loaded (once per process) from settings.LABELER_CATS_VS_DOGS_WEIGHTS.
+    """
+    import numpy as np
+    import PIL.Image
+    from . import experiment
+
+    global _cats_vs_dogs
+    if _cats_vs_dogs is None:
+        _cats_vs_dogs = experiment.build_model(path=settings.LABELER_CATS_VS_DOGS_WEIGHTS)
+    arrays, readable = [], []
+    for i, image in enumerate(images):
+        try:
+            with image.file.storage.open(image.file.name, 'rb') as fin:
+                img = PIL.Image.open(fin).convert('RGB').resize((experiment.img_width, experiment.img_height))
+            arrays.append(np.asarray(img, dtype=np.float32) / 255.)
+            readable.append(i)
+        except (IOError, OSError, ValueError) as e:
+            _logger.warning('Unable to read image %s (%s): %s', image.pk, image.file.name, e)
+    predictions = [[] for _ in images]
+    if arrays:
+        # flow_from_directory() numbers the classes alphabetically: cats 0, dogs 1
+        for i, dog in zip(readable, _cats_vs_dogs.predict(np.stack(arrays))[:, 0]):
+            predictions[i] = [('dog', float(dog)) if dog >= .5 else ('cat', 1. - float(dog))]
+    return predictions
+
+
+def label_for(name):
+    """ The Label a predicted class name stands for, or None """
+    return label_registry.get_by_title(getattr(settings, 'LABELER_PREANNOTATE_LABELS', {}).get(name, name))
+
+
+def preannotate(images, predict=None, min_confidence=None):
+    """ Store the predictions for these Images as machine labels, returning the number of labels created """
+    Image, ImageLabel = apps.get_model('labeler', 'Image'), apps.get_model('labeler', 'ImageLabel')
+    images = list(images)
+    if not images:
+        return 0
+    predict = predict or import_string(getattr(settings, 'LABELER_PREANNOTATE_PREDICTOR',
+                                               'labeler.preannotate.yolo_predictions'))
+    min_confidence = MIN_CONFIDENCE if min_confidence is None else min_confidence
+    machine_labels = []
+    for image, predictions in zip(images, predict(images)):
+        for name, confidence in predictions:
+            label = label_for(name)
+            if label is not None and confidence >= min_confidence:
+                machine_labels.append(ImageLabel(image_id=image.pk, label=label, is_machine=True,
+                                                 confidence=round(confidence, 4)))
+    # machine labels aren't counted in TotalVotes, so this is a plain INSERT
+    ImageLabel.objects.bulk_create(machine_labels)
+    # and updated_date is bumped here, as a vote bumps it, so a client revalidating the image's ETag sees the change
+    Image.objects.filter(pk__in=set(label.image_id for label in machine_labels)).update(updated_date=timezone.now())
+    invalidate_consensus(image.pk for image in images)
+    return len(machine_labels)
+
+
+class PreannotationWorker(object):
+    """ Background thread that pre-annotates the Images whose ids are queued, a batch at a time """
+
+    def __init__(self, batch_size=BATCH_SIZE, max_wait=MAX_WAIT):
+        self.batch_size, self.max_wait = batch_size, max_wait
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def enqueue(self, image_ids):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='labeler-preannotate', daemon=True)
+                self.thread.start()
+        for image_id in image_ids:
+            self.queue.put(image_id)
+
+    def run(self):
+        while True:
+            image_ids = next_batch(self.queue, self.batch_size, self.max_wait)
+            close_old_connections()
+            try:
+                Image = apps.get_model('labeler', 'Image')
+                preannotate(Image.objects.filter(pk__in=image_ids).only('file').order_by('pk'))
+            except Exception:
+                _logger.exception('Unable to pre-annotate images %s', image_ids)
+
+
+worker = PreannotationWorker()
+
+
+def queue_preannotation(image_ids):
+    """ Pre-annotate these (new) images in the background, if settings.LABELER_PREANNOTATE """
+    image_ids = [pk for pk in image_ids if pk]
+    if image_ids and getattr(settings, 'LABELER_PREANNOTATE', False):
+        worker.enqueue(image_ids)
@@ -0,0 +1,145 @@
+""" Process-local registry of Label records so label lookups don't hit the database on every request
+
+The registry loads every Label (one query) the first time it is used, not at import time.
+Saving or deleting a Label bumps a version number in the Django cache,
+and each process reloads its registry the next time it sees a newer version.
+The version is read from the cache at most once every LABELER_LABEL_REGISTRY_TTL seconds, and an id or title that
+isn't in the registry is looked up in the database before it's treated as unknown, so a label created by another
+process (or whose version bump was lost to a cache eviction) is found right away.
+
+>>> label_registry.version_key
+'labeler:label_registry:version'
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+
+
+class LabelRegistry(object):
+    """ Lazily loaded id/title/category lookups for all Labels, invalidated by a (cache-shared) version counter """
+    version_key = 'labeler:label_registry:version'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked_at = None
+        self._by_id = OrderedDict()
+        self._by_title = {}
+
+    def current_version(self):
+        """ The version number shared by all processes (through the Django cache) """
+        version = cache.get(self.version_key)
+        if version is None:
+            # start from the clock so an evicted counter never repeats a version some process already loaded
+            cache.add(self.version_key, int(time.time() * 1000), timeout=None)
+            version = cache.get(self.version_key)
+        return version
+
+    def invalidate(self):
+        """ Bump the shared version so every process reloads its registry on next use """
+        try:
+            cache.incr(self.version_key)
+        except ValueError:
+            cache.add(self.version_key, int(time.time() * 1000), timeout=None)
+        self._version = None
+
+    def load(self, force=False):
+        """ Reload all the Labels from the database if the registry is empty or stale (or force is True) """
+        now = time.monotonic()
+        ttl = getattr(settings, 'LABELER_LABEL_REGISTRY_TTL', 1)
+        if not force and self._version is not None and now - self._checked_at < ttl:
+            return self
+        version = self.current_version()
+        if version == self._version and not force:
+            self._checked_at = now
+            return self
+        with self._lock:
+            if version != self._version or force:
+                Label = apps.get_model('labeler', 'Label')
+                by_id = OrderedDict((label.id, label) for label in Label.objects.order_by('id'))
+                self._by_id = by_id
+                self._by_title = {label.title: label for label in reversed(list(by_id.values()))}
+                self._version = version
+            self._checked_at = now
+        return self
+
+    def reload_if_exists(self, **lookup):
+        """ Reload the registry if a Label matching the lookup is in the database but not (yet) in the registry """
+        if apps.get_model('labeler', 'Label').objects.filter(**lookup).exists():
+            self.load(force=True)
+            return True
+        return False
+
+    def get(self, label_id, default=None):
+        """ The Label instance for a label id (int or numeric str) """
+        try:
+            label_id = int(label_id)
+        except (TypeError, ValueError):
+            return default
+        label = self.load()._by_id.get(label_id)
+        if label is None and self.reload_if_exists(id=label_id):
+            label = self._by_id.get(label_id)
+        return default if label is None else label
+
+    def get_by_title(self, title, default=None):
+        """ The Label with this title (the first one created, if titles are duplicated) """
+        label = self.load()._by_title.get(title)
+        if label is None and self.reload_if_exists(title=title):
+            label = self._by_title.get(title)
+        return default if label is None else label
+
+    def title(self, label_id, default=None):
+        label = self.get(label_id)
+        return default if label is None else label.title
+
+    def category(self, label_id, default=None):
+        label = self.get(label_id)
+        return default if label is None else label.category
+
+    def titles(self, label_ids):
+        """ {label_id: title} for each of the label_ids that exist """
+        by_id = self.load()._by_id
+        missing = [label_id for label_id in label_ids if label_id not in by_id]
+        if missing and self.reload_if_exists(id__in=missing):
+            by_id = self._by_id
+        return {label_id: by_id[label_id].title for label_id in label_ids if label_id in by_id}
+
+    def choices(self):
+        """ (id, title) pairs for a form or model field `choices` argument """
+        return [(label.id, label.title) for label in self.load()._by_id.values()]
+
+    def lazy_choices(self):
+        """ An iterable of (id, title) pairs that isn't evaluated (queried) until it is iterated """
+        return LazyChoices(self)
+
+    def __iter__(self):
+        return iter(list(self.load()._by_id.values()))
+
+    def __len__(self):
+        return len(self.load()._by_id)
+
+    def __contains__(self, label_id):
+        return self.get(label_id) is not None
+
+
+class LazyChoices(object):
+    """ Choices list that reads the label registry each time it is iterated """
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    def __iter__(self):
+        return iter(self.registry.choices())
+
+    def __len__(self):
+        return len(self.registry.choices())
+
+    def __repr__(self):
+        return 'LazyChoices({!r})'.format(self.registry)
+
+
+label_registry = LabelRegistry()
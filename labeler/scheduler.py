@@ -0,0 +1,22 @@
+""" Pick the next image(s) for a user to label
+
+Images are served in ImagePriority order (fewest votes first, then the most disagreement among the votes),
+skipping any image the user has already voted on. ImagePriority is updated incrementally as votes arrive,
+so picking the next image is a single scan of the imagepriority_schedule_idx index that stops after `n` rows.
+The NOT IN (images this user voted on) filter is an index range scan on imagelabel_user_image_idx.
+"""
+from .models import ImageLabel, ImagePriority
+
+
+def next_images(user=None, n=1):
+    """ The `n` highest priority Images that `user` hasn't voted on yet """
+    queryset = ImagePriority.objects.select_related('image').order_by('total_votes', '-disagreement', 'image')
+    if user is not None and user.is_authenticated:
+        queryset = queryset.exclude(image_id__in=ImageLabel.objects.filter(user=user).values('image_id'))
+    return [priority.image for priority in queryset[:n]]
+
+
+def next_image(user=None):
+    """ The highest priority Image that `user` hasn't voted on, or None if they've voted on them all """
+    images = next_images(user, n=1)
+    return images[0] if images else None
@@ -1,12 +1,140 @@
+from django.db.models import Prefetch
+from django.urls import reverse
 from rest_framework import serializers
-from labeler.models import Image
+from labeler.derivatives import SIZES
+from labeler.models import Image, ImageLabel
+from labeler.registry import label_registry
 
 
-class ImageSerializer(serializers.ModelSerializer):
+def split_param(request, name):
+    """ Comma-separated query parameter as a list of stripped, nonempty strings """
+    return [s.strip() for s in request.query_params.get(name, '').split(',') if s.strip()]
+
+
+class SparseFieldsMixin(object):
+    """ Serialize only the fields named in the `?fields=` query parameter and none of those in `?omit=`
+
+    Fields listed in `deferred_fields` (big blobs) are only serialized when named in `?fields=`.
+    The sparse fieldset only applies to GET requests, so writes still see every field.
+    M2M fields named in `prefetches` are prefetched with that Prefetch rather than as all their related objects.
+    """
+    deferred_fields = ()
+    prefetches = {}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        requested = self.requested_fields(self.context.get('request'), self.fields)
+        for name in set(self.fields) - set(requested):
+            self.fields.pop(name)
+
+    @classmethod
+    def requested_fields(cls, request, all_fields=None):
+        """ Names of the fields to serialize for this request, in serializer order """
+        all_fields = list(cls().fields) if all_fields is None else list(all_fields)
+        if request is None or request.method != 'GET':
+            return all_fields
+        fields, omit = split_param(request, 'fields'), set(split_param(request, 'omit'))
+        if not fields:
+            fields = [name for name in all_fields if name not in cls.deferred_fields]
+        return [name for name in all_fields if name in fields and name not in omit]
+
+    @classmethod
+    def sparse_queryset(cls, queryset, request, required=('id',)):
+        """ Only SELECT the columns that will be serialized (plus any `required` ones) and prefetch M2M fields """
+        model_fields = {f.name: f for f in queryset.model._meta.get_fields()}
+        fields = [name for name in cls.requested_fields(request) if name in model_fields] + list(required)
+        columns = [name for name in fields if model_fields[name].concrete and not model_fields[name].many_to_many]
+        m2m = [name for name in fields if model_fields[name].many_to_many]
+        return queryset.only(*columns).prefetch_related(*(cls.prefetches.get(name, name) for name in m2m))
+
+
+class LabelField(serializers.Field):
+    """ A Label foreign key serialized as its title and deserialized from a title or id, using the label registry
+
+    Neither direction queries the database.
+    """
+    default_error_messages = {
+        'does_not_exist': 'Invalid label "{value}" - label does not exist.',
+    }
+
+    def get_attribute(self, instance):
+        # the foreign key id rather than the related Label, which would cost a query per object
+        return getattr(instance, self.source + '_id')
+
+    def to_representation(self, value):
+        return label_registry.title(getattr(value, 'pk', value))
+
+    def to_internal_value(self, data):
+        label = label_registry.get(data) or label_registry.get_by_title(data)
+        if label is None:
+            self.fail('does_not_exist', value=data)
+        return label
+
+
+class ImageSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    """ Image serializer that leaves out the (big) EXIF `info` field unless it's requested with `?fields=...,info` """
+    deferred_fields = ('info',)
+    # the labels voted for: machine labels (labeler.preannotate) are only suggestions, see api/images/<pk>/suggestions/
+    label = serializers.SerializerMethodField()
+    prefetches = {'label': Prefetch('imagelabel_set', to_attr='votes', queryset=ImageLabel.objects.filter(
+        is_machine=False, label__isnull=False).only('image_id', 'label_id', 'is_machine').order_by('pk'))}
+    # DRF maps jsonfield.JSONField to a CharField, which would serialize the python repr of the EXIF dict
+    info = serializers.JSONField(required=False, allow_null=True)
+    # {size name: URL}, e.g. {"thumb": ".../images/42/thumb/", "medium": ".../images/42/medium/"}
+    derivatives = serializers.SerializerMethodField()
+
     class Meta:
         model = Image
         fields = '__all__'
 
+    def get_label(self, image):
+        if hasattr(image, 'votes'):
+            return [vote.label_id for vote in image.votes]
+        return list(ImageLabel.objects.filter(image=image, is_machine=False, label__isnull=False).order_by('pk')
+                    .values_list('label_id', flat=True))
+
+    def get_derivatives(self, image):
+        request = self.context.get('request')
+        urls = ((size, reverse('image_derivative', args=(image.pk, size))) for size in SIZES)
+        return {size: request.build_absolute_uri(url) if request else url for size, url in urls}
+
+
+class ImageLabelSerializer(serializers.ModelSerializer):
+    label = LabelField()
+
+    class Meta:
+        model = ImageLabel
+        fields = ('id', 'image', 'label', 'user', 'created_date', 'is_machine', 'confidence')
+        read_only_fields = ('user', 'created_date', 'is_machine', 'confidence')
+
+
+class VoteListSerializer(serializers.ListSerializer):
+    """ Validate a whole batch of votes with one query (for the images) and insert them with one bulk_create """
+
+    def to_internal_value(self, data):
+        votes = super().to_internal_value(data)
+        image_ids = set(vote['image_id'] for vote in votes)
+        found = set(Image.objects.filter(pk__in=image_ids).values_list('pk', flat=True))
+        if image_ids - found:
+            raise serializers.ValidationError([
+                {} if vote['image_id'] in found else
+                {'image': ['Invalid pk "{}" - object does not exist.'.format(vote['image_id'])]}
+                for vote in votes])
+        return votes
+
+    def create(self, validated_data):
+        # ImageLabel.objects.bulk_create() applies the TotalVotes increments in the same transaction
+        return ImageLabel.objects.bulk_create([ImageLabel(**vote) for vote in validated_data])
+
+
+class VoteSerializer(serializers.Serializer):
+    """ One vote (ImageLabel ballot) in a batch, the image as an id and the label as a title or id """
+    image = serializers.IntegerField(source='image_id', min_value=1)
+    label = LabelField()
+
+    class Meta:
+        list_serializer_class = VoteListSerializer
+
 
 class CustomeImageSerializer(serializers.Serializer):
     id = serializers.IntegerField(read_only=True)
@@ -0,0 +1,163 @@
+""" File storage that names each uploaded file by the SHA-256 hash of its content
+
+Uploading the same bytes twice stores them once: the second upload finds the blob already on disk,
+throws away its temporary copy and gets the same name back.
+Many Image records may share a blob, so a blob is only deleted once the last Image with its
+content_hash is deleted (see `labeler.models.release_image_blob`), and then only if no upload has reused it
+in the last LABELER_BLOB_GRACE seconds: that upload's Image may not be committed yet. Blobs skipped for that
+reason (or left behind by failed uploads) are removed later by `python manage.py sweep_blobs`.
+
+Enable it with `DEFAULT_FILE_STORAGE = 'labeler.storage.ContentAddressedStorage'`.
+"""
+import errno
+import hashlib
+import os
+import re
+import tempfile
+import time
+import uuid
+
+from django.conf import settings
+
+from django.core.files.storage import FileSystemStorage
+from django.core.files.move import file_move_safe
+
+HASH_NAME_REGEX = re.compile(r'(?:^|/)([0-9a-f]{64})(?:\.[^/]*)?$')
+CHUNK_SIZE = 64 * 2 ** 10
+BLOB_GRACE = 3600  # seconds, default for settings.LABELER_BLOB_GRACE
+
+
+def content_hash_from_name(name):
+    """ The SHA-256 hex digest embedded in a content-addressed file name, or '' for any other name
+
+    >>> content_hash_from_name('images/e3/b0/e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855.jpg')
+    'e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855'
+    >>> content_hash_from_name('images/HUNT0133.jpg')
+    ''
+    """
+    match = HASH_NAME_REGEX.search(name or '')
+    return match.group(1) if match else ''
+
+
+def hashed_name(name, content_hash):
+    """ Path for a blob: the original directory, two levels of hash prefix, then the hash and original extension
+
+    >>> hashed_name('images/HUNT0133.JPG', 'abcdef')
+    'images/ab/cd/abcdef.jpg'
+    """
+    dirname, basename = os.path.split(name)
+    ext = os.path.splitext(basename)[1].lower()
+    return '/'.join(s for s in (dirname, content_hash[:2], content_hash[2:4], content_hash + ext) if s)
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """ FileSystemStorage that stores each distinct file content once, under a name derived from its SHA-256 """
+    temp_dirname = '.incoming'
+    trash_dirname = '.trash'
+
+    def get_available_name(self, name, max_length=None):
+        # the name is replaced by the content hash in _save(), and an existing blob is reused rather than renamed
+        return name
+
+    def _save(self, name, content):
+        # labeler.uploadhandlers already hashed the upload as it streamed in
+        content_hash = getattr(content, 'content_hash', None)
+        if content_hash:
+            name = hashed_name(name, content_hash)
+            if self.exists(name) and self.touch(name):
+                return name  # a duplicate: nothing to write
+
+        if hasattr(content, 'temporary_file_path'):
+            # already on disk (large uploads): hash it in place (if need be) and move it, rather than copying it
+            path = content.temporary_file_path()
+            return self._commit(path, name if content_hash else hashed_name(name, self.hash_file(path)), move=True)
+
+        temp_dir = self.path(self.temp_dirname)
+        self.makedirs(temp_dir)
+        fd, temp_path = tempfile.mkstemp(dir=temp_dir)
+        try:
+            hasher = hashlib.sha256()
+            with os.fdopen(fd, 'wb') as fout:
+                for chunk in content.chunks(CHUNK_SIZE):
+                    if not content_hash:
+                        hasher.update(chunk)
+                    fout.write(chunk)
+            return self._commit(temp_path, name if content_hash else hashed_name(name, hasher.hexdigest()))
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def _commit(self, source_path, name, move=False):
+        """ Put the file at source_path into place as `name`, unless a blob with that name (content) already exists """
+        full_path = self.path(name)
+        if os.path.exists(full_path) and self.touch(name):
+            return name
+        self.makedirs(os.path.dirname(full_path))
+        if move:
+            file_move_safe(source_path, full_path, allow_overwrite=True)
+        else:
+            # atomic, so a concurrent upload of the same content can only ever replace it with identical bytes
+            os.replace(source_path, full_path)
+        if self.file_permissions_mode is not None:
+            os.chmod(full_path, self.file_permissions_mode)
+        return name
+
+    def touch(self, name):
+        """ Mark a blob as just (re)used, so delete_unreferenced() leaves it for a while, False if it's gone """
+        try:
+            os.utime(self.path(name))
+            return True
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+
+    def delete_unreferenced(self, name, is_referenced, grace=None):
+        """ Delete a blob unless is_referenced() or an upload reused it in the last `grace` seconds, True if deleted
+
+        The blob is moved aside before it's checked, so an upload of the same content that comes after the move
+        writes a fresh copy instead of reusing the one being deleted, and one that came before it has touched it.
+        """
+        grace = getattr(settings, 'LABELER_BLOB_GRACE', BLOB_GRACE) if grace is None else grace
+        full_path = self.path(name)
+        trash_dir = self.path(self.trash_dirname)
+        self.makedirs(trash_dir)
+        trash_path = os.path.join(trash_dir, uuid.uuid4().hex)
+        try:
+            os.rename(full_path, trash_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        try:
+            if time.time() - os.stat(trash_path).st_mtime < grace or is_referenced():
+                # put it back (over any identical copy an upload has written meanwhile)
+                os.replace(trash_path, full_path)
+                return False
+        except BaseException:
+            os.replace(trash_path, full_path)
+            raise
+        os.remove(trash_path)
+        return True
+
+    def makedirs(self, directory):
+        try:
+            if self.directory_permissions_mode is not None:
+                old_umask = os.umask(0)
+                try:
+                    os.makedirs(directory, self.directory_permissions_mode)
+                finally:
+                    os.umask(old_umask)
+            else:
+                os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    @staticmethod
+    def hash_file(path):
+        hasher = hashlib.sha256()
+        with open(path, 'rb') as fin:
+            for chunk in iter(lambda: fin.read(CHUNK_SIZE), b''):
+                hasher.update(chunk)
+        return hasher.hexdigest()
@@ -1,12 +1,35 @@
+import io
 import os
 import datetime
+import glob
+import hashlib
+import shutil
+import struct
+import tarfile
+import tempfile
+from unittest import mock
 
-from django.test import TestCase
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
+from rest_framework.test import APIClient
 # from django.core.urlresolvers import reverse
 
 import labeler_site.settings
-from .models import Image
+from .derivatives import derivatives_storage, derivative_name
+from .exif import pil_exif, read_exif
+from .models import Image, Label, ImageLabel, ImagePriority, TotalVotes
+from .registry import label_registry
+from .scheduler import next_images
+from .serializers import ImageLabelSerializer
+from .uploadhandlers import ImageSniffer
 
 import doctest
 from labeler_site import bot
@@ -17,6 +40,37 @@ from labeler_site import bot
 MEDIA_ROOT = labeler_site.settings.MEDIA_ROOT
 
 
+def make_jpeg(width=640, height=480, make=b'Bushnell', taken=b'2017:08:01 21:30:00',
+              latitude=((37, 1), (45, 1), (0, 1)), longitude=((122, 1), (30, 1), (0, 1))):
+    """ Bytes of a tiny JPEG with an EXIF segment (IFD0 Make, Exif DateTimeOriginal, GPS N/W) and no pixel data """
+    def ifd(offset, entries):
+        # entries: (tag, type, count, packed value), with values over 4 bytes placed after the directory
+        data_offset, head, data = offset + 2 + 12 * len(entries) + 4, struct.pack('<H', len(entries)), b''
+        for tag, field_type, count, value in entries:
+            if len(value) <= 4:
+                head += struct.pack('<HHL', tag, field_type, count) + value.ljust(4, b'\x00')
+            else:
+                head += struct.pack('<HHLL', tag, field_type, count, data_offset + len(data))
+                data += value
+        return head + b'\x00' * 4 + data
+
+    make, taken = make + b'\x00', taken + b'\x00'
+    exif_offset = 8 + 2 + 12 * 3 + 4 + len(make)
+    gps_offset = exif_offset + 2 + 12 + 4 + len(taken)
+    tiff = b'II*\x00' + struct.pack('<L', 8) + ifd(8, [
+        (0x010F, 2, len(make), make), (0x8769, 4, 1, struct.pack('<L', exif_offset)),
+        (0x8825, 4, 1, struct.pack('<L', gps_offset))])
+    tiff += ifd(exif_offset, [(0x9003, 2, len(taken), taken)])
+    tiff += ifd(gps_offset, [(1, 2, 2, b'N\x00'), (2, 5, 3, b''.join(struct.pack('<LL', *r) for r in latitude)),
+                             (3, 2, 2, b'W\x00'), (4, 5, 3, b''.join(struct.pack('<LL', *r) for r in longitude))])
+    app1 = b'Exif\x00\x00' + tiff
+    sof = struct.pack('>BHHB', 8, height, width, 3) + b'\x01\x22\x00\x02\x11\x01\x03\x11\x01'
+    return (b'\xff\xd8' + b'\xff\xe0' + struct.pack('>H', 16) + b'JFIF\x00' + b'\x00' * 9 +
+            b'\xff\xe1' + struct.pack('>H', len(app1) + 2) + app1 +
+            b'\xff\xc0' + struct.pack('>H', len(sof) + 2) + sof +
+            b'\xff\xda' + struct.pack('>H', 2) + b'\x12\x34' * 50 + b'\xff\xd9')
+
+
 class ImageModelTest(TestCase):
     fixtures = ['labeler_test_data.json']
     caption = "This is only a test ... image take 2.5 years ago."
@@ -36,6 +90,1113 @@ class ImageModelTest(TestCase):
         self.assertEqual(self.caption, image.caption)
 
 
+class TotalVotesTest(TestCase):
+    """ TotalVotes should track every change to the ImageLabel ballots """
+
+    def setUp(self):
+        self.user = User.objects.create(username='voter')
+        self.image = Image.objects.create(file='images/test_image.jpg')
+        self.coyote = Label.objects.create(title='coyote')
+        self.wolf = Label.objects.create(title='wolf')
+
+    def tally(self):
+        return dict(TotalVotes.objects.filter(image=self.image, votes__gt=0).values_list('name', 'votes'))
+
+    def test_save_and_delete(self):
+        vote = ImageLabel.objects.create(image=self.image, label=self.coyote, user=self.user)
+        ImageLabel.objects.create(image=self.image, label=self.coyote, user=self.user)
+        self.assertEqual(self.tally(), {'coyote': 2})
+        vote.label = self.wolf
+        vote.save()
+        self.assertEqual(self.tally(), {'coyote': 1, 'wolf': 1})
+        vote = ImageLabel.objects.get(pk=vote.pk)
+        vote.delete()
+        self.assertEqual(self.tally(), {'coyote': 1})
+
+    def test_bulk_operations(self):
+        ImageLabel.objects.bulk_create([ImageLabel(image=self.image, label=self.coyote, user=self.user)
+                                        for i in range(3)])
+        self.assertEqual(self.tally(), {'coyote': 3})
+        ImageLabel.objects.filter(pk__in=ImageLabel.objects.values_list('pk', flat=True)[:2]).update(label=self.wolf)
+        self.assertEqual(self.tally(), {'coyote': 1, 'wolf': 2})
+        ImageLabel.objects.filter(label=self.wolf).delete()
+        self.assertEqual(self.tally(), {'coyote': 1})
+
+    def test_rebuild_command(self):
+        ImageLabel.objects.create(image=self.image, label=self.coyote, user=self.user)
+        TotalVotes.objects.update(votes=42)
+        with self.assertRaises(CommandError):
+            call_command('rebuild_totalvotes', verify=True, stdout=open(os.devnull, 'w'))
+        call_command('rebuild_totalvotes', batch_size=1, stdout=open(os.devnull, 'w'))
+        self.assertEqual(self.tally(), {'coyote': 1})
+        call_command('rebuild_totalvotes', verify=True, stdout=open(os.devnull, 'w'))
+
+
+class LabelRegistryTest(TestCase):
+
+    def setUp(self):
+        # the Labels of earlier tests were rolled back without bumping the version (and their ids get reused)
+        label_registry.invalidate()
+
+    def test_lookups_are_cached_and_invalidated(self):
+        coyote = Label.objects.create(title='coyote', category='canine')
+        self.assertEqual(label_registry.title(coyote.id), 'coyote')
+        with self.assertNumQueries(0):
+            self.assertEqual(label_registry.category(coyote.id), 'canine')
+            self.assertEqual(label_registry.get_by_title('coyote'), coyote)
+            self.assertIn((coyote.id, 'coyote'), list(Image.ANIMAL_CHOICES))
+        coyote.title = 'wolf'
+        coyote.save()
+        self.assertEqual(label_registry.title(coyote.id), 'wolf')
+        coyote.delete()
+        self.assertIsNone(label_registry.get(coyote.id))
+
+    def test_label_missed_by_the_version_check_is_found(self):
+        label_registry.load()
+        # created by another process whose version bump this one won't see until the TTL is up (or was evicted)
+        with mock.patch.object(label_registry, 'invalidate'):
+            fox = Label.objects.create(title='fox')
+        self.assertEqual(label_registry.title(fox.id), 'fox')
+        with mock.patch.object(label_registry, 'invalidate'):
+            bobcat = Label.objects.create(title='bobcat')
+        self.assertEqual(label_registry.get_by_title('bobcat'), bobcat)
+        with mock.patch.object(label_registry, 'invalidate'):
+            lynx = Label.objects.create(title='lynx')
+        self.assertEqual(label_registry.titles({lynx.id, 12345}), {lynx.id: 'lynx'})
+        with self.assertNumQueries(1):
+            self.assertIsNone(label_registry.get(12345))
+
+    def test_version_is_checked_once_per_ttl(self):
+        label_registry.load()
+        with mock.patch('labeler.registry.cache') as shared:
+            for _ in range(3):
+                label_registry.title(1)
+            self.assertFalse(shared.get.called)
+            with override_settings(LABELER_LABEL_REGISTRY_TTL=0):
+                shared.get.return_value = label_registry._version
+                label_registry.title(1)
+            self.assertTrue(shared.get.called)
+
+    def test_label_field(self):
+        wolf = Label.objects.create(title='wolf')
+        image = Image.objects.create(file='images/test_image.jpg')
+        serializer = ImageLabelSerializer(data={'image': image.id, 'label': 'wolf'})
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        vote = serializer.save()
+        self.assertEqual(vote.label_id, wolf.id)
+        self.assertEqual(ImageLabelSerializer(ImageLabel.objects.get(pk=vote.pk)).data['label'], 'wolf')
+        self.assertFalse(ImageLabelSerializer(data={'image': image.id, 'label': 'unicorn'}).is_valid())
+
+
+class KeysetPaginationTest(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        an_hour_ago = timezone.now() - datetime.timedelta(hours=1)
+        self.images = [Image.objects.create(file='images/test_image{}.jpg'.format(i)) for i in range(5)]
+        for i, image in enumerate(self.images):
+            # two images share each timestamp so the id tie-breaker matters
+            Image.objects.filter(pk=image.pk).update(created_date=an_hour_ago + datetime.timedelta(seconds=i // 2))
+        self.newest_first = [image.pk for image in reversed(self.images)]
+
+    def test_walk_forward_and_back(self):
+        page = self.client.get('/api/images/', {'page_size': 2}).data
+        self.assertIsNone(page['previous'])
+        pks = [image['id'] for image in page['results']]
+        while page['next']:
+            page = self.client.get(page['next']).data
+            pks += [image['id'] for image in page['results']]
+        self.assertEqual(pks, self.newest_first)
+        page = self.client.get(page['previous']).data
+        self.assertEqual([image['id'] for image in page['results']], self.newest_first[2:4])
+
+    def test_stable_under_inserts(self):
+        first = self.client.get('/api/', {'page_size': 2}).data
+        Image.objects.create(file='images/test_image_new.jpg')
+        second = self.client.get(first['next']).data
+        self.assertEqual([image['id'] for image in second['results']], self.newest_first[2:4])
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get('/api/images/', {'cursor': 'garbage'}).status_code, 404)
+
+    def test_deep_page_seeks_the_index(self):
+        from labeler.pagination import Cursor, KeysetPagination
+        middle = Image.objects.get(pk=self.newest_first[2])
+        for reverse in (False, True):
+            queryset = KeysetPagination().seek(Image.objects.all(), Cursor(reverse, middle.created_date, middle.pk))
+            sql, params = queryset.query.sql_with_params()
+            with connection.cursor() as db:
+                db.execute('EXPLAIN QUERY PLAN ' + sql, params)
+                plan = ' '.join(str(row[-1]) for row in db.fetchall())
+            # a range seek on the index, not a scan of the whole table (or index) from the newest row
+            self.assertIn('SEARCH', plan)
+            self.assertIn('image_created_id_idx', plan)
+
+
+class SparseFieldsTest(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.image = Image.objects.create(file='images/test_image.jpg', caption='coyote?', info={'Make': 'Bushnell'})
+
+    def get_images(self, **params):
+        with CaptureQueriesContext(connection) as queries:
+            results = self.client.get('/api/images/', params).data['results']
+        return results, ' '.join(q['sql'] for q in queries)
+
+    def test_info_deferred_by_default(self):
+        results, sql = self.get_images()
+        self.assertNotIn('info', results[0])
+        self.assertIn('caption', results[0])
+        self.assertNotIn('"info"', sql)
+
+    def test_fields_and_omit(self):
+        results, sql = self.get_images(fields='id,info,caption', omit='caption')
+        self.assertEqual(set(results[0]), {'id', 'info'})
+        self.assertEqual(results[0]['info'], {'Make': 'Bushnell'})
+        self.assertNotIn('"caption"', sql)
+
+
+class BulkUploadTest(TestCase):
+    jpeg = b'\xff\xd8\xff\xe0\x00\x10JFIF\x00' + b'\x00' * 100 + b'\xff\xd9'
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def make_tar(self, members):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+            for name, data in members.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        return SimpleUploadedFile('card.tar.gz', buf.getvalue())
+
+    def test_files_and_archive(self):
+        response = APIClient().post('/api/images/bulk/', {
+            'file': [SimpleUploadedFile('a.jpg', self.jpeg), SimpleUploadedFile('b.jpg', self.jpeg)],
+            'archive': self.make_tar({'DCIM/c.jpg': self.jpeg, 'DCIM/d.JPG': self.jpeg, 'DCIM/notes.txt': b'hi'}),
+        }, format='multipart')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(response.data['created'], 4)
+        statuses = {r['name']: r['status'] for r in response.data['results']}
+        self.assertEqual(statuses['DCIM/notes.txt'], 'skipped')
+        ids = [r['id'] for r in response.data['results'] if r['status'] == 'created']
+        self.assertEqual(Image.objects.filter(id__in=ids).count(), 4)
+        for image in Image.objects.filter(id__in=ids):
+            self.assertTrue(os.path.isfile(os.path.join(self.media_root, image.file.name)))
+
+    def test_partial_failure(self):
+        response = APIClient().post('/api/images/bulk/', {
+            'file': [SimpleUploadedFile('a.jpg', self.jpeg)],
+            'archive': SimpleUploadedFile('broken.zip', b'PK\x03\x04 not really a zip'),
+        }, format='multipart')
+        self.assertEqual(response.status_code, 207, response.data)
+        self.assertEqual((response.data['created'], response.data['failed']), (1, 1))
+
+
+class VoteBatchTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='voter')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.images = [Image.objects.create(file='images/test_image{}.jpg'.format(i)) for i in range(3)]
+        self.coyote = Label.objects.create(title='coyote')
+        self.wolf = Label.objects.create(title='wolf')
+        label_registry.load()
+
+    def test_batch(self):
+        votes = [{'image': image.id, 'label': 'coyote'} for image in self.images]
+        votes.append({'image': self.images[0].id, 'label': self.wolf.id})
+        # 1 query to validate the images, 1 bulk INSERT and 1 UPDATE/INSERT per tally (plus the transaction savepoints)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/api/votes/', {'votes': votes}, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(len([q for q in queries if q['sql'].startswith('SELECT') and 'labeler_image"' in q['sql']]), 1)
+        self.assertEqual(ImageLabel.objects.filter(user=self.user).count(), 4)
+        self.assertEqual(dict(TotalVotes.objects.filter(image=self.images[0]).values_list('name', 'votes')),
+                         {'coyote': 1, 'wolf': 1})
+
+    def test_invalid_votes_rejected(self):
+        response = self.client.post('/api/votes/', [{'image': self.images[0].id, 'label': 'coyote'},
+                                                    {'image': 999999, 'label': 'coyote'}], format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data[0], {})
+        self.assertIn('image', response.data[1])
+        self.assertEqual(ImageLabel.objects.count(), 0)
+        self.assertEqual(APIClient().post('/api/votes/', [], format='json').status_code, 403)
+
+
+class ConsensusTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.images = [Image.objects.create(file='images/test_image{}.jpg'.format(i)) for i in range(3)]
+        coyote, wolf = Label.objects.create(title='coyote'), Label.objects.create(title='wolf')
+        ImageLabel.objects.bulk_create([ImageLabel(image=self.images[0], label=coyote) for i in range(3)] +
+                                       [ImageLabel(image=self.images[0], label=wolf),
+                                        ImageLabel(image=self.images[1], label=wolf)])
+        self.wolf = wolf
+
+    def test_batch_uses_cached_tallies(self):
+        ids = ','.join(str(image.id) for image in self.images)
+        with self.assertNumQueries(1):
+            data = self.client.get('/api/consensus/', {'images': ids, 'k': 1}).data
+        self.assertEqual(data[0], {'image': self.images[0].id, 'total_votes': 4, 'agreement': 0.75,
+                                   'labels': [{'label': 'coyote', 'votes': 3}]})
+        self.assertEqual(data[2]['total_votes'], 0)
+        with self.assertNumQueries(0):
+            self.client.get('/api/consensus/', {'images': ids})
+
+    def test_votes_invalidate_cache(self):
+        url = '/api/images/{}/consensus/'.format(self.images[1].id)
+        self.assertEqual(self.client.get(url).data['total_votes'], 1)
+        ImageLabel.objects.create(image=self.images[1], label=self.wolf)
+        self.assertEqual(self.client.get(url).data['labels'], [{'label': 'wolf', 'votes': 2}])
+
+
+class SchedulerTest(TestCase):
+
+    def setUp(self):
+        self.alice, self.bob = User.objects.create(username='alice'), User.objects.create(username='bob')
+        self.coyote, self.wolf = Label.objects.create(title='coyote'), Label.objects.create(title='wolf')
+        self.contested, self.agreed, self.fresh = [
+            Image.objects.create(file='images/test_image{}.jpg'.format(i)) for i in range(3)]
+        ImageLabel.objects.create(image=self.contested, label=self.coyote, user=self.bob)
+        ImageLabel.objects.create(image=self.contested, label=self.wolf, user=self.bob)
+        ImageLabel.objects.create(image=self.agreed, label=self.coyote, user=self.bob)
+        ImageLabel.objects.create(image=self.agreed, label=self.coyote, user=self.bob)
+
+    def test_priority_order(self):
+        self.assertEqual(ImagePriority.objects.get(image=self.contested).disagreement, 0.5)
+        self.assertEqual(next_images(self.alice, n=3), [self.fresh, self.contested, self.agreed])
+
+    def test_skips_voted_images_and_updates_incrementally(self):
+        ImageLabel.objects.create(image=self.fresh, label=self.wolf, user=self.alice)
+        self.assertEqual(next_images(self.alice, n=3), [self.contested, self.agreed])
+        ImageLabel.objects.create(image=self.fresh, label=self.coyote, user=self.bob)
+        self.assertEqual(ImagePriority.objects.get(image=self.fresh).total_votes, 2)
+        response = APIClient().get('/api/next/', {'n': 2})
+        self.assertEqual([image['id'] for image in response.data], [self.contested.id, self.fresh.id])
+
+
+class ContentAddressedStorageTest(TransactionTestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def upload(self, name, content):
+        return Image.objects.create(file=SimpleUploadedFile(name, content))
+
+    @override_settings(LABELER_BLOB_GRACE=0)
+    def test_duplicates_share_a_refcounted_blob(self):
+        first, second = self.upload('HUNT0133.JPG', b'same bytes'), self.upload('copy.jpg', b'same bytes')
+        other = self.upload('other.jpg', b'other bytes')
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertEqual(len(first.content_hash), 64)
+        self.assertTrue(first.file.name.endswith(first.content_hash + '.jpg'))
+        self.assertNotEqual(first.content_hash, other.content_hash)
+        path = os.path.join(self.media_root, first.file.name)
+        first.delete()
+        self.assertTrue(os.path.isfile(path))
+        second.delete()
+        self.assertFalse(os.path.isfile(path))
+        self.assertTrue(os.path.isfile(os.path.join(self.media_root, other.file.name)))
+
+    def test_recently_reused_blob_is_left_for_the_sweep(self):
+        image = self.upload('HUNT0133.JPG', b'same bytes')
+        path = os.path.join(self.media_root, image.file.name)
+        image.delete()
+        self.assertTrue(os.path.isfile(path))
+        self.upload('copy.jpg', b'same bytes')
+        call_command('sweep_blobs', grace=0, stdout=io.StringIO())
+        self.assertTrue(os.path.isfile(path))
+        Image.objects.all().delete()
+        call_command('sweep_blobs', stdout=io.StringIO())
+        self.assertTrue(os.path.isfile(path))
+        call_command('sweep_blobs', grace=0, stdout=io.StringIO())
+        self.assertFalse(os.path.isfile(path))
+
+    def test_sweep_leaves_the_derivatives_alone(self):
+        image = self.upload('HUNT0133.JPG', b'same bytes')
+        thumb = derivatives_storage().save(derivative_name(image.content_hash, 'thumb'), ContentFile(b'thumbnail'))
+        legacy = derivatives_storage().save(derivative_name('ab' * 32, 'medium'), ContentFile(b'preview'))
+        Image.objects.all().delete()
+        call_command('sweep_blobs', grace=0, stdout=io.StringIO())
+        self.assertTrue(derivatives_storage().exists(thumb))
+        self.assertTrue(derivatives_storage().exists(legacy))
+
+    def test_upload_during_delete_keeps_its_blob(self):
+        from django.core.files.storage import default_storage
+
+        image = self.upload('HUNT0133.JPG', b'same bytes')
+        Image.objects.filter(pk=image.pk).delete()
+        uploads = []
+
+        def is_referenced():
+            # a duplicate upload that finds the blob already moved aside, and commits after the reference check
+            uploads.append(self.upload('copy.jpg', b'same bytes'))
+            return False
+        self.assertTrue(default_storage.delete_unreferenced(image.file.name, is_referenced, grace=0))
+        self.assertEqual(uploads[0].file.name, image.file.name)
+        with default_storage.open(image.file.name) as fin:
+            self.assertEqual(fin.read(), b'same bytes')
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class UploadHandlerTest(TestCase):
+
+    def test_sniffer_is_chunk_size_independent(self):
+        jpeg = make_jpeg()
+        for chunk_size in (1, 7, 64, len(jpeg)):
+            sniffer = ImageSniffer()
+            for i in range(0, len(jpeg), chunk_size):
+                sniffer.feed(jpeg[i:i + chunk_size])
+            sniffer.finish()
+            self.assertEqual((sniffer.image_format, sniffer.image_size), ('jpeg', (640, 480)))
+            self.assertEqual(sniffer.exif['Make'], 'Bushnell')
+            self.assertEqual(sniffer.exif['GPSInfo']['GPSLatitude'], ((37, 1), (45, 1), (0, 1)))
+            self.assertEqual(sniffer.content_hash, hashlib.sha256(jpeg).hexdigest())
+
+    def test_upload_populates_info_and_taken_date(self):
+        response = self.client.post('/upload/', {'caption': 'coyote', 'file': SimpleUploadedFile('a.jpg', make_jpeg())})
+        self.assertEqual(response.status_code, 302)
+        image = Image.objects.get(caption='coyote')
+        self.assertEqual(image.content_hash, hashlib.sha256(make_jpeg()).hexdigest())
+        self.assertEqual(image.info['Make'], 'Bushnell')
+        self.assertEqual(image.info['GPSInfo']['GPSLatitudeRef'], 'N')
+        self.assertEqual(timezone.localtime(image.taken_date).replace(tzinfo=None),
+                         datetime.datetime(2017, 8, 1, 21, 30))
+        self.assertEqual((image.latitude, image.longitude, image.camera_make), (37.75, -122.5, 'bushnell'))
+
+    @override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=0)
+    def test_large_upload_moved_from_temp_file(self):
+        self.test_upload_populates_info_and_taken_date()
+
+    def test_rejects_files_that_are_not_images(self):
+        response = self.client.post('/upload/', {'caption': 'notes', 'file': SimpleUploadedFile('a.jpg', b'hello')})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('file', response.context['form'].errors)
+        self.assertFalse(Image.objects.filter(caption='notes').exists())
+
+
+class ExifTest(SimpleTestCase):
+
+    def test_same_tags_as_pil(self):
+        try:
+            import PIL  # noqa
+        except ImportError:
+            self.skipTest('PIL is not installed')
+        for path in glob.glob(os.path.join(os.path.dirname(__file__), 'data', '*.jpg')):
+            fast, slow = read_exif(path), pil_exif(path)
+            self.assertEqual(set(fast), set(slow), path)
+            for name, value in fast.items():
+                if isinstance(value, tuple) and value and isinstance(value[0], tuple):
+                    value = tuple(num / den if den else 0 for num, den in value)
+                elif (isinstance(value, tuple) and len(value) == 2 and name in slow
+                      and not isinstance(slow[name], tuple)):
+                    value = value[0] / value[1] if value[1] else 0
+                if name != 'GPSInfo':
+                    self.assertAlmostEqual(value, slow[name], msg='{} {}'.format(path, name))
+
+
+class BackfillExifTest(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        self.checkpoint = os.path.join(self.media_root, 'checkpoint')
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def add_image(self, name, content=None):
+        if content is not None:
+            os.makedirs(os.path.join(self.media_root, 'images'), exist_ok=True)
+            with open(os.path.join(self.media_root, 'images', name), 'wb') as fout:
+                fout.write(content)
+        return Image.objects.create(file='images/' + name)
+
+    def backfill(self, **options):
+        call_command('backfill_exif', checkpoint=self.checkpoint, stdout=io.StringIO(), stderr=io.StringIO(),
+                     **options)
+
+    def test_backfill(self):
+        trail_cam = self.add_image('trail_cam.jpg', make_jpeg())
+        screenshot = self.add_image('screenshot.gif', b'GIF89a\x40\x01\xf0\x00' + b'\x00' * 20)
+        missing = self.add_image('missing.jpg')
+        for workers in (0, 2):
+            Image.objects.update(info=None, taken_date=None)
+            self.backfill(workers=workers, batch_size=2)
+            trail_cam.refresh_from_db()
+            self.assertEqual(trail_cam.info['Make'], 'Bushnell')
+            self.assertEqual(timezone.localtime(trail_cam.taken_date).hour, 21)
+            self.assertEqual(Image.objects.get(pk=screenshot.pk).info, {})
+            self.assertIsNone(Image.objects.get(pk=missing.pk).info)
+        with open(self.checkpoint) as fin:
+            self.assertEqual(fin.read(), '{} exif'.format(missing.pk))
+
+    def test_resume(self):
+        first, second = self.add_image('a.jpg', make_jpeg()), self.add_image('b.jpg', make_jpeg())
+        with open(self.checkpoint, 'w') as fout:
+            fout.write(str(first.pk))
+        self.backfill(workers=0, resume=True)
+        self.assertIsNone(Image.objects.get(pk=first.pk).info)
+        self.assertEqual(Image.objects.get(pk=second.pk).info['Make'], 'Bushnell')
+
+    def test_columns_from_info(self):
+        image = self.add_image('gone.jpg')
+        Image.objects.filter(pk=image.pk).update(info={'Make': 'Reconyx', 'Model': 'HC600', 'GPSInfo': {
+            'GPSLatitude': [[45, 1], [30, 1], [0, 1]], 'GPSLatitudeRef': 'S',
+            'GPSLongitude': [[170, 1], [15, 1], [0, 1]], 'GPSLongitudeRef': 'E'}})
+        self.backfill(from_info=True)
+        image.refresh_from_db()
+        self.assertEqual((image.latitude, image.longitude), (-45.5, 170.25))
+        self.assertEqual((image.camera_make, image.camera_model), ('reconyx', 'hc600'))
+        # a checkpoint from one mode can't be resumed by the other
+        with self.assertRaises(CommandError):
+            self.backfill(workers=0, resume=True)
+
+    def test_updates_fit_the_query_parameter_limit(self):
+        from .management.commands.backfill_exif import rows_per_update
+
+        images = [self.add_image('{}.jpg'.format(i), make_jpeg()) for i in range(5)]
+        with mock.patch('labeler.management.commands.backfill_exif.max_query_params', return_value=40):
+            with CaptureQueriesContext(connection) as queries:
+                self.backfill(workers=0, batch_size=10)
+        self.assertEqual(rows_per_update(6, max_params=40), 3)
+        updates = [q['sql'] for q in queries.captured_queries if q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 2)
+        self.assertEqual(Image.objects.filter(pk__in=[i.pk for i in images], camera_make='bushnell').count(), 5)
+
+
+class ImageFilterTest(TestCase):
+
+    def setUp(self):
+        self.images = {name: Image.objects.create(caption=name, file='images/{}.jpg'.format(name), **fields)
+                       for name, fields in (
+            ('portland', dict(latitude=45.52, longitude=-122.68, camera_make='bushnell', camera_model='trophy cam',
+                              taken_date=timezone.make_aware(datetime.datetime(2017, 8, 1, 21, 30)))),
+            ('fiji', dict(latitude=-17.7, longitude=178.1, camera_make='reconyx', camera_model='hc600',
+                          taken_date=timezone.make_aware(datetime.datetime(2016, 1, 5, 6, 0)))),
+            ('samoa', dict(latitude=-13.8, longitude=-171.8, camera_make='reconyx', camera_model='hc500')),
+            ('scan', dict()))}
+
+    def captions(self, query):
+        response = self.client.get('/api/images/?fields=caption&' + query)
+        self.assertEqual(response.status_code, 200, response.content)
+        return sorted(img['caption'] for img in response.json()['results'])
+
+    def test_bbox(self):
+        self.assertEqual(self.captions('bbox=-125,40,-120,50'), ['portland'])
+        self.assertEqual(self.captions('bbox=175,-20,-170,-10'), ['fiji', 'samoa'])  # across the antimeridian
+        self.assertEqual(self.client.get('/api/images/?bbox=1,2,3').status_code, 400)
+        self.assertEqual(self.client.get('/api/images/?bbox=0,10,1,5').status_code, 400)
+
+    def test_camera_and_taken_date(self):
+        self.assertEqual(self.captions('camera_make=reconyx'), ['fiji', 'samoa'])
+        self.assertEqual(self.captions('camera_make=Reconyx&camera_model=HC600'), ['fiji'])
+        with CaptureQueriesContext(connection) as queries:
+            self.captions('camera_make=Reconyx')
+        sql = ' '.join(q['sql'] for q in queries.captured_queries)
+        self.assertNotIn('UPPER', sql)  # an exact match, that can use image_camera_idx (or image_camera_model_idx)
+        self.assertNotIn('LIKE', sql)
+        self.assertEqual(self.captions('camera_model=HC500'), ['samoa'])
+        sql, params = Image.objects.filter(camera_model='hc500').query.sql_with_params()
+        with connection.cursor() as db:
+            db.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            self.assertIn('image_camera_model_idx', ' '.join(str(row[-1]) for row in db.fetchall()))
+        self.assertEqual(self.captions('taken_after=2017-01-01'), ['portland'])
+        self.assertEqual(self.captions('taken_before=2016-01-05'), ['fiji'])
+        self.assertEqual(self.client.get('/api/images/?taken_after=yesterday').status_code, 400)
+
+
+class YoloDecodeTest(SimpleTestCase):
+
+    def test_same_boxes_as_scalar_loop(self):
+        try:
+            import numpy as np
+        except ImportError:
+            self.skipTest('numpy is not installed')
+        from . import yolo_decode
+
+        rs = np.random.RandomState(0)
+        for _ in range(3):
+            netout = rs.normal(scale=2, size=(5, 5, yolo_decode.BOX, 4 + 1 + yolo_decode.CLASS))
+            detections = yolo_decode.decode_netout(netout)
+            boxes = yolo_decode.decode_netout_boxes(netout)
+            self.assertGreater(len(boxes), 0)
+            expected = sorted((b.x, b.y, b.w, b.h, np.argmax(b.probs), np.max(b.probs)) for b in boxes)
+            actual = sorted(tuple(xywh) + (label, score)
+                            for xywh, label, score in zip(detections.xywh, detections.labels, detections.scores))
+            self.assertEqual(len(actual), len(expected))
+            for a, e in zip(actual, expected):
+                np.testing.assert_allclose(a, e)
+        self.assertEqual(doctest.testmod(yolo_decode).failed, 0)
+
+
+class NmsTest(SimpleTestCase):
+
+    def setUp(self):
+        try:
+            import numpy as np
+        except ImportError:
+            self.skipTest('numpy is not installed')
+        rs = np.random.RandomState(0)
+        self.xywh = np.concatenate([rs.uniform(.2, .8, size=(40, 2)), rs.uniform(.05, .4, size=(40, 2))], axis=1)
+        self.scores = rs.uniform(size=40)
+        self.classes = rs.randint(3, size=40)
+
+    def bound_boxes(self):
+        from .yolo_decode import BoundBox
+        boxes = []
+        for x, y, w, h in self.xywh:
+            box = BoundBox(1)
+            box.x, box.y, box.w, box.h = x, y, w, h
+            boxes.append(box)
+        return boxes
+
+    def reference_nms(self, indices):
+        """ Greedy suppression of the boxes at indices, one BoundBox.iou() call per pair """
+        boxes, keep = self.bound_boxes(), []
+        for i in sorted(indices, key=lambda i: -self.scores[i]):
+            if all(boxes[k].iou(boxes[i]) < 0.4 for k in keep):
+                keep.append(i)
+        return keep
+
+    def test_iou_matrix_matches_bound_box_iou(self):
+        import numpy as np
+        from .nms import iou_matrix
+
+        boxes = self.bound_boxes()
+        expected = [[a.iou(b) for b in boxes] for a in boxes]
+        np.testing.assert_allclose(iou_matrix(self.xywh), expected)
+        np.testing.assert_allclose(iou_matrix(self.xywh[:3], self.xywh), expected[:3])
+
+    def test_nms(self):
+        from . import nms
+
+        self.assertEqual(nms.nms(self.xywh, self.scores).tolist(), self.reference_nms(range(40)))
+        per_class = nms.nms(self.xywh, self.scores, classes=self.classes).tolist()
+        expected = sum((self.reference_nms([i for i in range(40) if self.classes[i] == c]) for c in range(3)), [])
+        self.assertEqual(per_class, sorted(expected, key=lambda i: -self.scores[i]))
+        self.assertEqual(nms.nms(self.xywh, self.scores, score_threshold=2.).tolist(), [])
+        self.assertEqual(doctest.testmod(nms).failed, 0)
+
+    def test_batched_nms(self):
+        import numpy as np
+        from .nms import batched_nms, nms
+
+        image_ids = np.arange(40) // 10
+        expected = np.concatenate([10 * i + nms(self.xywh[10 * i:10 * (i + 1)], self.scores[10 * i:10 * (i + 1)],
+                                                classes=self.classes[10 * i:10 * (i + 1)]) for i in range(4)])
+        actual = batched_nms(self.xywh, self.scores, image_ids, classes=self.classes)
+        self.assertEqual(sorted(actual.tolist()), sorted(expected.tolist()))
+        self.assertTrue(np.all(np.diff(self.scores[actual]) <= 0))
+
+
+class FakeYoloModel(object):
+    """ Stands in for the Keras model: one 'dog' in the middle of every image, and a record of each batch """
+    loads, batch_sizes = 0, []
+
+    def __init__(self, weights_path=None):
+        FakeYoloModel.loads += 1
+
+    def predict(self, batch):
+        import numpy as np
+        FakeYoloModel.batch_sizes.append(len(batch))
+        netout = np.zeros((len(batch), 13, 13, 5, 25))
+        netout[:, 6, 6, 0, 4], netout[:, 6, 6, 0, 5 + 11] = 5., 10.
+        return netout
+
+
+@override_settings(LABELER_DETECTION_WEIGHTS='tiny-yolo-voc.weights',
+                   LABELER_DETECTION_MODEL_LOADER='labeler.tests.FakeYoloModel')
+class DetectionTest(TestCase):
+
+    def setUp(self):
+        try:
+            import numpy  # noqa
+            import PIL.Image
+        except ImportError:
+            self.skipTest('numpy or PIL is not installed')
+        from .detection import reset_detector
+        reset_detector()
+        FakeYoloModel.loads, FakeYoloModel.batch_sizes = 0, []
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        os.makedirs(os.path.join(self.media_root, 'images'))
+        PIL.Image.new('RGB', (640, 480), (90, 120, 60)).save(os.path.join(self.media_root, 'images', 'dog.jpg'))
+        self.image = Image.objects.create(file='images/dog.jpg')
+
+    def tearDown(self):
+        from .detection import reset_detector
+        reset_detector()
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def test_micro_batches(self):
+        import numpy as np
+        from .detection import BatchingPredictor
+
+        predictor = BatchingPredictor(FakeYoloModel, max_batch_size=4, max_wait=0.5)
+        futures = [predictor.submit(np.zeros((416, 416, 3))) for _ in range(10)]
+        self.assertEqual([f.result(timeout=10).shape for f in futures], [(13, 13, 5, 25)] * 10)
+        self.assertEqual(FakeYoloModel.loads, 1)
+        self.assertEqual(sum(predictor.batch_sizes), 10)
+        self.assertLessEqual(max(predictor.batch_sizes), 4)
+        self.assertLess(len(predictor.batch_sizes), 10)
+
+    def test_detections_endpoint(self):
+        for _ in range(2):
+            response = self.client.get('/api/images/{}/detections/'.format(self.image.pk))
+            self.assertEqual(response.status_code, 200, response.content)
+            detections = response.json()['detections']
+            self.assertEqual([d['label'] for d in detections], ['dog'])
+            self.assertAlmostEqual(detections[0]['x'], 6.5 / 13, places=2)
+            self.assertEqual(detections[0]['xmin'], int((6.5 - 1.08 / 2) / 13 * 640))
+        self.assertEqual(FakeYoloModel.loads, 1)
+        self.assertEqual(self.client.get('/api/images/999999/detections/').status_code, 404)
+
+    def test_load_failure_backs_off(self):
+        import numpy as np
+        from .detection import BatchingPredictor, DetectionUnavailable
+
+        attempts = []
+
+        def broken_model():
+            attempts.append(1)
+            raise IOError('no such weights file')
+        predictor = BatchingPredictor(broken_model, retry_after=60)
+        with self.assertRaises(DetectionUnavailable):
+            predictor.predict(np.zeros((416, 416, 3)), timeout=10)
+        for _ in range(3):
+            with self.assertRaises(DetectionUnavailable):
+                predictor.submit(np.zeros((416, 416, 3)))
+        self.assertEqual(len(attempts), 1)
+        predictor.load_failed_at -= 61
+        predictor.load_model = FakeYoloModel
+        self.assertEqual(predictor.predict(np.zeros((416, 416, 3)), timeout=10).shape, (13, 13, 5, 25))
+
+    def test_disabled(self):
+        with override_settings(LABELER_DETECTION_WEIGHTS=None):
+            response = self.client.get('/api/images/{}/detections/'.format(self.image.pk))
+        self.assertEqual(response.status_code, 503)
+
+
+def fake_predictions(images):
+    """ A stand-in for labeler.preannotate.yolo_predictions that sees the same things in every image """
+    return [[('dog', .9), ('person', .8), ('cat', .1)] for _ in images]
+
+
+class PreannotateTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.checkpoint = os.path.join(tempfile.mkdtemp(), 'checkpoint')
+        self.dog, self.cat = Label.objects.create(title='dog'), Label.objects.create(title='cat')
+        self.images = [Image.objects.create(file='images/{}.jpg'.format(i)) for i in range(3)]
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.checkpoint))
+
+    def preannotate(self):
+        call_command('preannotate', predictor='labeler.tests.fake_predictions', checkpoint=self.checkpoint,
+                     batch_size=2, stdout=io.StringIO())
+
+    def test_machine_labels_are_not_votes(self):
+        self.preannotate()
+        self.preannotate()  # images with machine labels are skipped
+        machine_labels = ImageLabel.objects.filter(is_machine=True)
+        self.assertEqual(sorted(machine_labels.values_list('image_id', 'label_id', 'confidence')),
+                         [(image.pk, self.dog.pk, 0.9) for image in self.images])
+        self.assertFalse(TotalVotes.objects.filter(votes__gt=0).exists())
+        self.assertEqual(ImagePriority.objects.get(image=self.images[0]).total_votes, 0)
+        self.assertEqual(self.client.get('/api/images/{}/consensus/'.format(self.images[0].pk)).data['total_votes'], 0)
+
+        response = self.client.get('/api/images/{}/suggestions/'.format(self.images[0].pk))
+        self.assertEqual(response.json()['suggestions'], [{'label': 'dog', 'confidence': 0.9}])
+
+    def test_image_labels_are_votes_only(self):
+        before = self.client.get('/api/images/{}/'.format(self.images[0].pk))
+        ImageLabel.objects.create(image=self.images[1], label=self.cat)
+        self.preannotate()
+        self.assertEqual(self.client.get('/api/images/{}/'.format(self.images[0].pk),
+                                         HTTP_IF_NONE_MATCH=before['ETag']).status_code, 200)
+        with self.assertNumQueries(3):  # the list validators, the page, its votes
+            images = {image['id']: image['label'] for image in self.client.get('/api/images/').data['results']}
+        self.assertEqual(images, {self.images[0].pk: [], self.images[1].pk: [self.cat.pk], self.images[2].pk: []})
+        self.assertEqual(self.client.get('/api/images/{}/'.format(self.images[1].pk)).data['label'], [self.cat.pk])
+
+    def test_confirming_a_machine_label_makes_it_a_vote(self):
+        self.preannotate()
+        ImageLabel.objects.filter(image=self.images[0], is_machine=True).update(is_machine=False)
+        self.assertEqual(TotalVotes.objects.get(image=self.images[0], name='dog').votes, 1)
+        self.assertEqual(self.client.get('/api/images/{}/consensus/'.format(self.images[0].pk)).data['total_votes'], 1)
+
+
+class DarknetTest(SimpleTestCase):
+    layers = [('conv2d_1', [(3, 3, 3, 4)]), ('batch_normalization_1', [(4,)] * 4), ('leaky_re_lu_1', []),
+              ('conv2d_2', [(1, 1, 4, 5), (5,)])]
+
+    def setUp(self):
+        try:
+            import numpy as np
+        except ImportError:
+            self.skipTest('numpy is not installed')
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.weights_path = os.path.join(self.tmpdir, 'tiny.weights')
+        size = 4 * 4 + 3 * 3 * 3 * 4 + 5 + 4 * 5
+        values = np.random.RandomState(0).normal(size=size).astype('float32')
+        with open(self.weights_path, 'wb') as fout:
+            fout.write(np.array([0, 2, 0, 0], dtype='int32').tobytes() + values.tobytes())
+
+    def expected(self):
+        """ The converted weights, as the original (whole-file, per-layer) loader read them """
+        import numpy as np
+
+        all_weights, offset = np.fromfile(self.weights_path, dtype='float32'), 4
+
+        def read(size):
+            nonlocal offset
+            offset += size
+            return all_weights[offset - size:offset]
+
+        beta, gamma, mean, var = (read(4) for _ in range(4))
+        kernel1 = read(3 * 3 * 3 * 4).reshape((4, 3, 3, 3)).transpose([2, 3, 1, 0])
+        bias2 = read(5)
+        kernel2 = read(4 * 5).reshape((5, 4, 1, 1)).transpose([2, 3, 1, 0])
+        return {'batch_normalization_1': [gamma, beta, mean, var], 'conv2d_1': [kernel1], 'conv2d_2': [kernel2, bias2]}
+
+    def assertConverted(self, converted):
+        import numpy as np
+
+        expected = self.expected()
+        self.assertEqual(list(converted), ['batch_normalization_1', 'conv2d_1', 'conv2d_2'])
+        for name, arrays in converted.items():
+            self.assertEqual(len(arrays), len(expected[name]))
+            for array, reference in zip(arrays, expected[name]):
+                self.assertEqual(array.shape, reference.shape)
+                np.testing.assert_array_equal(array, reference)
+
+    def test_same_weights_as_whole_file_reader(self):
+        from . import darknet
+
+        plan = darknet.conversion_plan(self.layers)
+        self.assertConverted(darknet.load_converted(self.weights_path, plan, use_cache=False))
+        cache_dir = os.path.join(self.tmpdir, 'cache')
+        self.assertConverted(darknet.load_converted(self.weights_path, plan, cache_dir=cache_dir))
+        path = darknet.cache_path(self.weights_path, plan, cache_dir=cache_dir)
+        self.assertEqual(sorted(os.listdir(cache_dir)), sorted([os.path.basename(path), 'tiny.weights.sha256']))
+        self.assertConverted(darknet.load_converted(self.weights_path, plan, cache_dir=cache_dir))
+        self.assertEqual(doctest.testmod(darknet).failed, 0)
+
+    def test_cache_is_keyed_by_content(self):
+        from . import darknet
+
+        plan = darknet.conversion_plan(self.layers)
+        path = darknet.cache_path(self.weights_path, plan)
+        with open(self.weights_path, 'r+b') as fout:
+            fout.seek(20)
+            fout.write(b'\x00\x00\x80\x3f')
+        os.utime(self.weights_path, ns=(0, os.stat(self.weights_path).st_mtime_ns + 10 ** 9))
+        self.assertNotEqual(darknet.cache_path(self.weights_path, plan), path)
+        self.assertConverted(darknet.load_converted(self.weights_path, plan))
+
+    def test_short_file(self):
+        from . import darknet
+
+        with open(self.weights_path, 'r+b') as fout:
+            fout.truncate(100)
+        with self.assertRaises(ValueError):
+            darknet.load_converted(self.weights_path, darknet.conversion_plan(self.layers), use_cache=False)
+
+
+VOC_XML = """<annotation>
+  <folder>VOC2012</folder><filename>{filename}</filename>
+  <size><width>500</width><height>375</height><depth>3</depth></size>
+  {objects}
+</annotation>"""
+VOC_OBJECT = """<object><name>{name}</name><pose>Left</pose><truncated>0</truncated><difficult>0</difficult>
+    <bndbox><xmin>{xmin}</xmin><ymin>20.6</ymin><xmax>{xmax}</xmax><ymax>200</ymax></bndbox>{parts}</object>"""
+VOC_PART = "<part><name>head</name><bndbox><xmin>1</xmin><ymin>2</ymin><xmax>3</xmax><ymax>4</ymax></bndbox></part>"
+
+
+class VocIndexTest(SimpleTestCase):
+
+    def setUp(self):
+        try:
+            import numpy  # noqa
+        except ImportError:
+            self.skipTest('numpy is not installed')
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.ann_dir = os.path.join(self.tmpdir, 'Annotations')
+        os.mkdir(self.ann_dir)
+        self.write('a.xml', 'a.jpg', [('person', 10, 100, VOC_PART), ('unicorn', 5, 50, '')])
+        self.write('b.xml', 'b.jpg', [('dog', 30, 300, ''), ('cat', 40, 400, '')])
+        self.write('c.xml', 'c.jpg', [])
+
+    def write(self, name, filename, objects, mtime_ns=None):
+        path = os.path.join(self.ann_dir, name)
+        with open(path, 'w') as fout:
+            fout.write(VOC_XML.format(filename=filename, objects='\n'.join(
+                VOC_OBJECT.format(name=obj, xmin=xmin, xmax=xmax, parts=parts) for obj, xmin, xmax, parts in objects)))
+        if mtime_ns is not None:
+            os.utime(path, ns=(mtime_ns, mtime_ns))
+
+    def box(self, name, xmin, xmax):
+        return {'name': name, 'xmin': xmin, 'ymin': 21, 'xmax': xmax, 'ymax': 200}
+
+    def image(self, filename, *boxes):
+        return {'filename': filename, 'width': 500, 'height': 375, 'object': [self.box(*box) for box in boxes]}
+
+    def test_index(self):
+        from .voc_index import to_dicts, update_index
+
+        self.assertEqual(to_dicts(update_index(self.ann_dir)), [
+            self.image('a.jpg', ('person', 10, 100)),
+            self.image('b.jpg', ('dog', 30, 300), ('cat', 40, 400)),
+            self.image('c.jpg')])
+        self.assertTrue(os.path.exists(self.ann_dir + '.index.npz'))
+
+    def test_box_missing_a_coordinate_is_skipped(self):
+        from .voc_index import to_dicts, update_index
+
+        with open(os.path.join(self.ann_dir, 'b.xml')) as fin:
+            xml = fin.read()
+        with open(os.path.join(self.ann_dir, 'b.xml'), 'w') as fout:
+            fout.write(xml.replace('<xmin>30</xmin>', '', 1).replace('<xmin>40</xmin>', '<xmin>n/a</xmin>', 1))
+        with self.assertLogs('labeler.voc_index', 'WARNING') as logs:
+            images = to_dicts(update_index(self.ann_dir))
+        self.assertEqual(images[1], self.image('b.jpg'))
+        self.assertEqual(len(logs.output), 2)
+        self.assertIn('b.xml', logs.output[0])
+
+    def test_only_changed_files_are_parsed(self):
+        from .voc_index import to_dicts, update_index
+
+        update_index(self.ann_dir)
+        # an unchanged (mtime and size) file that would fail to parse isn't read again
+        path = os.path.join(self.ann_dir, 'a.xml')
+        stat = os.stat(path)
+        with open(path, 'r+') as fout:
+            fout.write('x')
+        os.utime(path, ns=(stat.st_mtime_ns, stat.st_mtime_ns))
+        self.write('b.xml', 'b.jpg', [('dog', 31, 301, '')], mtime_ns=stat.st_mtime_ns + 10 ** 9)
+        os.remove(os.path.join(self.ann_dir, 'c.xml'))
+        self.write('d.xml', 'd.jpg', [('horse', 1, 2, '')])
+        expected = [self.image('a.jpg', ('person', 10, 100)), self.image('b.jpg', ('dog', 31, 301)),
+                    self.image('d.jpg', ('horse', 1, 2))]
+        self.assertEqual(to_dicts(update_index(self.ann_dir)), expected)
+        self.assertEqual(to_dicts(update_index(self.ann_dir)), expected)
+
+
+class DerivativesTest(TestCase):
+    photo = os.path.join(os.path.dirname(__file__), 'data', 'HUNT0133.jpg')
+
+    def setUp(self):
+        try:
+            import PIL.Image  # noqa
+        except ImportError:
+            self.skipTest('PIL is not installed')
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def read_photo(self):
+        with open(self.photo, 'rb') as fin:
+            return fin.read()
+
+    def test_generated_on_first_request_then_cached(self):
+        import PIL.Image
+        image = Image.objects.create(file=SimpleUploadedFile('HUNT0133.jpg', self.read_photo()))
+        name = derivative_name(image.content_hash, 'thumb')
+        response = self.client.get('/images/{}/thumb/'.format(image.pk))
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['Location'].endswith(name))
+        path = derivatives_storage().path(name)
+        self.assertLessEqual(max(PIL.Image.open(path).size), 160)
+        os.utime(path, (0, 0))
+        self.client.get('/images/{}/thumb/'.format(image.pk))
+        self.assertEqual(os.path.getmtime(path), 0)
+        self.assertEqual(self.client.get('/images/{}/huge/'.format(image.pk)).status_code, 404)
+        self.assertContains(self.client.get('/'), 'src="/images/{}/thumb/"'.format(image.pk))
+
+    def test_urls_in_api(self):
+        image = Image.objects.create(file=SimpleUploadedFile('HUNT0133.jpg', self.read_photo()))
+        results = APIClient().get('/api/images/').data['results']
+        self.assertTrue(results[0]['derivatives']['thumb'].endswith('/images/{}/thumb/'.format(image.pk)))
+
+    @override_settings(LABELER_EAGER_DERIVATIVES=True)
+    def test_eager_after_bulk_upload(self):
+        response = APIClient().post('/api/images/bulk/', {
+            'file': [SimpleUploadedFile('HUNT0133.jpg', self.read_photo())]}, format='multipart')
+        self.assertEqual(response.status_code, 201, response.data)
+        image = Image.objects.get(pk=response.data['results'][0]['id'])
+        for size in ('thumb', 'medium'):
+            self.assertTrue(derivatives_storage().exists(derivative_name(image.content_hash, size)))
+
+
+class ConditionalGetTest(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.image = Image.objects.create(file='images/test_image.jpg')
+        self.user = User.objects.create(username='voter')
+        self.coyote = Label.objects.create(title='coyote')
+
+    def assertNotModified(self, url, etag):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(queries), 1)
+
+    def test_list(self):
+        response = self.client.get('/api/images/')
+        etag = response['ETag']
+        self.assertFalse(response.has_header('Last-Modified'))  # deletions don't change max(updated_date)
+        self.assertNotModified('/api/images/', etag)
+        self.assertNotEqual(self.client.get('/api/images/?fields=id')['ETag'], etag)
+        ImageLabel.objects.create(image=self.image, label=self.coyote, user=self.user)
+        response = self.client.get('/api/images/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        another = Image.objects.create(file='images/another.jpg')
+        self.assertEqual(self.client.get('/api/images/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        etag = self.client.get('/api/images/')['ETag']
+        self.image.delete()
+        response = self.client.get('/api/images/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual([image['id'] for image in response.data['results']], [another.pk])
+
+    def test_detail(self):
+        url = '/api/images/{}/'.format(self.image.pk)
+        response = self.client.get(url)
+        self.assertEqual(response.data['id'], self.image.pk)
+        self.assertNotModified(url, response['ETag'])
+        self.image.caption = 'coyote'
+        self.image.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual((response.status_code, response.data['caption']), (200, 'coyote'))
+
+
+class MediaTest(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        for name in ('images/photo.jpg', 'images/orphan.jpg', '.incoming/partial'):
+            os.makedirs(os.path.join(self.media_root, os.path.dirname(name)), exist_ok=True)
+            with open(os.path.join(self.media_root, name), 'wb') as fout:
+                fout.write(b'0123456789')
+        self.uploader = User.objects.create_user(username='uploader', password='secret')
+        self.labeler = User.objects.create_user(username='labeler', password='secret')
+        Image.objects.create(file='images/photo.jpg', uploaded_by=self.uploader)
+        self.client.force_login(self.labeler)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def get(self, path, **kwargs):
+        return self.client.get(labeler_site.settings.MEDIA_URL + path, **kwargs)
+
+    def test_streams_ranges(self):
+        url = labeler_site.settings.MEDIA_URL + 'images/photo.jpg'
+        response = self.client.get(url)
+        self.assertEqual((response.status_code, b''.join(response.streaming_content)), (200, b'0123456789'))
+        self.assertEqual((response['Content-Type'], response['Accept-Ranges']), ('image/jpeg', 'bytes'))
+        self.assertIn('private', response['Cache-Control'])
+        response = self.client.get(url, HTTP_RANGE='bytes=2-5')
+        self.assertEqual((response.status_code, b''.join(response.streaming_content)), (206, b'2345'))
+        self.assertEqual(response['Content-Range'], 'bytes 2-5/10')
+        self.assertEqual(self.client.get(url, HTTP_RANGE='bytes=-3').status_code, 206)
+        self.assertEqual(self.client.get(url, HTTP_RANGE='bytes=20-').status_code, 416)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_access(self):
+        for path in ('.incoming/partial', '../etc/passwd', 'images/missing.jpg', 'images/orphan.jpg'):
+            self.assertEqual(self.get(path).status_code, 404, path)
+        self.client.logout()
+        self.assertEqual(self.get('images/photo.jpg').status_code, 302)
+        with self.settings(LABELER_MEDIA_REQUIRE_LOGIN=False):
+            self.assertEqual(self.get('images/photo.jpg').status_code, 200)
+        self.client.force_login(User.objects.create_user(username='admin', is_staff=True))
+        self.assertEqual(self.get('images/orphan.jpg').status_code, 200)
+
+    @override_settings(LABELER_MEDIA_PERMISSION='labeler.media.uploader_or_staff')
+    def test_uploader_or_staff(self):
+        self.assertEqual(self.get('images/photo.jpg').status_code, 404)
+        self.client.force_login(self.uploader)
+        self.assertEqual(self.get('images/photo.jpg').status_code, 200)
+
+    @override_settings(LABELER_MEDIA_SENDFILE='x-accel-redirect')
+    def test_handoff_to_web_server(self):
+        response = self.get('images/photo.jpg')
+        self.assertEqual((response.status_code, response.content), (200, b''))
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/images/photo.jpg')
+        self.assertEqual(self.get('images/orphan.jpg').status_code, 404)
+
+
+class IndexCacheTest(TestCase):
+
+    def check_index_cache(self):
+        cache.clear()
+        first = Image.objects.create(file='images/first.jpg')
+        self.assertContains(self.client.get('/'), 'images/first.jpg')
+        with CaptureQueriesContext(connection) as queries:
+            self.assertContains(self.client.get('/'), 'images/first.jpg')
+        self.assertEqual(len(queries), 0)
+
+        Image.objects.create(file='images/second.jpg', uploaded_by=User.objects.create(username='alice'),
+                             info={'Make': 'Bushnell'})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/')
+        self.assertContains(response, 'images/second.jpg')
+        self.assertContains(response, 'alice')
+        self.assertContains(response, 'images/first.jpg')
+        self.assertEqual(len(queries), 1)  # the rows are cached fragments, but the list of images isn't
+        self.assertNotIn('"info"', queries[0]['sql'])
+
+        first.delete()
+        self.assertNotContains(self.client.get('/'), 'images/first.jpg')
+
+    def test_locmem_cache(self):
+        self.check_index_cache()
+
+    def test_file_based_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            with self.settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                                                   'LOCATION': cache_dir}}):
+                self.check_index_cache()
+        finally:
+            shutil.rmtree(cache_dir)
+
+
 class BotTest(TestCase):
     """Run doctests for the bot module"""
 
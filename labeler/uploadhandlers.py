@@ -0,0 +1,195 @@
+""" Upload handlers that hash, sniff and extract EXIF from image uploads while the chunks stream in
+
+Every byte of an upload passes through ImageSniffer exactly once, on its way to memory or the temp file, so:
+  - `content_hash` (SHA-256) lets ContentAddressedStorage skip re-reading the file (and skip writing a duplicate)
+  - `image_format` and `image_size` (width, height) come from the magic bytes and the image header
+  - `exif` is decoded from the JPEG APP1 segment, for `Image.info` and `Image.taken_date`
+are set on the UploadedFile without another pass over the file or a PIL decode.
+
+Enable them in settings.FILE_UPLOAD_HANDLERS, in place of Django's default handlers.
+"""
+import hashlib
+import struct
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+
+from .exif import APP1, EOI, SOF_MARKERS, SOS, STANDALONE_MARKERS, decode_app1
+
+MAX_IMAGE_PIXELS = getattr(settings, 'LABELER_MAX_IMAGE_PIXELS', 100 * 1000 * 1000)
+
+PNG_MAGIC, GIF_MAGIC, TIFF_MAGIC = b'\x89PNG\r\n\x1a\n', (b'GIF87a', b'GIF89a'), (b'II*\x00', b'MM\x00*')
+MAGIC_BYTES = 26  # enough for every format's magic bytes and (for all but JPEG) its width and height
+
+
+class ImageSniffer(object):
+    """ Incremental SHA-256, image format, dimensions and EXIF of a file, fed one chunk at a time
+
+    Only the JPEG header segments it needs are ever buffered (at most 64 KB each), the rest are skipped.
+
+    >>> sniffer = ImageSniffer()
+    >>> for chunk in (b'GIF89a', b'\\x40\\x01\\xf0\\x00', b'\\x00' * 20):
+    ...     sniffer.feed(chunk)
+    >>> sniffer.image_format, sniffer.image_size
+    ('gif', (320, 240))
+    """
+
+    def __init__(self):
+        self.hasher = hashlib.sha256()
+        self.buffer = bytearray()
+        self.skip = 0
+        self.done = False
+        self.image_format, self.image_size, self.exif = None, None, None
+
+    def feed(self, chunk):
+        self.hasher.update(chunk)
+        if self.done:
+            return
+        if self.skip >= len(chunk):
+            self.skip -= len(chunk)
+            return
+        self.buffer += chunk[self.skip:]
+        self.skip = 0
+        if self.image_format is None:
+            self.sniff_magic()
+        if self.image_format == 'jpeg':
+            self.parse_jpeg()
+
+    def finish(self):
+        """ Call at the end of the file, in case it was shorter than MAGIC_BYTES """
+        if self.image_format is None and not self.done:
+            self.sniff_magic(final=True)
+        self.done = True
+        self.buffer = bytearray()
+
+    @property
+    def content_hash(self):
+        return self.hasher.hexdigest()
+
+    def sniff_magic(self, final=False):
+        buf = bytes(self.buffer[:MAGIC_BYTES])
+        if len(buf) < MAGIC_BYTES and not final:
+            return
+        if buf.startswith(b'\xff\xd8\xff'):
+            self.image_format = 'jpeg'
+            del self.buffer[:2]
+            return
+        if buf.startswith(PNG_MAGIC) and buf[12:16] == b'IHDR' and len(buf) >= 24:
+            self.image_format, self.image_size = 'png', struct.unpack('>LL', buf[16:24])
+        elif buf[:6] in GIF_MAGIC and len(buf) >= 10:
+            self.image_format, self.image_size = 'gif', struct.unpack('<HH', buf[6:10])
+        elif buf.startswith(b'BM') and len(buf) >= 26:
+            width, height = struct.unpack('<ll', buf[18:26])
+            self.image_format, self.image_size = 'bmp', (width, abs(height))
+        elif buf[:4] in TIFF_MAGIC:
+            self.image_format = 'tiff'
+        self.done = True
+        self.buffer = bytearray()
+
+    def parse_jpeg(self):
+        """ Walk the JPEG segments in the buffer up to the start of frame (dimensions), keeping the EXIF segment """
+        buf = self.buffer
+        while not self.done:
+            if len(buf) < 4:
+                return
+            if buf[0] != 0xFF:
+                break  # corrupt, or not where we expected a marker
+            marker = buf[1]
+            if marker == 0xFF:
+                del buf[:1]  # fill byte
+                continue
+            if marker in STANDALONE_MARKERS:
+                del buf[:2]
+                continue
+            if marker in (SOS, EOI):
+                break
+            length = struct.unpack('>H', bytes(buf[2:4]))[0]
+            if length < 2:
+                break
+            if marker not in SOF_MARKERS and (marker != APP1 or self.exif is not None):
+                # skip the segment without buffering it
+                del buf[:2]
+                self.skip = max(length - len(buf), 0)
+                del buf[:length]
+                continue
+            if len(buf) < 2 + length:
+                return  # wait for the rest of the segment
+            segment = bytes(buf[4:2 + length])
+            del buf[:2 + length]
+            if marker == APP1:
+                self.exif = decode_app1(segment)
+            elif len(segment) >= 5:
+                height, width = struct.unpack('>HH', segment[1:5])
+                self.image_size = (width, height)
+                break  # the APPn (EXIF) segments always come before the frame header
+        self.done = True
+        self.buffer = bytearray()
+
+    def annotate(self, fileobj):
+        """ Set the content_hash, image_format, image_size and exif attributes on a (Uploaded)File """
+        self.finish()
+        fileobj.content_hash = self.content_hash
+        fileobj.image_format, fileobj.image_size, fileobj.exif = self.image_format, self.image_size, self.exif
+        return fileobj
+
+
+class SniffedFile(File):
+    """ A File that annotates itself with ImageSniffer metadata once its chunks() have all been read (e.g. by storage)
+
+    For files that didn't arrive through the upload handlers, like the members of an uploaded archive.
+    """
+
+    def chunks(self, chunk_size=None):
+        sniffer = ImageSniffer()
+        for chunk in super().chunks(chunk_size):
+            sniffer.feed(chunk)
+            yield chunk
+        sniffer.annotate(self)
+
+
+class ImageSnifferMixin(object):
+    """ Feed each chunk that this upload handler consumes through an ImageSniffer, and annotate the finished file """
+
+    def new_file(self, *args, **kwargs):
+        self.sniffer = ImageSniffer()  # first, because MemoryFileUploadHandler.new_file() raises StopFutureHandlers
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        # a MemoryFileUploadHandler that isn't activated (upload too large) passes its chunks on to the next handler
+        if getattr(self, 'activated', True):
+            self.sniffer.feed(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        uploaded = super().file_complete(file_size)
+        if uploaded is not None:
+            self.sniffer.annotate(uploaded)
+        return uploaded
+
+
+class SniffingMemoryFileUploadHandler(ImageSnifferMixin, MemoryFileUploadHandler):
+    """ Small uploads, kept in memory """
+
+
+class SniffingTemporaryFileUploadHandler(ImageSnifferMixin, TemporaryFileUploadHandler):
+    """ Large uploads, streamed to a temporary file """
+
+
+def validate_image_upload(value):
+    """ Reject uploads that ImageSniffer didn't recognize as an image, or that have an absurd number of pixels
+
+    Files that never went through ImageSniffer (no `image_format` attribute) are let through.
+    """
+    uploaded = getattr(value, '_file', None) or value
+    if not hasattr(uploaded, 'image_format'):
+        return
+    if uploaded.image_format is None:
+        raise ValidationError('Upload a valid image. The file you uploaded was either not an image or a corrupted '
+                              'image.', code='invalid_image')
+    if uploaded.image_size is not None:
+        width, height = uploaded.image_size
+        if width <= 0 or height <= 0 or width * height > MAX_IMAGE_PIXELS:
+            raise ValidationError('Image dimensions %(width)sx%(height)s are not allowed.', code='invalid_image_size',
+                                  params=dict(width=width, height=height))
@@ -0,0 +1,169 @@
+""" Bulk ingest of many image files (or a tar/zip archive of them) in a single request
+
+Each file is streamed to storage as it's read, and the Image rows are inserted with bulk_create,
+one batch (and one transaction) at a time, so a bad file or batch never rolls back the others.
+"""
+import logging
+import os
+import tarfile
+import zipfile
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import UploadedFile
+from django.db import DatabaseError, connection, transaction
+
+from .derivatives import generate_derivatives_quietly
+from .models import Image, ImagePriority, release_blob
+from .pagecache import invalidate_index
+from .preannotate import queue_preannotation
+from .storage import content_hash_from_name
+from .uploadhandlers import SniffedFile, validate_image_upload
+
+_logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.tif', '.tiff', '.bmp')
+ARCHIVE_FIELD, FILE_FIELD = 'archive', 'file'
+
+
+def is_image_filename(name):
+    return os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+
+
+def iter_archive(archive):
+    """ Yield (name, file) for each image in a tar (read as a stream) or zip archive, and (name, None) for the rest """
+    if zipfile.is_zipfile(archive):
+        archive.seek(0)
+        with zipfile.ZipFile(archive) as zf:
+            for info in zf.infolist():
+                if info.filename.endswith('/'):
+                    continue
+                if not is_image_filename(info.filename):
+                    yield info.filename, None
+                    continue
+                with zf.open(info) as fin:
+                    yield info.filename, fin
+        return
+    archive.seek(0)
+    # 'r|*' reads the (optionally compressed) tar sequentially, without seeking or buffering the whole archive
+    with tarfile.open(fileobj=archive, mode='r|*') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            if not is_image_filename(member.name):
+                yield member.name, None
+                continue
+            yield member.name, tar.extractfile(member)
+
+
+def iter_uploaded_files(files):
+    """ Yield (name, file) for every file in a request.FILES MultiValueDict, expanding any archives """
+    for uploaded in files.getlist(FILE_FIELD):
+        yield uploaded.name, uploaded
+    for archive in files.getlist(ARCHIVE_FIELD):
+        try:
+            for name, fin in iter_archive(archive):
+                yield name, fin
+        except (tarfile.TarError, zipfile.BadZipfile, EOFError, OSError) as e:
+            yield archive.name, ValueError('Unreadable archive: {}'.format(e))
+
+
+def store_file(name, fin):
+    """ Stream a file into default_storage where Image.file would put it, returning (stored name, file)
+
+    Uploads already carry the hash, format and EXIF from labeler.uploadhandlers, anything else
+    (archive members) is sniffed by SniffedFile on its single pass into storage.
+    """
+    storage_name = Image._meta.get_field('file').generate_filename(None, os.path.basename(name))
+    if not (isinstance(fin, UploadedFile) and hasattr(fin, 'content_hash')):
+        fin = SniffedFile(fin, name=os.path.basename(name))
+    return default_storage.save(storage_name, fin), fin
+
+
+def bulk_ingest(files, uploaded_by=None, caption='', batch_size=100):
+    """ Store each (name, file) pair and create Image records for them in batches
+
+    Returns:
+      list of dict: {'name', 'status' ('created', 'skipped' or 'error'), and 'id' or 'error'} for each file, in order
+    """
+    results, batch = [], []
+    for name, fin in files:
+        if fin is None:
+            results.append(dict(name=name, status='skipped', error='Not an image file'))
+            continue
+        if isinstance(fin, Exception):
+            results.append(dict(name=name, status='error', error=str(fin)))
+            continue
+        try:
+            stored_name, content = store_file(name, fin)
+        except (OSError, IOError, ValueError) as e:
+            _logger.warning('Unable to store %r: %s', name, e)
+            results.append(dict(name=name, status='error', error='Unable to store file: {}'.format(e)))
+            continue
+        content_hash = content_hash_from_name(stored_name)
+        try:
+            validate_image_upload(content)
+        except ValidationError as e:
+            if content_hash:
+                release_blob(default_storage, stored_name, content_hash)
+            results.append(dict(name=name, status='error', error=' '.join(e.messages)))
+            continue
+        result = dict(name=name, status='created', file=stored_name)
+        results.append(result)
+        image = Image(file=stored_name, content_hash=content_hash, caption=caption, uploaded_by=uploaded_by)
+        image.set_upload_metadata(content)
+        batch.append((result, image))
+        if len(batch) >= batch_size:
+            insert_batch(batch)
+            batch = []
+    if batch:
+        insert_batch(batch)
+    return results
+
+
+def insert_batch(batch):
+    """ bulk_create a batch of (result dict, Image) pairs, falling back to one INSERT at a time if the batch fails """
+    images = [image for _, image in batch]
+    max_pk = Image.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+    try:
+        with transaction.atomic():
+            Image.objects.bulk_create(images)
+    except DatabaseError as e:
+        _logger.warning('bulk_create of %d images failed (%s), inserting them one at a time', len(images), e)
+        for result, image in batch:
+            try:
+                with transaction.atomic():
+                    image.save()
+            except DatabaseError as e:
+                if image.content_hash:
+                    # other Images may share the blob
+                    release_blob(default_storage, image.file.name, image.content_hash)
+                else:
+                    default_storage.delete(image.file.name)
+                result.update(status='error', error='Unable to save image record: {}'.format(e))
+                result.pop('file', None)
+    if not connection.features.can_return_ids_from_bulk_insert:
+        # sqlite and MySQL don't return the new primary keys, so look them up (one query per batch)
+        # duplicate uploads share a file name, so match them up in the order they were inserted
+        ids = {}
+        for name, pk in (Image.objects.filter(file__in=[image.file.name for image in images],
+                                              pk__gt=max_pk).order_by('pk').values_list('file', 'id')):
+            ids.setdefault(name, []).append(pk)
+        for image in images:
+            image.pk = image.pk or (ids.get(image.file.name) or [None]).pop(0)
+    for result, image in batch:
+        if result['status'] == 'created':
+            result['id'] = image.pk
+    # bulk_create skips the post_save signals that queue new images for labeling (image.save() doesn't) ...
+    ids = set(image.pk for image in images if image.pk)
+    queued = set(ImagePriority.objects.filter(image_id__in=ids).values_list('image_id', flat=True))
+    ImagePriority.objects.bulk_create([ImagePriority(image_id=pk) for pk in sorted(ids - queued)])
+    # ... and re-render the index page
+    invalidate_index()
+    # ... and make their thumbnails
+    if getattr(settings, 'LABELER_EAGER_DERIVATIVES', False):
+        generate_derivatives_quietly([image for image in images if image.pk])
+    # ... and suggest their labels
+    if getattr(settings, 'LABELER_PREANNOTATE', False):
+        transaction.on_commit(lambda: queue_preannotation(sorted(ids)))
@@ -1,6 +1,7 @@
+import re
+
 from django.conf.urls import url
 from django.conf import settings
-from django.conf.urls.static import static
 
 from . import views
 
@@ -9,10 +10,17 @@ urlpatterns = [
     url(r'^$', views.index, name='index'),
     # class-based REST API view ov images
     url(r'^api/images/$', views.ListImages.as_view()),
+    url(r'^api/images/(?P<pk>[0-9]+)/$', views.ImageDetail.as_view(), name='image_detail'),
+    url(r'^api/images/bulk/$', views.BulkUploadImages.as_view(), name='image_bulk_upload'),
+    url(r'^images/(?P<pk>[0-9]+)/(?P<size>[a-z]+)/$', views.image_derivative, name='image_derivative'),
+    url(r'^api/images/(?P<pk>[0-9]+)/consensus/$', views.consensus, name='image_consensus'),
+    url(r'^api/consensus/$', views.consensus, name='consensus'),
+    url(r'^api/images/(?P<pk>[0-9]+)/detections/$', views.detections, name='image_detections'),
+    url(r'^api/images/(?P<pk>[0-9]+)/suggestions/$', views.suggestions, name='image_suggestions'),
+    url(r'^api/next/$', views.next_image, name='next_image'),
+    url(r'^api/votes/$', views.VoteBatch.as_view(), name='vote_batch'),
     url(r'^upload/$', views.form_file_upload, name='form_file_upload'),
     url(r'^api/$', views.ListImages.as_view(), name='image_list'),
+    # user uploads, in production too (handed off to the web server with LABELER_MEDIA_SENDFILE)
+    url(r'^{}(?P<path>.+)$'.format(re.escape(settings.MEDIA_URL.lstrip('/'))), views.media, name='media'),
 ]
-
-
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -2,26 +2,55 @@
 - Home page (list of images in our DB?)
 - Image "details" page, a form for viewing, changing, or uploading an Image
 - Image upload page
-- A way to label an image
-- Display the aggregate (sum) of the label "votes" for an image
+- User uploads (media), with access checks, handed off to the web server or streamed with Range support
+- Thumbnails and previews of each image, generated on first request and cached on disk
+- Bulk image upload API (many files or a tar/zip archive per request)
+- A way to label an image (or a whole batch of images at once)
+- Display the aggregate (sum) of the label "votes" for an image (the consensus API)
+- Objects detected in an image by the YOLO model, batched across concurrent requests
+- Labels suggested for an image by a model (machine pre-annotation)
 - List the individual votes for an Image 
 """
+import concurrent.futures
+import logging
 
-from django.shortcuts import render, redirect
+from django.conf import settings
+from django.contrib.auth.views import redirect_to_login
+from django.core.cache import cache
+from django.http import Http404, HttpResponse
+from django.shortcuts import get_object_or_404, render, redirect
+from django.utils.cache import patch_cache_control
 
+from rest_framework import status
 from rest_framework.decorators import api_view
+from rest_framework.parsers import MultiPartParser
+from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
+from rest_framework.views import APIView
 
 # from django.template import RequestContext
 # from django.http import HttpResponseRedirect
 # from django.core.urlresolvers import reverse
 
-from .models import Image
-from .serializers import ImageSerializer
+from .conditional import ConditionalListMixin, ConditionalRetrieveMixin
+from .consensus import image_consensus
+from .derivatives import SIZES, derivative_url
+from .detection import DetectionUnavailable, detect_image
+from .filters import ImageFilterBackend
+from .media import serve_media
+from .models import Image, ImageLabel
+from .pagecache import PAGE_TIMEOUT, ROW_TIMEOUT, index_page_key
+from .registry import label_registry
+from .serializers import ImageSerializer, VoteSerializer
 from .forms import FileUploadForm
+from .pagination import KeysetPagination
+from .scheduler import next_images
+from .uploads import bulk_ingest, iter_uploaded_files
 
 from rest_framework import generics
 
+_logger = logging.getLogger(__name__)
+
 
 def form_file_upload(request):
     if request.method == 'POST':
@@ -37,23 +66,190 @@ def form_file_upload(request):
 
 
 def index(request):
-    images = Image.objects.all()
-    return render(request, 'labeler/index.html', {'images': images})
+    """ The table of all images, served from the cache until an Image is saved or deleted (see labeler.pagecache) """
+    key = index_page_key(request)
+    content = cache.get(key)
+    if content is None:
+        # just the columns the template shows: not the EXIF `info` blobs, which would be most of the bytes read
+        images = Image.objects.select_related('uploaded_by').only(
+            'id', 'file', 'caption', 'updated_date', 'uploaded_by__username')
+        content = render(request, 'labeler/index.html', {'images': images, 'row_timeout': ROW_TIMEOUT}).content
+        cache.set(key, content, PAGE_TIMEOUT)
+    return HttpResponse(content)
+
+
+def image_derivative(request, pk, size):
+    """ Redirect to a thumbnail ('thumb') or preview ('medium') of an image, generating it on the first request """
+    if size not in SIZES:
+        raise Http404('No such image size: {}'.format(size))
+    image = get_object_or_404(Image.objects.only('file', 'content_hash'), pk=pk)
+    try:
+        response = redirect(derivative_url(image, size))
+    except (ImportError, IOError, OSError, ValueError) as e:
+        _logger.warning('Unable to make a %s of image %s (%s): %s', size, pk, image.file.name, e)
+        return redirect(image.file.url)  # the full size original is better than a broken image
+    patch_cache_control(response, public=True, max_age=60 * 60)
+    return response
+
+
+def media(request, path):
+    """ Serve a file from MEDIA_ROOT to the users settings.LABELER_MEDIA_PERMISSION allows (see labeler.media)
+
+    Anonymous users are sent to the login page, unless settings.LABELER_MEDIA_REQUIRE_LOGIN is False.
+    """
+    if getattr(settings, 'LABELER_MEDIA_REQUIRE_LOGIN', True) and not request.user.is_authenticated:
+        return redirect_to_login(request.get_full_path())
+    return serve_media(request, path)
 
 
 @api_view(['GET'])
 def image_list(request):
     """ A function based view that use the api_view decorator to add functionality to the view. """
     if request.method == 'GET':
-        images = Image.objects.all()
-        serializer = ImageSerializer(images, many=True)
-        return Response(serializer.data)
+        paginator = KeysetPagination()
+        images = ImageSerializer.sparse_queryset(Image.objects.all(), request, required=('id', 'created_date'))
+        images = ImageFilterBackend().filter_queryset(request, images)
+        images = paginator.paginate_queryset(images, request)
+        serializer = ImageSerializer(images, many=True, context={'request': request})
+        return paginator.get_paginated_response(serializer.data)
 
 
-class ListImages(generics.ListCreateAPIView):
+class ListImages(ConditionalListMixin, generics.ListCreateAPIView):
     """ A class based view that inherits from the generics class.
 
     Creates REST views/forms for simple CRUD operations.
+    Lists are paginated newest first with `?cursor=` tokens from the `next` and `previous` links.
+    `?fields=id,file,info` or `?omit=description` select the fields (and db columns) to return.
+    Responses carry an ETag header, and polling with If-None-Match gets a 304 until the list changes.
+    `?bbox=min_lon,min_lat,max_lon,max_lat`, `?camera_make=`, `?camera_model=`, `?taken_after=` and `?taken_before=`
+    filter on the indexed EXIF columns (see labeler.filters).
     """
     queryset = Image.objects.all()
     serializer_class = ImageSerializer
+    pagination_class = KeysetPagination
+    filter_backends = (ImageFilterBackend,)
+
+    def get_queryset(self):
+        # created_date is the pagination key, so it's always needed
+        return self.serializer_class.sparse_queryset(super().get_queryset(), self.request,
+                                                     required=('id', 'created_date'))
+
+
+class ImageDetail(ConditionalRetrieveMixin, generics.RetrieveUpdateDestroyAPIView):
+    """ View, update or delete one image, with the same `?fields=` and `?omit=` as the list
+
+    GETs carry ETag and Last-Modified headers (from the image's updated_date) for conditional requests.
+    """
+    queryset = Image.objects.all()
+    serializer_class = ImageSerializer
+
+    def get_queryset(self):
+        return self.serializer_class.sparse_queryset(super().get_queryset(), self.request,
+                                                     required=('id', 'updated_date'))
+
+
+class BulkUploadImages(APIView):
+    """ Upload many images in one multipart POST: repeated `file` fields and/or tar/zip `archive` fields
+
+    Files are streamed to storage and their Image records inserted in batches.
+    The response lists the status of each file; a failed file doesn't undo the ones that succeeded.
+    """
+    parser_classes = (MultiPartParser,)
+    batch_size = 100
+
+    def post(self, request, format=None):
+        results = bulk_ingest(iter_uploaded_files(request.FILES),
+                              uploaded_by=request.user if request.user.is_authenticated else None,
+                              caption=request.data.get('caption', ''),
+                              batch_size=self.batch_size)
+        created = sum(r['status'] == 'created' for r in results)
+        failed = sum(r['status'] == 'error' for r in results)
+        if not results or (failed and not created):
+            code = status.HTTP_400_BAD_REQUEST
+        elif failed:
+            code = status.HTTP_207_MULTI_STATUS
+        else:
+            code = status.HTTP_201_CREATED
+        return Response({'created': created, 'failed': failed, 'results': results}, status=code)
+
+
+class VoteBatch(APIView):
+    """ Cast a batch of votes for the current user: `[{"image": 1, "label": "coyote"}, ...]` or `{"votes": [...]}`
+
+    The whole batch is validated in one query and inserted (along with its TotalVotes increments) in one transaction.
+    """
+    permission_classes = (IsAuthenticated,)
+    max_batch_size = 1000
+
+    def post(self, request, format=None):
+        votes = request.data.get('votes') if hasattr(request.data, 'get') else request.data
+        if not isinstance(votes, list):
+            return Response({'detail': 'Expected a list of votes.'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(votes) > self.max_batch_size:
+            return Response({'detail': 'At most {} votes per request.'.format(self.max_batch_size)},
+                            status=status.HTTP_400_BAD_REQUEST)
+        serializer = VoteSerializer(data=votes, many=True, context={'request': request})
+        serializer.is_valid(raise_exception=True)
+        serializer.save(user=request.user)
+        return Response({'created': len(serializer.data), 'votes': serializer.data}, status=status.HTTP_201_CREATED)
+
+
+def parse_k(request, default=3, maximum=100):
+    try:
+        return max(1, min(int(request.query_params.get('k', default)), maximum))
+    except ValueError:
+        return default
+
+
+@api_view(['GET'])
+def consensus(request, pk=None):
+    """ Top-k labels, vote counts and agreement ratio for one image, or for `?images=1,2,3` (at most 1000 ids)
+
+    Served from cached TotalVotes, so a batch costs at most one query however many images it names.
+    """
+    k = parse_k(request)
+    if pk is not None:
+        return Response(image_consensus([int(pk)], k=k)[0])
+    try:
+        image_ids = [int(s) for s in request.query_params.get('images', '').split(',') if s.strip()]
+    except ValueError:
+        return Response({'detail': 'images must be a comma-separated list of image ids.'},
+                        status=status.HTTP_400_BAD_REQUEST)
+    if len(image_ids) > 1000:
+        return Response({'detail': 'At most 1000 images per request.'}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(image_consensus(image_ids, k=k))
+
+
+@api_view(['GET'])
+def detections(request, pk):
+    """ Objects detected in an image by the YOLO model (see labeler.detection): label, score and box of each """
+    image = get_object_or_404(Image.objects.only('file'), pk=pk)
+    try:
+        boxes = detect_image(image)
+    except (DetectionUnavailable, concurrent.futures.TimeoutError) as e:
+        return Response({'detail': str(e) or 'Detection timed out.'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    except (ImportError, IOError, OSError, ValueError) as e:
+        _logger.warning('Unable to detect objects in image %s (%s): %s', pk, image.file.name, e)
+        return Response({'detail': 'Unable to read the image.'}, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+    return Response({'image': int(pk), 'detections': boxes})
+
+
+@api_view(['GET'])
+def suggestions(request, pk):
+    """ Labels suggested for an image by a model (machine labels, see labeler.preannotate), most confident first """
+    machine_labels = (ImageLabel.objects.filter(image_id=pk, is_machine=True)
+                      .order_by('-confidence', 'pk').values_list('label_id', 'confidence'))
+    suggested = [{'label': label_registry.title(label_id), 'confidence': confidence}
+                 for label_id, confidence in machine_labels]
+    return Response({'image': int(pk), 'suggestions': suggested})
+
+
+@api_view(['GET'])
+def next_image(request):
+    """ The next `?n=` (default 1, at most 100) images the current user should label, highest priority first """
+    try:
+        n = max(1, min(int(request.query_params.get('n', 1)), 100))
+    except ValueError:
+        n = 1
+    images = next_images(request.user, n=n)
+    return Response(ImageSerializer(images, many=True, context={'request': request}).data)
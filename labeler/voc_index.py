@@ -0,0 +1,184 @@
+""" Index of the boxes in a directory of Pascal VOC annotation (.xml) files, cached on disk and updated incrementally
+
+Parsing all 17k XML files of VOC2012 on every training run is slow, more so on network storage. `update_index`
+parses them once, in a process pool (one process per CPU), and saves an .npz index: a table of the annotation files
+(name, mtime, size, image filename, width, height) and a record array of every box (file, label, xmin, ymin, xmax,
+ymax). Later runs only re-parse the files that were added or whose mtime or size changed, and drop the deleted ones.
+
+NumPy only: labeler.yolo.parse_annotation turns the index back into its list of dicts with `to_dicts`.
+"""
+import logging
+import os
+import tempfile
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+
+from labeler.yolo_decode import LABELS
+
+_logger = logging.getLogger(__name__)
+
+BOX_DTYPE = np.dtype([('file', '<i4'), ('label', '<i2'),
+                      ('xmin', '<i4'), ('ymin', '<i4'), ('xmax', '<i4'), ('ymax', '<i4')])
+POOL_MIN_FILES = 64  # fewer changed files than this are parsed in this process, a pool isn't worth starting
+
+# annotations: .xml file names (sorted), mtime_ns, size: their os.stat(), filenames: the image file of each ('' if
+# missing), widths, heights (-1 if missing), boxes: BOX_DTYPE records ordered by file, labels: the label of each index
+AnnotationIndex = namedtuple('AnnotationIndex',
+                             ['annotations', 'mtime_ns', 'size', 'filenames', 'widths', 'heights', 'boxes', 'labels'])
+
+
+def coordinate(text):
+    return int(round(float(text)))
+
+
+def parse_file(path, labels=LABELS):
+    """ (image filename, width, height, [(label index, xmin, ymin, xmax, ymax), ...]) of one VOC annotation file
+
+    Only the objects whose name is one of the labels are kept (so not the head/hand/foot parts of a person).
+    An object whose bndbox is missing a coordinate (or has one that isn't a number) is skipped, with a warning.
+    """
+    root = ET.parse(path).getroot()
+    size = root.find('.//size')
+    width = size.findtext('width') if size is not None else None
+    height = size.findtext('height') if size is not None else None
+    label_index = {name: i for i, name in enumerate(labels)}
+    boxes = []
+    for obj in root.iter('object'):
+        label, bndbox = label_index.get(obj.findtext('name')), obj.find('bndbox')
+        if label is None or bndbox is None:
+            continue
+        try:
+            boxes.append((label,) + tuple(coordinate(bndbox.findtext(dim)) for dim in ('xmin', 'ymin', 'xmax', 'ymax')))
+        except (TypeError, ValueError):
+            _logger.warning('Skipping a %s in %s: its bndbox is missing a coordinate', obj.findtext('name'), path)
+    return (root.findtext('.//filename') or '', int(width) if width else -1, int(height) if height else -1, boxes)
+
+
+def scan(ann_dir):
+    """ {.xml file name: (mtime_ns, size)} of the annotation files in a directory """
+    files = {}
+    for entry in os.scandir(ann_dir):
+        if entry.name.endswith('.xml') and entry.is_file():
+            stat = entry.stat()
+            files[entry.name] = (stat.st_mtime_ns, stat.st_size)
+    return files
+
+
+def default_index_path(ann_dir):
+    """ Annotations/ -> Annotations.index.npz, next to the directory rather than among the annotations """
+    return os.path.abspath(ann_dir).rstrip(os.sep) + '.index.npz'
+
+
+def load_index(index_path):
+    """ The AnnotationIndex saved at index_path, or None if there's none (or it can't be read) """
+    try:
+        with np.load(index_path, allow_pickle=False) as saved:
+            return AnnotationIndex(*(saved[field] for field in AnnotationIndex._fields))
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+
+
+def save_index(index, index_path):
+    """ Write the index to an .npz file, atomically """
+    directory = os.path.dirname(index_path)
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fout:
+            np.savez(fout, **index._asdict())
+        os.replace(temp_path, index_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def parse_files(ann_dir, names, labels=LABELS, workers=None):
+    """ parse_file() of each file name, in a process pool when there are many """
+    paths = [os.path.join(ann_dir, name) for name in names]
+    parse = partial(parse_file, labels=labels)
+    workers = workers or os.cpu_count() or 1
+    if len(paths) < POOL_MIN_FILES or workers == 1:
+        return [parse(path) for path in paths]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(parse, paths, chunksize=max(len(paths) // (4 * workers), 1)))
+
+
+def update_index(ann_dir, index_path=None, labels=LABELS, workers=None):
+    """ The AnnotationIndex of ann_dir, re-parsing only the files added or changed since index_path was saved
+
+    The index isn't saved when nothing changed or when its directory isn't writable.
+    """
+    index_path = index_path or default_index_path(ann_dir)
+    files = scan(ann_dir)
+    names = sorted(files)
+    old = load_index(index_path)
+    if old is not None and list(old.labels) != list(labels):
+        old = None
+    previous = {} if old is None else {name: stat for name, stat in zip(
+        old.annotations.tolist(), zip(old.mtime_ns.tolist(), old.size.tolist()))}
+    kept = [name for name in names if previous.get(name) == files[name]]
+    changed = sorted(set(names) - set(kept))
+    if old is not None and not changed and len(kept) == len(old.annotations):
+        return old
+
+    row = {name: i for i, name in enumerate(names)}
+    filenames, widths, heights = [''] * len(names), np.full(len(names), -1, 'int32'), np.full(len(names), -1, 'int32')
+    box_arrays = []
+    if kept:
+        # carry the unchanged files' rows and boxes over from the old index, renumbering their files
+        old_row = {name: i for i, name in enumerate(old.annotations.tolist())}
+        old_rows = np.array([old_row[name] for name in kept])
+        new_rows = np.array([row[name] for name in kept])
+        old_filenames = old.filenames.tolist()
+        for name, i in zip(kept, old_rows.tolist()):
+            filenames[row[name]] = old_filenames[i]
+        widths[new_rows], heights[new_rows] = old.widths[old_rows], old.heights[old_rows]
+        renumber = np.full(len(old.annotations), -1, 'int32')
+        renumber[old_rows] = new_rows
+        boxes = old.boxes[renumber[old.boxes['file']] >= 0].copy()
+        boxes['file'] = renumber[boxes['file']]
+        box_arrays.append(boxes)
+    parsed = []
+    for name, (filename, width, height, boxes) in zip(changed, parse_files(ann_dir, changed, labels, workers)):
+        filenames[row[name]], widths[row[name]], heights[row[name]] = filename, width, height
+        parsed.extend((row[name],) + box for box in boxes)
+    box_arrays.append(np.array(parsed, dtype=BOX_DTYPE))
+    boxes = np.concatenate(box_arrays)
+    index = AnnotationIndex(annotations=np.array(names, dtype='U'),
+                            mtime_ns=np.array([files[name][0] for name in names], dtype='int64'),
+                            size=np.array([files[name][1] for name in names], dtype='int64'),
+                            filenames=np.array(filenames, dtype='U'),
+                            widths=widths, heights=heights,
+                            boxes=boxes[np.argsort(boxes['file'], kind='mergesort')],
+                            labels=np.array(list(labels), dtype='U'))
+    try:
+        save_index(index, index_path)
+    except (IOError, OSError):
+        pass  # read-only dataset directory: re-parse every run, as before
+    return index
+
+
+def to_dicts(index):
+    """ [{'filename', 'width', 'height', 'object': [{'name', 'xmin', 'ymin', 'xmax', 'ymax'}, ...]}, ...]
+
+    One dict per annotation file with an image filename, in annotation file name order.
+    """
+    labels = index.labels.tolist()
+    objects = [[] for _ in range(len(index.annotations))]
+    for i, label, xmin, ymin, xmax, ymax in index.boxes.tolist():
+        objects[i].append({'name': labels[label], 'xmin': xmin, 'ymin': ymin, 'xmax': xmax, 'ymax': ymax})
+    images = []
+    for filename, width, height, boxes in zip(index.filenames.tolist(), index.widths.tolist(),
+                                              index.heights.tolist(), objects):
+        if not filename:
+            continue
+        img = {'filename': filename, 'object': boxes}
+        if width >= 0:
+            img['width'] = width
+        if height >= 0:
+            img['height'] = height
+        images.append(img)
+    return images
@@ -23,152 +23,26 @@ import os
 
 import numpy as np
 import os
-import xml.etree.ElementTree as ET
 import tensorflow as tf
 import copy
 import cv2
 
+from labeler.darknet import conversion_plan, load_converted
+from labeler.voc_index import to_dicts, update_index
+from labeler.yolo_decode import ANCHORS, BOX, CLASS, GRID_H, GRID_W, LABELS, decode_netout, draw_boxes
 
-class BoundBox:
-    def __init__(self, class_num):
-        self.x, self.y, self.w, self.h, self.c = 0., 0., 0., 0., 0.
-        self.probs = np.zeros((class_num,))
-
-    def iou(self, box):
-        intersection = self.intersect(box)
-        union = self.w * self.h + box.w * box.h - intersection
-        return intersection / union
-
-    def intersect(self, box):
-        width = self.__overlap([self.x - self.w / 2, self.x + self.w / 2], [box.x - box.w / 2, box.x + box.w / 2])
-        height = self.__overlap([self.y - self.h / 2, self.y + self.h / 2], [box.y - box.h / 2, box.y + box.h / 2])
-        return width * height
-
-    def __overlap(self, interval_a, interval_b):
-        x1, x2 = interval_a
-        x3, x4 = interval_b
-        if x3 < x1:
-            if x4 < x1:
-                return 0
-            else:
-                return min(x2, x4) - x1
-        else:
-            if x2 < x3:
-                return 0
-            else:
-                return min(x2, x4) - x3
-
-
-class WeightReader:
-    def __init__(self, weight_file):
-        self.offset = 4
-        self.all_weights = np.fromfile(weight_file, dtype='float32')
-
-    def read_bytes(self, size):
-        self.offset = self.offset + size
-        return self.all_weights[self.offset - size:self.offset]
-
-    def reset(self):
-        self.offset = 4
 
 def interpret_netout(image, netout):
-    boxes = []
+    """ Draw the boxes detected in the network output for one image on that image (see labeler.yolo_decode) """
+    return draw_boxes(image, decode_netout(netout))
 
-    # interpret the output by the network
-    for row in range(GRID_H):
-        for col in range(GRID_W):
-            for b in range(BOX):
-                box = BoundBox(CLASS)
 
-                # first 5 weights for x, y, w, h and confidence
-                box.x, box.y, box.w, box.h, box.c = netout[row,col,b,:5]
+def parse_annotation(ann_dir='/data/vsa/VOCdevkit/VOC2012/Annotations/', index_path=None, workers=None):
+    """ [{'filename', 'width', 'height', 'object': [{'name', 'xmin', 'ymin', 'xmax', 'ymax'}]}] of the VOC annotations
 
-                box.x = (col + sigmoid(box.x)) / GRID_W
-                box.y = (row + sigmoid(box.y)) / GRID_H
-                box.w = ANCHORS[2 * b + 0] * np.exp(box.w) / GRID_W
-                box.h = ANCHORS[2 * b + 1] * np.exp(box.h) / GRID_H
-                box.c = sigmoid(box.c)
-
-                # last 20 weights for class likelihoods
-                classes = netout[row,col,b,5:]
-                box.probs = softmax(classes) * box.c
-                box.probs *= box.probs > THRESHOLD
-
-                boxes.append(box)
-
-    # suppress non-maximal boxes
-    for c in range(CLASS):
-        sorted_indices = list(reversed(np.argsort([box.probs[c] for box in boxes])))
-
-        for i in xrange(len(sorted_indices)):
-            index_i = sorted_indices[i]
-
-            if boxes[index_i].probs[c] == 0: 
-                continue
-            else:
-                for j in xrange(i + 1, len(sorted_indices)):
-                    index_j = sorted_indices[j]
-
-                    if boxes[index_i].iou(boxes[index_j]) >= 0.4:
-                        boxes[index_j].probs[c] = 0
-
-    # draw the boxes using a threshold
-    for box in boxes:
-        max_indx = np.argmax(box.probs)
-        max_prob = box.probs[max_indx]
-
-        if max_prob > THRESHOLD:
-            xmin = int((box.x - box.w / 2) * image.shape[1])
-            xmax = int((box.x + box.w / 2) * image.shape[1])
-            ymin = int((box.y - box.h / 2) * image.shape[0])
-            ymax = int((box.y + box.h / 2) * image.shape[0])
-
-            cv2.rectangle(image, (xmin, ymin), (xmax, ymax), COLORS[max_indx], 2)
-            cv2.putText(image, LABELS[max_indx], (xmin, ymin - 12), 0, 1e-3 * image.shape[0], (0, 255, 0), 2)
-
-    return image
-
-
-def parse_annotation(ann_dir='/data/vsa/VOCdevkit/VOC2012/Annotations/'):
-    all_img = []
-
-    for ann in os.listdir(ann_dir):
-        img = {'object': []}
-
-        tree = ET.parse(ann_dir + ann)
-
-        for elem in tree.iter():
-            if 'filename' in elem.tag:
-                all_img += [img]
-                img['filename'] = elem.text
-            if 'width' in elem.tag:
-                img['width'] = int(elem.text)
-            if 'height' in elem.tag:
-                img['height'] = int(elem.text)
-            if 'object' in elem.tag or 'part' in elem.tag:
-                obj = {}
-
-                for attr in list(elem):
-                    if 'name' in attr.tag:
-                        obj['name'] = attr.text
-
-                        if obj['name'] in LABELS:
-                            img['object'] += [obj]
-                        else:
-                            break
-
-                    if 'bndbox' in attr.tag:
-                        for dim in list(attr):
-                            if 'xmin' in dim.tag:
-                                obj['xmin'] = int(round(float(dim.text)))
-                            if 'ymin' in dim.tag:
-                                obj['ymin'] = int(round(float(dim.text)))
-                            if 'xmax' in dim.tag:
-                                obj['xmax'] = int(round(float(dim.text)))
-                            if 'ymax' in dim.tag:
-                                obj['ymax'] = int(round(float(dim.text)))
-
-    return all_img
+    Read from an index cached next to ann_dir that's only re-parsed for the files changed since (see voc_index).
+    """
+    return to_dicts(update_index(ann_dir, index_path=index_path, workers=workers))
 
 
 def aug_img(train_instance, img_dir='/data/vsa/VOCdevkit/VOC2012/JPEGImages/'):
@@ -364,32 +238,8 @@ def custom_loss(y_true, y_pred):
     return loss
 
 
-def sigmoid(x):
-    return 1. / (1. + np.exp(-x))
-
-
-def softmax(x):
-    return np.exp(x) / np.sum(np.exp(x), axis=0)
-
-
-LABELS = ['aeroplane', 'bicycle', 'bird', 'boat', 'bottle',
-          'bus', 'car', 'cat', 'chair', 'cow',
-          'diningtable', 'dog', 'horse', 'motorbike', 'person',
-          'pottedplant', 'sheep', 'sofa', 'train', 'tvmonitor']
-
-COLORS = [(43, 206, 72), (255, 204, 153), (128, 128, 128), (148, 255, 181), (143, 124, 0),
-          (0, 153, 143), (157, 204, 0), (194, 0, 136), (0, 51, 128), (255, 164, 5),
-          (255, 168, 187), (66, 102, 0), (255, 0, 16), (94, 241, 242), (224, 255, 102),
-          (116, 10, 255), (153, 0, 0), (255, 255, 128), (255, 255, 0), (255, 80, 5)]
-
 NORM_H, NORM_W = 416, 416
-GRID_H, GRID_W = 13, 13
 BATCH_SIZE = 8
-BOX = 5
-CLASS = 20
-THRESHOLD = 0.2
-ANCHORS = '1.08, 1.19,    3.42, 4.41,    6.63, 11.38,  9.42, 5.11,    16.62, 10.52'
-ANCHORS = [float(s.strip()) for s in ANCHORS.split(',')]
 SCALE_NOOB, SCALE_CONF, SCALE_COOR, SCALE_PROB = 0.5, 5.0, 5.0, 1.0
 
 
@@ -430,36 +280,13 @@ def build_model():
     return model
 
 
-def load_weights(model, wt_path='/data/vsa/tiny-yolo-voc.weights'):
-    weight_reader = WeightReader(wt_path)
-    weight_reader.reset()
-
-    for i in range(len(model.layers)):
-        if 'conv' in model.layers[i].name:
-            if 'batch' in model.layers[i + 1].name:
-                norm_layer = model.layers[i + 1]
-                size = np.prod(norm_layer.get_weights()[0].shape)
-
-                beta = weight_reader.read_bytes(size)
-                gamma = weight_reader.read_bytes(size)
-                mean = weight_reader.read_bytes(size)
-                var = weight_reader.read_bytes(size)
-
-                weights = norm_layer.set_weights([gamma, beta, mean, var])
-                print(weights)
-
-            conv_layer = model.layers[i]
-            if len(conv_layer.get_weights()) > 1:
-                bias = weight_reader.read_bytes(np.prod(conv_layer.get_weights()[1].shape))
-                kernel = weight_reader.read_bytes(np.prod(conv_layer.get_weights()[0].shape))
-                kernel = kernel.reshape(list(reversed(conv_layer.get_weights()[0].shape)))
-                kernel = kernel.transpose([2, 3, 1, 0])
-                conv_layer.set_weights([kernel, bias])
-            else:
-                kernel = weight_reader.read_bytes(np.prod(conv_layer.get_weights()[0].shape))
-                kernel = kernel.reshape(list(reversed(conv_layer.get_weights()[0].shape)))
-                kernel = kernel.transpose([2, 3, 1, 0])
-                conv_layer.set_weights([kernel])
+def load_weights(model, wt_path='/data/vsa/tiny-yolo-voc.weights', cache_dir=None):
+    """ Set the model's weights from a Darknet weights file (converted once, then loaded from a cache, see darknet) """
+    from keras import backend as K
+
+    plan = conversion_plan((layer.name, [K.int_shape(w) for w in layer.weights]) for layer in model.layers)
+    for name, weights in load_converted(wt_path, plan, cache_dir=cache_dir).items():
+        model.get_layer(name).set_weights(weights)
     return model
 
 
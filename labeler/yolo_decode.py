@@ -0,0 +1,172 @@
+""" Decode the output tensor of YOLO v2 (labeler.yolo) into bounding boxes, with NumPy alone
+
+`decode_netout` turns the whole (GRID_H, GRID_W, BOX, 4 + 1 + CLASS) tensor into arrays of boxes with a handful of
+vectorized operations, rather than a BoundBox object and scalar sigmoid/softmax calls for each of the 845 anchors.
+Only the few boxes that pass the score threshold ever reach the (per class) non-maximal suppression (labeler.nms).
+Drawing the boxes on the image is a separate, optional step (`draw_boxes`, which needs OpenCV).
+
+No keras, tensorflow or OpenCV needed, so the web app can decode the output of a model served elsewhere.
+
+References:
+- [YOLO v2 paper](https://arxiv.org/abs/1612.08242)
+- [basic-yolo-keras](https://github.com/experiencor/basic-yolo-keras)
+"""
+from collections import namedtuple
+
+import numpy as np
+
+from .nms import suppress
+
+LABELS = ['aeroplane', 'bicycle', 'bird', 'boat', 'bottle',
+          'bus', 'car', 'cat', 'chair', 'cow',
+          'diningtable', 'dog', 'horse', 'motorbike', 'person',
+          'pottedplant', 'sheep', 'sofa', 'train', 'tvmonitor']
+
+COLORS = [(43, 206, 72), (255, 204, 153), (128, 128, 128), (148, 255, 181), (143, 124, 0),
+          (0, 153, 143), (157, 204, 0), (194, 0, 136), (0, 51, 128), (255, 164, 5),
+          (255, 168, 187), (66, 102, 0), (255, 0, 16), (94, 241, 242), (224, 255, 102),
+          (116, 10, 255), (153, 0, 0), (255, 255, 128), (255, 255, 0), (255, 80, 5)]
+
+GRID_H, GRID_W = 13, 13
+BOX = 5
+CLASS = 20
+THRESHOLD = 0.2
+NMS_THRESHOLD = 0.4  # IoU
+ANCHORS = '1.08, 1.19,    3.42, 4.41,    6.63, 11.38,  9.42, 5.11,    16.62, 10.52'
+ANCHORS = [float(s.strip()) for s in ANCHORS.split(',')]
+
+# xywh: (N, 4) box centers, widths and heights as fractions of the image width and height
+# probs: (N, CLASS) class scores (after thresholding and suppression), labels: (N,) argmax class, scores: (N,) max
+Detections = namedtuple('Detections', ['xywh', 'probs', 'labels', 'scores'])
+
+
+class BoundBox:
+    def __init__(self, class_num):
+        self.x, self.y, self.w, self.h, self.c = 0., 0., 0., 0., 0.
+        self.probs = np.zeros((class_num,))
+
+    def iou(self, box):
+        intersection = self.intersect(box)
+        union = self.w * self.h + box.w * box.h - intersection
+        return intersection / union
+
+    def intersect(self, box):
+        width = self.__overlap([self.x - self.w / 2, self.x + self.w / 2], [box.x - box.w / 2, box.x + box.w / 2])
+        height = self.__overlap([self.y - self.h / 2, self.y + self.h / 2], [box.y - box.h / 2, box.y + box.h / 2])
+        return width * height
+
+    def __overlap(self, interval_a, interval_b):
+        x1, x2 = interval_a
+        x3, x4 = interval_b
+        if x3 < x1:
+            if x4 < x1:
+                return 0
+            else:
+                return min(x2, x4) - x1
+        else:
+            if x2 < x3:
+                return 0
+            else:
+                return min(x2, x4) - x3
+
+
+def sigmoid(x):
+    return 1. / (1. + np.exp(-x))
+
+
+def softmax(x, axis=-1):
+    """ Softmax along an axis (the last by default), shifted by the max so big logits don't overflow
+
+    >>> softmax(np.array([1000., 1000.]))
+    array([0.5, 0.5])
+    """
+    e = np.exp(x - np.max(x, axis=axis, keepdims=True))
+    return e / np.sum(e, axis=axis, keepdims=True)
+
+
+def decode_netout(netout, anchors=ANCHORS, threshold=THRESHOLD, nms_threshold=NMS_THRESHOLD):
+    """ Detections (boxes whose best class score is over threshold) from one image's YOLO output tensor
+
+    netout: array of shape (grid_h, grid_w, boxes, 4 + 1 + classes) of raw (linear) network outputs
+    """
+    grid_h, grid_w, nb_box = netout.shape[:3]
+    netout = np.asarray(netout, dtype=np.float64)
+    col = np.arange(grid_w).reshape(1, grid_w, 1)
+    row = np.arange(grid_h).reshape(grid_h, 1, 1)
+    anchors = np.reshape(anchors, (nb_box, 2))
+
+    x = (col + sigmoid(netout[..., 0])) / grid_w
+    y = (row + sigmoid(netout[..., 1])) / grid_h
+    w = anchors[:, 0] * np.exp(netout[..., 2]) / grid_w
+    h = anchors[:, 1] * np.exp(netout[..., 3]) / grid_h
+    confidence = sigmoid(netout[..., 4])
+    probs = softmax(netout[..., 5:]) * confidence[..., None]
+    probs *= probs > threshold
+
+    # only the boxes with a score over the threshold for some class take part in the suppression
+    probs = probs.reshape(-1, probs.shape[-1])
+    candidates = np.flatnonzero(probs.any(axis=1))
+    xywh = np.stack([x, y, w, h], axis=-1).reshape(-1, 4)[candidates]
+    probs = suppress(xywh, probs[candidates], iou_threshold=nms_threshold)
+
+    labels = np.argmax(probs, axis=1)
+    scores = probs[np.arange(len(probs)), labels]
+    keep = scores > threshold
+    return Detections(xywh[keep], probs[keep], labels[keep], scores[keep])
+
+
+def decode_netout_boxes(netout, anchors=ANCHORS, threshold=THRESHOLD, nms_threshold=NMS_THRESHOLD):
+    """ The scalar version of decode_netout: a list of BoundBox objects, one per anchor of every grid cell
+
+    Slow (thousands of NumPy calls per image), kept as the reference that decode_netout is tested against.
+    """
+    grid_h, grid_w, nb_box = netout.shape[:3]
+    boxes = []
+    for row in range(grid_h):
+        for col in range(grid_w):
+            for b in range(nb_box):
+                box = BoundBox(netout.shape[-1] - 5)
+                box.x, box.y, box.w, box.h, box.c = netout[row, col, b, :5]
+                box.x = (col + sigmoid(box.x)) / grid_w
+                box.y = (row + sigmoid(box.y)) / grid_h
+                box.w = anchors[2 * b + 0] * np.exp(box.w) / grid_w
+                box.h = anchors[2 * b + 1] * np.exp(box.h) / grid_h
+                box.c = sigmoid(box.c)
+                box.probs = softmax(netout[row, col, b, 5:]) * box.c
+                box.probs *= box.probs > threshold
+                boxes.append(box)
+
+    for c in range(netout.shape[-1] - 5):
+        sorted_indices = list(reversed(np.argsort([box.probs[c] for box in boxes])))
+        for i in range(len(sorted_indices)):
+            index_i = sorted_indices[i]
+            if boxes[index_i].probs[c] == 0:
+                continue
+            for j in range(i + 1, len(sorted_indices)):
+                index_j = sorted_indices[j]
+                if boxes[index_i].iou(boxes[index_j]) >= nms_threshold:
+                    boxes[index_j].probs[c] = 0
+
+    return [box for box in boxes if np.max(box.probs) > threshold]
+
+
+def to_pixels(xywh, width, height):
+    """ (N, 4) integer xmin, ymin, xmax, ymax pixel coordinates of (x, y, w, h) boxes in an image of this size
+
+    >>> to_pixels(np.array([[.5, .5, .2, .4]]), 100, 50).tolist()
+    [[40, 15, 60, 35]]
+    """
+    x, y, w, h = np.asarray(xywh, dtype=np.float64).T
+    return np.stack([(x - w / 2) * width, (y - h / 2) * height,
+                     (x + w / 2) * width, (y + h / 2) * height], axis=-1).astype(int)
+
+
+def draw_boxes(image, detections, labels=LABELS, colors=COLORS):
+    """ Draw each detected box and its label on an image array (height, width, channels) in place, with OpenCV """
+    import cv2
+
+    for (xmin, ymin, xmax, ymax), label in zip(to_pixels(detections.xywh, image.shape[1], image.shape[0]),
+                                               detections.labels):
+        cv2.rectangle(image, (xmin, ymin), (xmax, ymax), colors[label], 2)
+        cv2.putText(image, labels[label], (xmin, ymin - 12), 0, 1e-3 * image.shape[0], (0, 255, 0), 2)
+    return image
@@ -14,15 +14,28 @@ Hi hobs, how are you?
 $ bot Inspire me!
 Failure is part of the process. Each time you fail you are one step closer to success.
 
+It also uploads images to the labeler API, a whole directory tree of them at a time:
+
+$ bot upload ~/Pictures/DCIM --workers 8 --url http://localhost:8000/api/images/bulk/
+
+Completed uploads are recorded (by SHA-256) in a manifest file, so rerunning an interrupted upload
+only sends the files that haven't been uploaded yet.
 
 """
 from __future__ import division, print_function, absolute_import
 
 import argparse
+import hashlib
+import json
 import sys
 import logging
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 from labeler_site import __version__  # noqa
 
@@ -33,6 +46,9 @@ __license__ = "mit"
 _logger = logging.getLogger(__name__)
 
 WALLPAPER_PATH = os.path.join(os.path.expanduser('~'), 'Pictures', 'wallpaper')
+UPLOAD_URL = os.getenv('LABELER_UPLOAD_URL', 'http://localhost:8000/api/images/bulk/')
+MANIFEST_NAME = '.labeler_upload_manifest.jsonl'
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.tif', '.tiff', '.bmp')
 
 
 def change_wallpaper(new_path=WALLPAPER_PATH, wallpaper_path=WALLPAPER_PATH, backup=False):
@@ -103,6 +119,36 @@ def parse_args(args):
         dest="upload",
         help="Path to image file for upload to labler API",
         type=str)
+    parser.add_argument(
+        '--url',
+        dest="url",
+        help="Labeler API endpoint to upload images to (default: $LABELER_UPLOAD_URL or {})".format(UPLOAD_URL),
+        default=UPLOAD_URL,
+        type=str)
+    parser.add_argument(
+        '--workers',
+        dest="workers",
+        help="Number of files to upload at the same time, each over its own pooled connection",
+        default=8,
+        type=int)
+    parser.add_argument(
+        '--retries',
+        dest="retries",
+        help="Number of times to retry a failed request (with exponential backoff)",
+        default=5,
+        type=int)
+    parser.add_argument(
+        '--manifest',
+        dest="manifest",
+        help="File that records the completed uploads (default: DIR/{})".format(MANIFEST_NAME),
+        default=None,
+        type=str)
+    parser.add_argument(
+        '--caption',
+        dest="caption",
+        help="Caption for the uploaded images",
+        default='bot upload',
+        type=str)
     parser.add_argument(
         '-v',
         '--verbose',
@@ -167,25 +213,131 @@ def main(args):
     # _logger.debug("Starting crazy calculations...")
     if is_greeting(' '.join(unknown)):
         print("Hi {}, would you like to play a game?".format(os.getenv('USER', 'Boss')))
-    if args.upload:
-        upload(args.upload)
+    if unknown[:1] == ['upload'] and len(unknown) > 1:
+        args.upload = unknown[1]
+    if args.upload and os.path.isdir(os.path.expanduser(args.upload)):
+        setup_logging(args.loglevel or logging.INFO)
+        summary = upload_dir(args.upload, url=args.url, workers=args.workers, retries=args.retries,
+                             manifest_path=args.manifest, caption=args.caption)
+        print(summary)
+    elif args.upload:
+        upload(args.upload, url=args.url, caption=args.caption)
     # _logger.info("Script ends here")
 
 
-def upload(filepath):
-    # POST request to your API with "files" key in requests data dict
+def make_session(workers=8, retries=5, backoff_factor=0.5):
+    """ requests.Session with a connection pool big enough for all the worker threads, that retries with backoff
 
-    # base_dir = os.path.join(os.getenv('HOME'), 'Pictures')
-    base_dir = os.path.expanduser(os.path.dirname(filepath))
-    url = 'http://localhost:8000/api/'
+    Only retries what the server can't have processed, so a retried upload never creates a second Image
+    (the server dedupes the file, but not the Image record): connection errors and 429/503 responses,
+    waiting backoff_factor * 2 ** n seconds (or the Retry-After) between attempts. Read timeouts and
+    other 5xx responses aren't retried, the upload is reported as failed and retried by the next run.
+    """
+    retry_kwargs = dict(total=retries, connect=retries, read=0, status=retries, backoff_factor=backoff_factor,
+                        status_forcelist=(429, 503), raise_on_status=False)
+    try:
+        retry = Retry(allowed_methods=None, **retry_kwargs)
+    except TypeError:  # urllib3 < 1.26
+        retry = Retry(method_whitelist=False, **retry_kwargs)
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(workers, 1), max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def upload(filepath, url=UPLOAD_URL, caption='bot upload', session=None):
+    """ POST one image file to the labeler API, returning the response """
+    filepath = os.path.expanduser(filepath)
     filename = os.path.basename(filepath)
-    with open(os.path.join(base_dir, filename), 'rb') as fin:
+    with open(filepath, 'rb') as fin:
         print(fin.name)
-        POST_data = {'caption': 'bot upload'}
-        files = {'file': (filename, fin),
-                 'file_name': filename}
-        resp = requests.post(url, data=POST_data, files=files)
+        resp = (session or requests).post(url, data={'caption': caption}, files={'file': (filename, fin)})
         print(resp)
+    return resp
+
+
+def file_hash(path, chunk_size=2 ** 20):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def iter_image_paths(directory):
+    """ Yield the path of every image file under directory, in a stable (sorted) order """
+    for dirpath, dirnames, filenames in os.walk(directory):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS:
+                yield os.path.join(dirpath, filename)
+
+
+def read_manifest(manifest_path):
+    """ {sha256: record} of the files already uploaded, according to a manifest (one JSON record per line) """
+    done = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as fin:
+            for line in fin:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # a line cut short by an interrupted run
+                done[record['sha256']] = record
+    return done
+
+
+def upload_dir(directory, url=UPLOAD_URL, workers=8, retries=5, manifest_path=None, caption='bot upload',
+               session=None):
+    """ Upload every image under directory that isn't in the manifest yet, `workers` files at a time
+
+    Each completed upload is appended to the manifest as soon as it finishes, so an interrupted run
+    can be restarted and will skip the files that were already uploaded (even if they've been renamed or moved).
+
+    Returns:
+      dict: counts of the files 'uploaded', 'skipped' (already in the manifest) and 'failed'
+    """
+    directory = os.path.expanduser(directory)
+    manifest_path = manifest_path or os.path.join(directory, MANIFEST_NAME)
+    done = read_manifest(manifest_path)
+    session = session or make_session(workers=workers, retries=retries)
+    summary = dict(uploaded=0, skipped=0, failed=0)
+    lock = threading.Lock()
+
+    def upload_one(path):
+        sha256 = file_hash(path)
+        with lock:
+            if sha256 in done:
+                return 'skipped', sha256, None
+            done[sha256] = None  # so an identical file elsewhere in the tree isn't sent twice
+        with open(path, 'rb') as fin:
+            resp = session.post(url, data={'caption': caption}, files={'file': (os.path.basename(path), fin)})
+        if resp.status_code not in (200, 201):
+            with lock:
+                done.pop(sha256, None)
+            raise IOError('HTTP {} {}'.format(resp.status_code, resp.text[:200]))
+        ids = [r.get('id') for r in resp.json().get('results', []) if r.get('status') == 'created']
+        return 'uploaded', sha256, ids[0] if ids else None
+
+    with open(manifest_path, 'a') as manifest, ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        futures = {pool.submit(upload_one, path): path for path in iter_image_paths(directory)}
+        for i, future in enumerate(as_completed(futures)):
+            path = futures[future]
+            try:
+                status, sha256, image_id = future.result()
+            except (IOError, OSError, ValueError, requests.RequestException) as e:
+                status = 'failed'
+                _logger.warning('Unable to upload %s: %s', path, e)
+            summary[status] += 1
+            if status == 'uploaded':
+                record = dict(sha256=sha256, path=os.path.relpath(path, directory), id=image_id)
+                done[sha256] = record
+                manifest.write(json.dumps(record) + '\n')
+                manifest.flush()
+            if (i + 1) % 100 == 0:
+                _logger.info('%d of %d files: %r', i + 1, len(futures), summary)
+    return summary
 
 
 def run():
@@ -196,5 +348,5 @@ def run():
 
 if __name__ == "__main__":
     print('sys.args:')
-    print(sys.args)
+    print(sys.argv)
     run()
@@ -124,3 +124,57 @@ USE_TZ = True
 STATIC_URL = '/static/'
 MEDIA_URL = '/user_uploads/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'user_uploads')
+# uploads are named by the SHA-256 of their content, so duplicate uploads share one file on disk
+DEFAULT_FILE_STORAGE = 'labeler.storage.ContentAddressedStorage'
+# a blob reused by an upload in the last LABELER_BLOB_GRACE seconds isn't deleted with its last Image (that upload's
+# Image may not be committed yet), `manage.py sweep_blobs` deletes it later
+LABELER_BLOB_GRACE = 3600
+# hash, sniff and extract the EXIF from each upload as it streams in (see labeler/uploadhandlers.py)
+FILE_UPLOAD_HANDLERS = [
+    'labeler.uploadhandlers.SniffingMemoryFileUploadHandler',
+    'labeler.uploadhandlers.SniffingTemporaryFileUploadHandler',
+]
+# thumbnails and previews are made on first view, set this to make them right after upload instead
+LABELER_EAGER_DERIVATIVES = False
+# user uploads are served by labeler.views.media: set LABELER_MEDIA_SENDFILE to 'x-accel-redirect' (nginx) or
+# 'x-sendfile' (Apache/lighttpd) to hand the transfer off to the web server instead of streaming it from Django.
+# Each file is checked with LABELER_MEDIA_PERMISSION(user, images, path), which by default lets any logged in user
+# see the files of any Image (every labeler is shown every image): use 'labeler.media.uploader_or_staff' (or your own
+# function) to keep uploads private to their uploaders. With LABELER_MEDIA_REQUIRE_LOGIN = False anonymous users
+# are checked too, and by default can see every image.
+LABELER_MEDIA_REQUIRE_LOGIN = True
+LABELER_MEDIA_PERMISSION = 'labeler.media.can_view_media'
+LABELER_MEDIA_SENDFILE = None
+LABELER_MEDIA_ACCEL_PREFIX = '/protected-media/'
+# object detection (labeler.detection): the YOLO model is loaded once per worker process, on first use, and
+# concurrent requests are run through it in batches of up to MAX_BATCH images, waiting up to MAX_WAIT seconds.
+# Only requests handled by threads of the same process share a batch: run threaded workers (gunicorn --threads N),
+# with single-threaded (sync) workers set LABELER_DETECTION_MAX_WAIT = 0
+LABELER_DETECTION_WEIGHTS = None  # path to the Darknet weights, e.g. /data/vsa/tiny-yolo-voc.weights
+LABELER_DETECTION_WEIGHTS_CACHE = None  # directory for the converted weights (default: next to the weights file)
+LABELER_DETECTION_MAX_BATCH = 8
+LABELER_DETECTION_RETRY_AFTER = 60  # seconds before loading a model that failed to load is tried again
+LABELER_DETECTION_MAX_WAIT = 0.02
+LABELER_DETECTION_TIMEOUT = 30
+# machine pre-annotation (labeler.preannotate): suggest labels for new uploads with a model, in a background thread
+# (or run `manage.py preannotate --follow` on a worker instead). Predicted classes are matched to Label titles,
+# or mapped with LABELER_PREANNOTATE_LABELS, e.g. {'cat': 'bobcat'}
+LABELER_PREANNOTATE = False
+LABELER_PREANNOTATE_PREDICTOR = 'labeler.preannotate.yolo_predictions'
+LABELER_PREANNOTATE_LABELS = {}
+LABELER_PREANNOTATE_MIN_CONFIDENCE = 0.3
+LABELER_PREANNOTATE_BATCH = 16
+LABELER_CATS_VS_DOGS_WEIGHTS = 'cats-vs-dogs-keras-weights.h5'  # for labeler.preannotate.cats_vs_dogs_predictions
+# the local-memory cache is per process: with several worker processes, share the cache (and the label registry,
+# consensus and index page versions in it) with e.g. the file-based backend:
+#   CACHES = {'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+#                         'LOCATION': '/var/tmp/labeler_cache'}}
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'labeler',
+    }
+}
+# seconds each process goes without checking the shared label registry version (labels it hasn't loaded yet are
+# still looked up in the database right away)
+LABELER_LABEL_REGISTRY_TTL = 1
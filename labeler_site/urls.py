@@ -5,8 +5,6 @@ References:
 """
 from django.conf.urls import include, url
 from django.contrib import admin
-from django.conf import settings
-from django.conf.urls.static import static
 
 
 urlpatterns = [
@@ -14,7 +12,4 @@ urlpatterns = [
     url(r'^', include('labeler.urls')),
     # url(r'^', include('example_app.urls', namespace='example_app')),
 ]
-
-
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+# user uploads (MEDIA_URL) are served by labeler.views.media, which checks access first
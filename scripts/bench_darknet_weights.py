@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+""" Benchmark loading Darknet weights: whole-file read and conversion vs labeler.darknet's converted-weights cache
+
+A synthetic weights file with the layer shapes of tiny-yolo-voc (unless --weights is given) is loaded three ways,
+reporting the time and the peak of the memory numpy allocates (tracemalloc) for each:
+  fromfile: np.fromfile() of the whole file, then convert (the original labeler.yolo.WeightReader)
+  cold:     memory-mapped file, convert and write the cache (first start)
+  warm:     memory-mapped cache (every later start)
+
+Usage:
+  python scripts/bench_darknet_weights.py
+  python scripts/bench_darknet_weights.py --weights /data/vsa/tiny-yolo-voc.weights
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from labeler import darknet  # noqa
+
+
+def tiny_yolo_layers():
+    """ (layer name, [Keras weight shapes]) of the convolutions of labeler.yolo.build_model() """
+    layers, channels = [], 3
+    for i, filters in enumerate([16, 32, 64, 128, 256, 512, 1024, 1024]):
+        layers.append(('conv_{}'.format(i + 1), [(3, 3, channels, filters)]))
+        layers.append(('norm_{}'.format(i + 1), [(filters,)] * 4))
+        channels = filters
+    layers.append(('conv_9', [(1, 1, channels, 125), (125,)]))
+    return layers
+
+
+def write_weights(path, plan):
+    size = sum(int(np.prod(shape)) for _, shapes in darknet.plan_arrays(plan) for shape in shapes)
+    with open(path, 'wb') as fout:
+        fout.write(np.zeros(darknet.HEADER_SIZE, dtype='int32').tobytes())
+        np.random.RandomState(0).normal(scale=.1, size=size).astype('float32').tofile(fout)
+
+
+class FromFileReader(darknet.WeightReader):
+
+    def __init__(self, weight_file):
+        self.all_weights = np.fromfile(weight_file, dtype='float32')
+        self.offset = darknet.HEADER_SIZE
+
+
+def measure(name, load):
+    tracemalloc.start()
+    start = time.time()
+    converted = load()
+    # like Keras set_weights(), which copies every array into the model
+    total = sum(np.array(array).nbytes for arrays in converted.values() for array in arrays)
+    elapsed = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print('{:8s} {:8.1f} ms  peak {:7.1f} MB  ({:.1f} MB of weights)'.format(
+        name, elapsed * 1000, peak / 2. ** 20, total / 2. ** 20))
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--weights', default=None, help='Darknet weights file with the tiny-yolo-voc layers.')
+    args = parser.parse_args(args)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        plan = darknet.conversion_plan(tiny_yolo_layers())
+        weights_path = args.weights or os.path.join(tmpdir, 'tiny-yolo-voc.weights')
+        if not args.weights:
+            write_weights(weights_path, plan)
+        measure('fromfile', lambda: darknet.convert(FromFileReader(weights_path), plan))
+        measure('cold', lambda: darknet.load_converted(weights_path, plan, cache_dir=tmpdir))
+        measure('warm', lambda: darknet.load_converted(weights_path, plan, cache_dir=tmpdir))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
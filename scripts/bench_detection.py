@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+""" Benchmark detection throughput (images/s) of labeler.detection.BatchingPredictor for several max batch sizes
+
+The model is loaded once, then for each max batch size a pool of client threads (like the threads of a web worker)
+submits preprocessed images concurrently, and the images per second and mean batch size are reported.
+
+Usage:
+  python scripts/bench_detection.py --weights /data/vsa/tiny-yolo-voc.weights
+  python scripts/bench_detection.py --weights x --loader labeler.tests.FakeYoloModel   # just the batching overhead
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'labeler_site.settings')
+
+import django  # noqa
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--weights', required=True, help='Darknet weights file (e.g. tiny-yolo-voc.weights).')
+    parser.add_argument('--loader', default='labeler.detection.load_yolo_model',
+                        help='Dotted path of the function(weights_path) that loads the model.')
+    parser.add_argument('--batch-sizes', default='1,2,4,8,16', help='Comma-separated max batch sizes to compare.')
+    parser.add_argument('--images', type=int, default=64, help='Number of images to detect per batch size.')
+    parser.add_argument('--clients', type=int, default=16, help='Number of concurrent client threads.')
+    parser.add_argument('--max-wait', type=float, default=0.02, help='Seconds to wait for a batch to fill.')
+    return parser.parse_args(args)
+
+
+def main(args):
+    args = parse_args(args)
+    django.setup()
+    import numpy as np
+    from django.utils.module_loading import import_string
+    from labeler.detection import INPUT_SIZE, BatchingPredictor
+
+    start = time.time()
+    model = import_string(args.loader)(args.weights)
+    print('Loaded the model in {:.1f} s'.format(time.time() - start))
+    images = np.random.RandomState(0).uniform(size=(args.images, INPUT_SIZE[1], INPUT_SIZE[0], 3)).astype('float32')
+    model.predict(images[:1])  # warm up
+
+    with ThreadPoolExecutor(max_workers=args.clients) as clients:
+        for max_batch_size in [int(s) for s in args.batch_sizes.split(',')]:
+            predictor = BatchingPredictor(lambda: model, max_batch_size=max_batch_size, max_wait=args.max_wait)
+            start = time.time()
+            list(clients.map(predictor.predict, images))
+            elapsed = time.time() - start
+            print('max batch {:3d}: {:8.1f} images/s (mean batch {:.1f})'.format(
+                max_batch_size, args.images / elapsed, np.mean(predictor.batch_sizes)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+""" Benchmark EXIF extraction: the header-only JPEG parser (labeler.exif.read_exif) vs PIL.Image.open + _getexif()
+
+Reads every file several times, so both paths are measured with the files in the OS page cache,
+and checks that the two paths find the same tags in each file.
+
+Usage:
+  python scripts/bench_exif.py                      # labeler/data/*.jpg
+  python scripts/bench_exif.py --repeat 50 /path/to/DCIM/*.JPG
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'labeler_site.settings')
+
+import django  # noqa
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    default_paths = sorted(glob.glob(os.path.join(BASE_DIR, 'labeler', 'data', '*.jpg')))
+    parser.add_argument('paths', nargs='*', default=default_paths,
+                        help='Image files to read (default: labeler/data/*.jpg).')
+    parser.add_argument('--repeat', type=int, default=20, help='Number of times to read each file with each path.')
+    return parser.parse_args(args)
+
+
+def files_per_second(read, paths, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        for path in paths:
+            read(path)
+    return repeat * len(paths) / (time.time() - start)
+
+
+def main(args):
+    args = parse_args(args)
+    django.setup()
+    from labeler.exif import pil_exif, read_exif
+
+    for path in args.paths:
+        fast, slow = read_exif(path), pil_exif(path)
+        if set(fast) != set(slow):
+            print('WARNING: tags differ for {}: {}'.format(path, sorted(set(fast) ^ set(slow), key=str)))
+
+    print('Reading {} files {} times each'.format(len(args.paths), args.repeat))
+    results = [(name, files_per_second(read, args.paths, args.repeat))
+               for name, read in (('PIL.Image.open + _getexif', pil_exif), ('header-only read_exif', read_exif))]
+    for name, rate in results:
+        print('{:28s} {:9.1f} files/s'.format(name, rate))
+    print('{:28s} {:9.1f}x'.format('speedup', results[1][1] / results[0][1]))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
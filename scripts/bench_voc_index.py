@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+""" Benchmark reading VOC annotations: the original serial ElementTree loop vs labeler.voc_index, cold and warm
+
+Without --ann-dir, a VOC2012-sized directory of synthetic annotation files is written to a temporary directory.
+The three ways must give the same images and boxes (compared up to the order of the files).
+
+Usage:
+  python scripts/bench_voc_index.py
+  python scripts/bench_voc_index.py --ann-dir /data/vsa/VOCdevkit/VOC2012/Annotations/
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from labeler.voc_index import to_dicts, update_index  # noqa
+from labeler.yolo_decode import LABELS  # noqa
+
+OBJECT = """  <object><name>{}</name><pose>Unspecified</pose><truncated>0</truncated><difficult>0</difficult>
+    <bndbox><xmin>{}</xmin><ymin>{}</ymin><xmax>{}</xmax><ymax>{}</ymax></bndbox></object>"""
+
+
+def write_annotations(ann_dir, count):
+    rs = np.random.RandomState(0)
+    for i in range(count):
+        objects = [OBJECT.format(LABELS[rs.randint(len(LABELS))], *sorted(rs.randint(1, 500, 4)))
+                   for _ in range(rs.randint(1, 5))]
+        with open(os.path.join(ann_dir, '2012_{:06d}.xml'.format(i)), 'w') as fout:
+            fout.write('<annotation><folder>VOC2012</folder><filename>2012_{:06d}.jpg</filename>\n'
+                       '  <size><width>500</width><height>375</height><depth>3</depth></size>\n{}\n'
+                       '</annotation>\n'.format(i, '\n'.join(objects)))
+
+
+def parse_serial(ann_dir):
+    """ The original labeler.yolo.parse_annotation """
+    all_img = []
+    for ann in os.listdir(ann_dir):
+        img = {'object': []}
+        tree = ET.parse(os.path.join(ann_dir, ann))
+        for elem in tree.iter():
+            if 'filename' in elem.tag:
+                all_img += [img]
+                img['filename'] = elem.text
+            if 'width' in elem.tag:
+                img['width'] = int(elem.text)
+            if 'height' in elem.tag:
+                img['height'] = int(elem.text)
+            if 'object' in elem.tag or 'part' in elem.tag:
+                obj = {}
+                for attr in list(elem):
+                    if 'name' in attr.tag:
+                        obj['name'] = attr.text
+                        if obj['name'] in LABELS:
+                            img['object'] += [obj]
+                        else:
+                            break
+                    if 'bndbox' in attr.tag:
+                        for dim in list(attr):
+                            for name in ('xmin', 'ymin', 'xmax', 'ymax'):
+                                if name in dim.tag:
+                                    obj[name] = int(round(float(dim.text)))
+    return all_img
+
+
+def timed(name, parse):
+    start = time.time()
+    images = parse()
+    print('{:8s} {:8.2f} s  ({} images, {} boxes)'.format(
+        name, time.time() - start, len(images), sum(len(img['object']) for img in images)))
+    return sorted(images, key=lambda img: img['filename'])
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--ann-dir', default=None, help='Directory of VOC annotation files.')
+    parser.add_argument('--files', type=int, default=17125, help='Number of synthetic annotation files.')
+    parser.add_argument('--workers', type=int, default=None, help='Parser processes (default: one per CPU).')
+    args = parser.parse_args(args)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        ann_dir = args.ann_dir
+        if not ann_dir:
+            ann_dir = os.path.join(tmpdir, 'Annotations')
+            os.mkdir(ann_dir)
+            write_annotations(ann_dir, args.files)
+        index_path = os.path.join(tmpdir, 'Annotations.index.npz')
+        serial = timed('serial', lambda: parse_serial(ann_dir))
+        cold = timed('cold', lambda: to_dicts(update_index(ann_dir, index_path=index_path, workers=args.workers)))
+        warm = timed('warm', lambda: to_dicts(update_index(ann_dir, index_path=index_path, workers=args.workers)))
+        assert serial == cold == warm, 'the index differs from the serial parse'
+        print('index: {:.1f} MB'.format(os.path.getsize(index_path) / 2. ** 20))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
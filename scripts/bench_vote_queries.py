@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+""" Benchmark the hot voting queries before and after the 0012_voting_indexes migration
+
+Seeds a throwaway sqlite database (never your real one) with N ImageLabel ballots,
+then prints the EXPLAIN plan and the mean time of each query with the schema migrated
+to 0011 (FK indexes only) and then to 0012 (composite indexes + unique TotalVotes).
+
+Usage:
+  python scripts/bench_vote_queries.py -n 200000 --images 20000 --users 200
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import timeit
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'labeler_site.settings')
+
+import django  # noqa
+from django.conf import settings  # noqa
+
+BEFORE, AFTER = '0011_label_title', '0012_voting_indexes'
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', '--num-votes', type=int, default=100000, help='Number of ImageLabel rows to seed.')
+    parser.add_argument('--images', type=int, default=10000, help='Number of Image rows to seed.')
+    parser.add_argument('--users', type=int, default=100, help='Number of User rows to seed.')
+    parser.add_argument('--labels', type=int, default=20, help='Number of Label rows to seed.')
+    parser.add_argument('--repeat', type=int, default=200, help='Number of times to run each query.')
+    parser.add_argument('--db', default=None, help='Path for the scratch sqlite db (default: a temporary file).')
+    return parser.parse_args(args)
+
+
+def historical_apps(migration):
+    """ The app registry as of a migration, so the seeding and queries only touch the columns that exist then """
+    from django.db import connection
+    from django.db.migrations.executor import MigrationExecutor
+    return MigrationExecutor(connection).loader.project_state(('labeler', migration)).apps
+
+
+def seed(apps, num_votes, num_images, num_users, num_labels):
+    from collections import Counter
+    from django.db import models
+    User, Label = apps.get_model('auth', 'User'), apps.get_model('labeler', 'Label')
+    Image, ImageLabel = apps.get_model('labeler', 'Image'), apps.get_model('labeler', 'ImageLabel')
+    TotalVotes = apps.get_model('labeler', 'TotalVotes')
+
+    User.objects.bulk_create([User(username='user{}'.format(i)) for i in range(num_users)])
+    Label.objects.bulk_create([Label(title='label{}'.format(i)) for i in range(num_labels)])
+    Image.objects.bulk_create([Image(file='images/bench{}.jpg'.format(i)) for i in range(num_images)])
+    user_ids = list(User.objects.values_list('id', flat=True))
+    titles = dict(Label.objects.values_list('id', 'title'))
+    image_ids = list(Image.objects.values_list('id', flat=True))
+    ballots = [(random.choice(image_ids), random.choice(list(titles)), random.choice(user_ids))
+               for i in range(num_votes)]
+    # plain QuerySet.bulk_create, the tallies are counted here rather than by rebuild_totalvotes, which needs the
+    # columns and tables added after BEFORE
+    models.QuerySet(ImageLabel).bulk_create(
+        (ImageLabel(image_id=image_id, label_id=label_id, user_id=user_id) for image_id, label_id, user_id in ballots))
+    tallies = Counter((image_id, titles[label_id]) for image_id, label_id, _ in ballots)
+    TotalVotes.objects.bulk_create((TotalVotes(image_id=image_id, name=name, votes=votes)
+                                    for (image_id, name), votes in sorted(tallies.items())))
+    return image_ids, user_ids, sorted(titles.values())
+
+
+def hot_queries(apps, image_ids, user_ids, titles):
+    """ {name: function returning a fresh QuerySet for a random image/user/label} """
+    from django.db.models import Count
+    ImageLabel, TotalVotes = apps.get_model('labeler', 'ImageLabel'), apps.get_model('labeler', 'TotalVotes')
+    return {
+        'votes for image': lambda: (ImageLabel.objects.filter(image_id=random.choice(image_ids))
+                                    .values('label_id').annotate(votes=Count('id')).order_by()),
+        'user voted on image': lambda: ImageLabel.objects.filter(
+            user_id=random.choice(user_ids), image_id=random.choice(image_ids)).values('id')[:1],
+        'tally for image and label': lambda: TotalVotes.objects.filter(
+            image_id=random.choice(image_ids), name=random.choice(titles)).values('votes'),
+    }
+
+
+def explain(queryset):
+    from django.db import connection
+    sql, params = queryset.query.sql_with_params()
+    prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+    with connection.cursor() as cursor:
+        cursor.execute(prefix + sql, params)
+        return [' '.join(str(col) for col in row) for row in cursor.fetchall()]
+
+
+def report(stage, queries, repeat):
+    print('\n=== {} ==='.format(stage))
+    for name, make_queryset in sorted(queries.items()):
+        seconds = timeit.timeit(lambda: list(make_queryset()), number=repeat) / repeat
+        print('{:28s} {:9.1f} us/query'.format(name, seconds * 1e6))
+        for line in explain(make_queryset()):
+            print('    ' + line)
+
+
+def main(args):
+    args = parse_args(args)
+    db_path = args.db or tempfile.mkstemp(suffix='.sqlite3', prefix='bench_votes_')[1]
+    settings.DATABASES['default']['NAME'] = db_path
+    settings.DEBUG = False  # don't let the query log skew the timings
+    django.setup()
+    from django.core.management import call_command
+
+    call_command('migrate', verbosity=0)
+    call_command('migrate', 'labeler', BEFORE, verbosity=0)
+    print('Seeding {} votes on {} images by {} users in {}'.format(args.num_votes, args.images, args.users, db_path))
+    apps = historical_apps(BEFORE)
+    ids = seed(apps, args.num_votes, args.images, args.users, args.labels)
+    queries = hot_queries(apps, *ids)
+
+    report('before ({})'.format(BEFORE), queries, args.repeat)
+    call_command('migrate', 'labeler', AFTER, verbosity=0)
+    report('after ({})'.format(AFTER), queries, args.repeat)
+
+    if not args.db:
+        os.remove(db_path)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+""" Benchmark decoding YOLO v2 output: vectorized labeler.yolo_decode.decode_netout vs the per-box scalar loop
+
+Decodes random (13, 13, 5, 25) network outputs (with the confidence logits shifted so a realistic number of boxes
+pass the threshold) with both versions, checks that they find the same boxes, and reports the time per image.
+
+Usage:
+  python scripts/bench_yolo_decode.py
+  python scripts/bench_yolo_decode.py --images 50 --confidence-shift -4
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from labeler.yolo_decode import BOX, CLASS, GRID_H, GRID_W, decode_netout, decode_netout_boxes  # noqa
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--images', type=int, default=20, help='Number of network outputs to decode.')
+    parser.add_argument('--confidence-shift', type=float, default=-3.,
+                        help='Added to the confidence logits (lower means fewer boxes over the threshold).')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(args)
+
+
+def seconds_per_image(decode, netouts):
+    start = time.time()
+    for netout in netouts:
+        decode(netout)
+    return (time.time() - start) / len(netouts)
+
+
+def same_boxes(detections, boxes):
+    vectorized = sorted(tuple(np.round(list(xywh) + [label, score], 9))
+                        for xywh, label, score in zip(detections.xywh, detections.labels, detections.scores))
+    scalar = sorted(tuple(np.round([b.x, b.y, b.w, b.h, np.argmax(b.probs), np.max(b.probs)], 9)) for b in boxes)
+    return vectorized == scalar
+
+
+def main(args):
+    args = parse_args(args)
+    rs = np.random.RandomState(args.seed)
+    netouts = rs.normal(scale=2, size=(args.images, GRID_H, GRID_W, BOX, 4 + 1 + CLASS))
+    netouts[..., 4] += args.confidence_shift
+
+    counts = []
+    for i, netout in enumerate(netouts):
+        detections = decode_netout(netout)
+        counts.append(len(detections.scores))
+        if not same_boxes(detections, decode_netout_boxes(netout)):
+            print('WARNING: the two versions found different boxes in image {}'.format(i))
+
+    print('Decoding {} outputs of shape {} ({:.1f} boxes per image)'.format(
+        len(netouts), netouts.shape[1:], np.mean(counts)))
+    results = [(name, seconds_per_image(decode, netouts))
+               for name, decode in (('scalar loop (BoundBox)', decode_netout_boxes),
+                                    ('vectorized decode_netout', decode_netout))]
+    for name, seconds in results:
+        print('{:28s} {:9.3f} ms/image'.format(name, 1000 * seconds))
+    print('{:28s} {:9.1f}x'.format('speedup', results[0][1] / results[1][1]))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
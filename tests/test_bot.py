@@ -1,8 +1,12 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import json
+import os
+import threading
+
 import pytest
-from labeler_site.bot import recognize_greeting
+from labeler_site.bot import MANIFEST_NAME, make_session, recognize_greeting, upload_dir
 
 
 __author__ = "Hobson Lane"
@@ -16,3 +20,69 @@ def test_recognize_greeting():
     assert recognize_greeting('') is False
     with pytest.raises(AttributeError):
         recognize_greeting(None)
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, data):
+        self.status_code, self.data, self.text = status_code, data, json.dumps(data)
+
+    def json(self):
+        return self.data
+
+
+class FakeSession(object):
+    """ Records the files posted to it, and fails the ones whose name contains 'bad' """
+
+    def __init__(self):
+        self.posted = []
+        self.lock = threading.Lock()
+
+    def post(self, url, data=None, files=None):
+        name, fin = files['file']
+        with self.lock:
+            self.posted.append(name)
+            image_id = len(self.posted)
+        if 'bad' in name:
+            return FakeResponse(503, {'detail': 'Service Unavailable'})
+        return FakeResponse(201, {'created': 1, 'results': [{'name': name, 'status': 'created', 'id': image_id}]})
+
+
+def make_images(directory, files):
+    for name, content in files.items():
+        path = os.path.join(directory, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as fout:
+            fout.write(content)
+
+
+def test_upload_dir_resumes(tmpdir):
+    directory = str(tmpdir)
+    make_images(directory, {'a.jpg': b'a', 'DCIM/b.JPG': b'b', 'DCIM/copy_of_a.jpg': b'a', 'bad.jpg': b'x',
+                            'notes.txt': b'not an image'})
+    session = FakeSession()
+    summary = upload_dir(directory, workers=4, session=session)
+    assert summary == dict(uploaded=2, skipped=1, failed=1)
+    # a.jpg and copy_of_a.jpg have the same content, so only one of them is sent
+    assert len(session.posted) == 3 and {'b.JPG', 'bad.jpg'} < set(session.posted)
+
+    session = FakeSession()
+    summary = upload_dir(directory, workers=4, session=session)
+    assert summary == dict(uploaded=0, skipped=3, failed=1)
+    assert session.posted == ['bad.jpg']
+
+    with open(os.path.join(directory, MANIFEST_NAME)) as fin:
+        assert len(fin.readlines()) == 2
+
+
+def test_session_pool_and_retries():
+    session = make_session(workers=16, retries=3)
+    adapter = session.get_adapter('http://localhost:8000/')
+    assert adapter._pool_maxsize == 16
+    assert adapter.max_retries.total == 3
+    # uploads aren't idempotent: only retry POSTs the server can't have processed
+    assert adapter.max_retries.is_retry('POST', 503)
+    assert adapter.max_retries.is_retry('POST', 429)
+    assert not adapter.max_retries.is_retry('POST', 500)
+    assert not adapter.max_retries.is_retry('POST', 504)
+    assert adapter.max_retries.read == 0